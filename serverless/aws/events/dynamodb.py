@@ -1,15 +1,18 @@
 import logging
-import boto3
 import json
 from boto3.dynamodb.types import TypeDeserializer
 from decimal import Decimal
-from  dynamoplus.v2.indexing_service_v2 import create_indexes,update_indexes,delete_indexes
+from typing import *
+from dynamoplus.utils.executor import run_in_parallel
+from dynamoplus.v2.repository.repositories import get_unsharded_sk
+from dynamoplus.v2.indexing_service_v2 import index_batch
+from dynamoplus.v2.service.system.metadata_cache import MetadataGeneration, metadata_caches
+from dynamoplus.v2.service.system.system_service import AggregationService
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 serializer = TypeDeserializer()
-dynamodb = boto3.resource("dynamodb")
 
 
 def deserialize(data):
@@ -25,63 +28,146 @@ def deserialize(data):
         return data
 
 
-def dynamo_stream_handler(event, context):
-    logger.info("Events on dynamo {} ".format(str(event)))
+def get_document(record: dict):
+    if "document" in record:
+        if isinstance(record["document"], dict):
+            return record["document"]
+        else:
+            return json.loads(record["document"], parse_float=Decimal)
+    return {}
+
 
+def dynamo_system_stream_handler(event, context):
+    ## bumps the metadata generation so that the containers evict the changed metadata from their cache
+    metadata_types = set()
     for record in event.get('Records'):
         keys = record['dynamodb']['Keys']
+        sk = keys['sk']['S']
+        if sk in metadata_caches:
+            metadata_types.add(sk)
+        else:
+            logger.debug('Skipping metadata record {} - {}'.format(keys['pk']['S'], sk))
+    if metadata_types:
+        logger.info("metadata changed {}".format(metadata_types))
+        MetadataGeneration.bump(sorted(metadata_types))
+
+
+def get_change(record: dict):
+    """
+    returns the (new_document, old_document) of a stream record, None for the image missing for the event
+    """
+    event_name = record.get('eventName')
+    new_document = get_document(deserialize(record['dynamodb']['NewImage'])) \
+        if event_name in ['INSERT', 'MODIFY'] else None
+    old_document = get_document(deserialize(record['dynamodb']['OldImage'])) \
+        if event_name in ['MODIFY', 'REMOVE'] else None
+    return new_document, old_document
+
+
+def coalesce_changes(changes: List[Tuple[str, str, dict, dict]], applied: Dict[str, List[str]] = None):
+    """
+    folds the changes (pk, sequence_number, new_document, old_document) of the same document into a single net
+    change, from the oldest old document to the newest new document.
+
+    e.g. INSERT + MODIFY is an INSERT, MODIFY + REMOVE is a REMOVE, REMOVE + INSERT is a MODIFY and INSERT + REMOVE
+    is dropped. Returns (sequence_numbers, new_document, old_document) in order of first appearance, the sequence
+    numbers are the ones of the folded records. The records with different `applied` aggregations (by sequence
+    number) aren't folded together.
+    """
+    coalesced = []
+    ## pk -> (applied aggregations, position of the change still folding the records of the pk)
+    folding = {}
+    for pk, sequence_number, new_document, old_document in changes:
+        applied_aggregations = frozenset((applied or {}).get(sequence_number, []))
+        if pk in folding and folding[pk][0] == applied_aggregations:
+            i = folding[pk][1]
+            sequence_numbers, _, first_old_document = coalesced[i]
+            coalesced[i] = (sequence_numbers + [sequence_number], new_document, first_old_document)
+        else:
+            folding[pk] = (applied_aggregations, len(coalesced))
+            coalesced.append(([sequence_number], new_document, old_document))
+    return [c for c in coalesced if c[1] is not None or c[2] is not None]
 
+
+def dynamo_stream_handler(event, context):
+    ## the records are grouped by collection and each group is indexed as a batch, the records that can't be
+    ## processed are reported as failures so that only them (and the following ones) are retried
+    records = event.get('Records')
+    logger.info("Events on dynamo {} ".format(len(records)))
+    if not records:
+        return {"batchItemFailures": []}
+    ## the retry of a batch starts with the first failed record, the aggregations already applied to the records
+    ## of the failed batch are skipped
+    first_sequence_number = records[0]['dynamodb'].get('SequenceNumber')
+    previously_applied = AggregationService.get_applied_aggregations(first_sequence_number)
+    positions = {record['dynamodb'].get('SequenceNumber'): i for i, record in enumerate(records)}
+    failures = []
+    applied = {}
+    groups = {}
+    for record in records:
+        sequence_number = record['dynamodb'].get('SequenceNumber')
+        keys = record['dynamodb']['Keys']
         pk = keys['pk']['S']
         sk = keys['sk']['S']
-        if "#" not in sk:
-
-            if record.get('eventName') == 'INSERT':
-                new_record = deserialize(record['dynamodb']['NewImage'])
-                logger.info("creating index for {}".format(str(new_record)))
-                if "document" in new_record:
-                    if isinstance(new_record["document"], dict):
-                        new_document = new_record["document"]
-                    else:
-                        new_document = json.loads(new_record["document"],
-                                              parse_float=Decimal) if "document" in new_record else {}
-
-                create_indexes(sk, new_document)
-                # create_indexes_for_collection(sk,new_document, lambda r: r.create(new_document))
-
-            elif record.get('eventName') == 'MODIFY':
-                new_record = deserialize(record['dynamodb']['NewImage'])
-                old_record = deserialize(record['dynamodb']['OldImage'])
-                # new_document = dict(filter(lambda kv: kv[0] not in ["geokey","hashkey"], new_record.items()))
-                logger.info("updating index for {}".format(str(new_record)))
-                if "document" in new_record:
-                    if isinstance(new_record["document"], dict):
-                        new_document = new_record["document"]
-                    else:
-                        new_document = json.loads(new_record["document"],
-                                              parse_float=Decimal) if "document" in new_record else {}
-                if "document" in old_record:
-                    if isinstance(old_record["document"], dict):
-                        old_document = old_record["document"]
-                    else:
-                        old_document = json.loads(old_record["document"],
-                                                  parse_float=Decimal) if "document" in old_record else {}
-
-                update_indexes(sk, old_document,new_document)
-                # create_indexes_for_collection(sk, new_document, lambda r: r.update(new_document))
-
-            elif record.get('eventName') == 'REMOVE':
-                old_record = deserialize(record['dynamodb']['OldImage'])
-                logger.info('removing index on record  {}'.format(str(old_record)))
-                if "document" in old_record:
-                    if isinstance(old_record["document"], dict):
-                        old_document = old_record["document"]
-                    else:
-                        old_document = json.loads(old_record["document"],
-                                              parse_float=Decimal) if "document" in old_record else {}
-
-                delete_indexes(sk, old_document)
-                # id = new_document[collection_metadata.id_key]
-                # indexing(lambda r: r.delete(id), system_service, sk,
-                #          collection_metadata, new_document)
-        else:
+        if "#" in sk:
             logger.debug('Skipping indexing on record {} - {}'.format(pk, sk))
+            continue
+        try:
+            new_document, old_document = get_change(record)
+            ## the main rows of a sharded collection have the shard after the collection name
+            groups.setdefault(get_unsharded_sk(sk), []).append((pk, sequence_number, new_document, old_document))
+        except Exception as e:
+            logger.error("unable to read the record {} - {}: {}".format(pk, sk, e))
+            failures.append(sequence_number)
+
+    def process(collection_name: str, changes: list):
+        ## a hot document is indexed once per batch with its net change
+        changes = coalesce_changes(changes, previously_applied)
+        changes_applied = [set(previously_applied.get(sequence_numbers[0], [])) for sequence_numbers, _, _ in changes]
+        try:
+            failed = index_batch(collection_name, [(new_document, old_document)
+                                                   for _, new_document, old_document in changes], changes_applied)
+            failed_sequence_numbers = [sequence_number for i in failed for sequence_number in changes[i][0]]
+        except Exception as e:
+            logger.error("unable to index the records of {}: {}".format(collection_name, e))
+            failed_sequence_numbers = [sequence_number for sequence_numbers, _, _ in changes
+                                       for sequence_number in sequence_numbers]
+        for (sequence_numbers, _, _), change_applied in zip(changes, changes_applied):
+            for sequence_number in sequence_numbers:
+                applied[sequence_number] = change_applied
+        return failed_sequence_numbers
+
+    for failed in run_in_parallel([lambda sk=sk, changes=changes: process(sk, changes) for sk, changes in
+                                   groups.items()]):
+        failures.extend(failed)
+    saved = None
+    if failures:
+        logger.info("{} records failed".format(len(failures)))
+        saved = save_applied_aggregations(failures, applied, positions)
+    if previously_applied and saved != first_sequence_number:
+        try:
+            AggregationService.delete_applied_aggregations(first_sequence_number)
+        except Exception as e:
+            logger.error("unable to delete the aggregations applied to the records from {}: {}".format(first_sequence_number, e))
+    return {"batchItemFailures": [{"itemIdentifier": f} for f in failures]}
+
+
+def save_applied_aggregations(failures: List[str], applied: Dict[str, Set[str]],
+                              positions: Dict[str, int]) -> Optional[str]:
+    """
+    Lambda retries all the records starting from the first failure, the aggregations already applied to them are
+    saved for the retry since the increments of the aggregations aren't idempotent. Returns the sequence number
+    they are saved with, None if there is nothing to save.
+    """
+    first_failure = min(failures, key=positions.get)
+    to_retry = {sequence_number: sorted(keys) for sequence_number, keys in applied.items()
+                if keys and positions[sequence_number] >= positions[first_failure]}
+    if not to_retry:
+        return None
+    try:
+        AggregationService.set_applied_aggregations(first_failure, to_retry)
+        return first_failure
+    except Exception as e:
+        logger.error("unable to save the aggregations applied to the records from {}, they will be applied again: {}".format(
+            first_failure, e))
+        return None
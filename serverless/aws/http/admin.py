@@ -2,10 +2,13 @@ try:
   import unzip_requirements
 except ImportError:
   pass
+import json
 import logging
 
 ## TODO: use an interface and not directly the repo
 from dynamoplus.v2.repository.repositories import create_tables,cleanup_tables
+from dynamoplus.v2.indexing_service_v2 import reindex as reindex_collection
+from dynamoplus.v2.service.cursor import encode_cursor
 
 
 logging.basicConfig(level=logging.INFO)
@@ -18,4 +21,17 @@ def setup(event, context):
 
 def cleanup(event,context):
     cleanup_tables()
-    return {"statusCode": 200}
\ No newline at end of file
+    return {"statusCode": 200}
+
+
+def reindex(event, context):
+    ## rewrites a page of the rows of a collection, to be called again with the returned last_key until it's null
+    collection_name = event["pathParameters"]["collection"]
+    query_string_parameters = event.get("queryStringParameters") or {}
+    try:
+        last_key = reindex_collection(collection_name, query_string_parameters.get("last_key"),
+                                      int(query_string_parameters.get("limit", "100")))
+    except Exception as e:
+        logging.error("unable to reindex {}: {}".format(collection_name, e))
+        return {"statusCode": 400, "body": json.dumps({"msg": str(e)})}
+    return {"statusCode": 200, "body": json.dumps({"last_key": encode_cursor(last_key)})}
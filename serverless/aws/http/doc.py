@@ -86,7 +86,7 @@ def swagger_json(event, context):
                     {
                         "name": "last_key",
                         "in": "query",
-                        "description": "last id",
+                        "description": "last_key returned by the previous page (or the last id)",
                         "required": False,
                         "schema": {"type": "string"}
                     }
@@ -102,7 +102,8 @@ def swagger_json(event, context):
                                                 "type": "array",
                                                 "items": {"$ref": "#/components/schemas/Collection"}
                                             },
-                                            "has_more": {"type": "boolean"}
+                                            "has_more": {"type": "boolean"},
+                                            "last_key": {"type": "string"}
                                         }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -136,7 +137,8 @@ def swagger_json(event, context):
                                         "type": "array",
                                         "items": {"$ref": "#/components/schemas/Collection"}
                                     },
-                                    "lastKey": {"type": "string"}
+                                    "has_more": {"type": "boolean"},
+                                    "last_key": {"type": "string"}
                                 }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -201,7 +203,7 @@ def swagger_json(event, context):
                     {
                         "name": "last_key",
                         "in": "query",
-                        "description": "last id",
+                        "description": "last_key returned by the previous page (or the last id)",
                         "required": False,
                         "schema": {"type": "string"}
                     }
@@ -217,7 +219,8 @@ def swagger_json(event, context):
                                                 "type": "array",
                                                 "items": {"$ref": "#/components/schemas/Index"}
                                             },
-                                            "has_more": {"type": "boolean"}
+                                            "has_more": {"type": "boolean"},
+                                            "last_key": {"type": "string"}
                                         }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -260,7 +263,8 @@ def swagger_json(event, context):
                                         "type": "array",
                                         "items": {"$ref": "#/components/schemas/Index"}
                                     },
-                                    "lastKey": {"type": "string"}
+                                    "has_more": {"type": "boolean"},
+                                    "last_key": {"type": "string"}
                                 }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -377,7 +381,7 @@ def swagger_json(event, context):
                     {
                         "name": "last_key",
                         "in": "query",
-                        "description": "last id",
+                        "description": "last_key returned by the previous page (or the last id)",
                         "required": False,
                         "schema": {"type": "string"}
                     }
@@ -398,7 +402,8 @@ def swagger_json(event, context):
                                                     ]
                                                 }
                                             },
-                                            "has_more": {"type": "boolean"}
+                                            "has_more": {"type": "boolean"},
+                                            "last_key": {"type": "string"}
                                         }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -462,7 +467,7 @@ def swagger_json(event, context):
                     {
                         "name": "last_key",
                         "in": "query",
-                        "description": "last id",
+                        "description": "last_key returned by the previous page (or the last id)",
                         "required": False,
                         "schema": {"type": "string"}
                     }
@@ -478,7 +483,8 @@ def swagger_json(event, context):
                                                 "type": "array",
                                                 "items": {"$ref": "#/components/schemas/Aggregation"}
                                             },
-                                            "has_more": {"type": "boolean"}
+                                            "has_more": {"type": "boolean"},
+                                            "last_key": {"type": "string"}
                                         }}}}},
                     "403": {"description": "Access forbidden for system API"}
                 }
@@ -602,7 +608,7 @@ def add_collection(c, spec):
                 {
                     "name": "last_key",
                     "in": "query",
-                    "description": "last id",
+                    "description": "last_key returned by the previous page (or the last id)",
                     "required": False,
                     "schema": {"type": "string"}
                 }
@@ -618,7 +624,8 @@ def add_collection(c, spec):
                                             "type": "array",
                                             "items": {"$ref": "#/components/schemas/{}".format(c.name)}
                                         },
-                                        "has_more": {"type": "boolean"}
+                                        "has_more": {"type": "boolean"},
+                                        "last_key": {"type": "string"}
                                     }}}}},
                 "403": {"description": "Access forbidden for system API"}
             }
@@ -662,7 +669,14 @@ def add_query_to_spec(i: Index, spec):
                                 "type": "object",
                                 "properties": get_schema_from_conditions(i.conditions)
 
-                            }
+                            },
+                            "order_by": {"type": "string",
+                                         "description": "the field the documents are sorted by, it needs an index "
+                                                        "ordered by it"},
+                            "direction": {"type": "string", "enum": ["ASC", "DESC"], "default": "DESC",
+                                          "description": "the order of the documents, uppercase"},
+                            "count": {"type": "boolean", "default": False,
+                                      "description": "returns only the number of matching documents"}
                         },
                         "required": ["matches"]
                     }}
@@ -680,7 +694,9 @@ def add_query_to_spec(i: Index, spec):
                                         "type": "array",
                                         "items": {"$ref": "#/components/schemas/{}".format(i.collection_name)}
                                     },
-                                    "lastKey": {"type": "string"}
+                                    "has_more": {"type": "boolean"},
+                                    "last_key": {"type": "string"},
+                                    "count": {"type": "integer", "description": "only with count"}
                                 }}}}},
                 "403": {"description": "Access forbidden for system API"}
             }
@@ -7,10 +7,11 @@ from decimal import Decimal
 from fastjsonschema import JsonSchemaException
 
 from dynamoplus.dynamo_plus_v2 import get as dynamoplus_get, update as dynamoplus_update, aggregation_configurations as get_aggregation_configurations, \
-    query as dynamoplus_query, \
+    query as dynamoplus_query, count as dynamoplus_count, \
     create as dynamoplus_create, delete as dynamoplus_delete, get_all as dynamoplus_get_all, HandlerException
 
 from dynamoplus.utils.decimalencoder import DecimalEncoder
+from dynamoplus.v2.service.cursor import encode_cursor
 from custom.custom_service import CustomService
 
 logger = logging.getLogger()
@@ -59,7 +60,8 @@ class HttpHandler(object):
                 else:
                     documents, last_evaluated_key = dynamoplus_get_all(collection, last_key, limit)
 
-                result = {"data": documents, "has_more": last_evaluated_key is not None}
+                result = {"data": documents, "has_more": last_evaluated_key is not None,
+                          "last_key": encode_cursor(last_evaluated_key)}
                 return self.get_http_response(body=self.format_json(result), headers=self.get_response_headers(headers),
                                               statusCode=200)
             except HandlerException as e:
@@ -140,9 +142,14 @@ class HttpHandler(object):
         logger.debug("last_key = {}".format(last_key))
         logger.debug("limit = {}".format(limit))
         try:
+            if q.get("count"):
+                result = {"count": dynamoplus_count(collection, q)}
+                return self.get_http_response(body=self.format_json(result),
+                                              headers=self.get_response_headers(headers), statusCode=200)
             documents, last_evaluated_key = dynamoplus_query(collection, q, last_key,
                                                              limit)
-            result = {"data": documents, "has_more": last_evaluated_key is not None}
+            result = {"data": documents, "has_more": last_evaluated_key is not None,
+                      "last_key": encode_cursor(last_evaluated_key)}
             return self.get_http_response(body=self.format_json(result), headers=self.get_response_headers(headers),
                                           statusCode=200)
         except HandlerException as e:
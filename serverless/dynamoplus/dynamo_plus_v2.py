@@ -1,5 +1,6 @@
 import abc
 import logging
+import os
 
 import uuid
 from datetime import datetime
@@ -7,11 +8,14 @@ import time
 from enum import Enum
 
 from dynamoplus.v2.service.query_service import QueryService
+from dynamoplus.v2.service.cursor import InvalidCursorException
 from dynamoplus.v2.service.system.system_service import CollectionService, IndexService, \
     AuthorizationService, Converter, Collection, AggregationConfigurationService, AggregationService
-from dynamoplus.models.query.conditions import Predicate, Range, Eq, And
+from dynamoplus.models.query.conditions import Predicate, Range, Eq, And, expand_disjunctions
 from dynamoplus.v2.service.domain.domain_service import DomainService
 from dynamoplus.v2.service.common import is_system
+from dynamoplus.v2.service.key_encoding import get_attribute_type
+from dynamoplus.models.system.collection.collection import AttributeType
 from dynamoplus.service.validation_service import validate_collection, validate_index, validate_document, \
     validate_client_authorization, validate_aggregation
 from dynamoplus.service.indexing_decorator import create_document, update_document, delete_document
@@ -19,6 +23,9 @@ from dynamoplus.service.indexing_decorator import create_document, update_docume
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+## every branch of an Or (or value of an In) is a query, they are executed in parallel
+query_max_branches = int(os.environ.get("QUERY_MAX_BRANCHES", "20"))
+
 
 class HandlerExceptionErrorCodes(Enum):
     BAD_REQUEST = 400
@@ -41,7 +48,7 @@ def get_all(collection_name: str, last_key: str, limit: int):
         logger.info("Get {} metadata from system".format(collection_name))
         if collection_name == 'collection':
             last_collection_metadata = None
-            collections, last_evaluated_key = CollectionService.get_all_collections(limit, last_key)
+            collections, last_evaluated_key = CollectionService.get_all_collections(last_key, limit)
             documents = list(map(lambda c: Converter.from_collection_to_API(c), collections))
             return documents, last_evaluated_key
         elif collection_name == 'aggregation_configuration':
@@ -112,6 +119,11 @@ def get(collection_name: str, document_id: str):
         elif collection_name == 'aggregation':
             aggregation = AggregationService.get_aggregation_by_name(document_id)
             if aggregation is None:
+                ## a group_by aggregation has an item per group instead of a single one
+                groups = list(AggregationService.get_aggregation_groups_generator(document_id))
+                if len(groups) > 0:
+                    return {"name": document_id,
+                            "groups": list(map(lambda g: Converter.from_aggregation_to_API(g), groups))}
                 raise HandlerException(HandlerExceptionErrorCodes.NOT_FOUND,
                                        "{} not found with name {}".format(collection_name, document_id))
             logger.info("Found aggregation {}".format(aggregation.__str__))
@@ -159,6 +171,15 @@ def create(collection_name: str, document: dict) -> dict:
         elif collection_name == "aggregation_configuration":
             validate_aggregation(document)
             aggregation = Converter.from_API_to_aggregation_configuration(document)
+            if aggregation.type.is_extreme() and (aggregation.target_field is None or get_attribute_type(
+                    CollectionService.get_collection(aggregation.collection_name),
+                    aggregation.target_field) != AttributeType.NUMBER):
+                ## the extreme is read from an index by the field, it's ordered as a number only if typed
+                raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                                       "{} needs a target_field of type NUMBER".format(aggregation.type.name))
+            if aggregation.type.is_extreme() and aggregation.group_by:
+                raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                                       "group_by is not supported by {}".format(aggregation.type.name))
             aggregation = AggregationConfigurationService.create_aggregation_configuration(aggregation)
             logging.info("created aggregation {}".format(aggregation.__str__()))
             return Converter.from_aggregation_configuration_to_API(aggregation)
@@ -219,7 +240,7 @@ def query(collection_name: str, query: dict = None, start_from: str = None,
     documents = []
     if is_system_collection:
         if collection_name == 'collection':
-            collections, last_key = CollectionService.get_all_collections(limit, start_from)
+            collections, last_key = CollectionService.get_all_collections(start_from, limit)
             documents = list(map(lambda c: Converter.from_collection_to_API(c), collections))
             last_evaluated_key = last_key
         elif collection_name == 'index' and "matches" in query and "eq" in query["matches"] and "value" in \
@@ -233,30 +254,85 @@ def query(collection_name: str, query: dict = None, start_from: str = None,
             raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
                                    "{} is not a valid collection".format(collection_name))
     else:
-        if "matches" in query:
-            predicate: Predicate = Converter.from_dict_to_predicate(query["matches"])
-        else:
-            raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
-                                   "invalid predicate")
-        logger.info("query {} collection by {} ".format(collection_name, predicate))
-        collection_metadata = CollectionService.get_collection(collection_name)
-        if collection_metadata is None:
+        collection_metadata, predicate = __get_collection_and_predicate(collection_name, query)
+        ## the rows are sorted by DynamoDB, so an order_by needs an index whose data is in that order
+        order_by = query.get("order_by")
+        ## the direction is uppercase, as in the query schema
+        direction = query.get("direction", "DESC")
+        if direction not in ["ASC", "DESC"]:
             raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
-                                   "{} is not a valid collection".format(collection_name))
-        domain_service = DomainService(collection_metadata)
-        ## TODO - missing order unique in the query
-        query_id = "__".join(predicate.get_fields())
-        index_matching_conditions = IndexService.get_index_matching_fields(predicate.get_fields(), collection_name,
-                                                                           None)
-        logger.info("Found index matching {}".format(index_matching_conditions.conditions))
-        if index_matching_conditions is None:
-            raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST, "no index {} found".format(query_id))
-        ## Since the sk should be built using the index it is necessary to pass the index matching the conditions
-        result = QueryService.query(collection_metadata, predicate, index_matching_conditions, start_from, limit)
+                                   "invalid direction {}".format(query["direction"]))
+        query_plans, intersection_plans = __get_query_plans(collection_name, predicate, order_by)
+        try:
+            if intersection_plans:
+                result = QueryService.query_intersection(collection_metadata, intersection_plans, start_from, limit,
+                                                         direction == "ASC")
+            elif len(query_plans) == 1:
+                query_plan = query_plans[0]
+                ## Since the sk should be built using the index it is necessary to pass the index matching the
+                ## conditions
+                result = QueryService.query(collection_metadata, query_plan.predicate, query_plan.index, start_from,
+                                            limit, query_plan.residual, direction == "ASC")
+            else:
+                result = QueryService.query_union(collection_metadata, query_plans, start_from, limit,
+                                                  direction == "ASC")
+        except InvalidCursorException as e:
+            raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST, str(e))
         documents = list(map(lambda m: m.document, result.data))
         last_evaluated_key = result.lastEvaluatedKey
     return documents, last_evaluated_key
 
+
+def count(collection_name: str, query: dict) -> int:
+    ## counts the documents matching the query without reading them, when DynamoDB can count them
+    if is_system(Collection(collection_name, None)):
+        raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                               "{} can't be counted".format(collection_name))
+    collection_metadata, predicate = __get_collection_and_predicate(collection_name, query)
+    query_plans, intersection_plans = __get_query_plans(collection_name, predicate)
+    if intersection_plans:
+        return QueryService.count_intersection(collection_metadata, intersection_plans)
+    elif len(query_plans) == 1:
+        return QueryService.count(collection_metadata, query_plans[0].predicate, query_plans[0].index,
+                                  query_plans[0].residual)
+    return QueryService.count_union(collection_metadata, query_plans)
+
+
+def __get_collection_and_predicate(collection_name: str, query: dict):
+    if "matches" in query:
+        predicate: Predicate = Converter.from_dict_to_predicate(query["matches"])
+    else:
+        raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                               "invalid predicate")
+    logger.info("query {} collection by {} ".format(collection_name, predicate))
+    collection_metadata = CollectionService.get_collection(collection_name)
+    if collection_metadata is None:
+        raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                               "{} is not a valid collection".format(collection_name))
+    return collection_metadata, predicate
+
+
+def __get_query_plans(collection_name: str, predicate: Predicate, order_by: str = None):
+    ## a plan for every branch of the predicate, or the indexes to intersect when no index covers all the conditions
+    branches = expand_disjunctions(predicate)
+    if len(branches) > query_max_branches:
+        raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST,
+                               "too many alternatives in the query ({} > {})".format(len(branches),
+                                                                                     query_max_branches))
+    query_plans = []
+    for branch in branches:
+        query_id = "__".join(branch.get_fields()) + ("__ORDER_BY__" + order_by if order_by else "")
+        query_plan = IndexService.get_query_plan(branch, collection_name, order_by)
+        if query_plan is None:
+            raise HandlerException(HandlerExceptionErrorCodes.BAD_REQUEST, "no index {} found".format(query_id))
+        logger.info("Found index matching {}".format(query_plan.explanation))
+        query_plans.append(query_plan)
+    ## without a composite index for all the conditions, the indexes of the single conditions are intersected
+    intersection_plans = IndexService.get_intersection_plans(branches[0], collection_name) \
+        if len(query_plans) == 1 and query_plans[0].residual is not None and not order_by else None
+    return query_plans, intersection_plans
+
+
 @delete_document
 def delete(collection_name: str, id: str):
     is_system_collection = is_system(Collection(collection_name, None))
@@ -265,6 +341,9 @@ def delete(collection_name: str, id: str):
         if collection_name == 'collection':
             CollectionService.delete_collection(id)
         elif collection_name == 'index':
+            if IndexService.is_locked(id):
+                raise HandlerException(HandlerExceptionErrorCodes.FORBIDDEN,
+                                       "index {} is used by an aggregation".format(id))
             index_metadata = IndexService.delete_index(id)
         elif collection_name == 'client_authorization':
             AuthorizationService.delete_authorization(id)
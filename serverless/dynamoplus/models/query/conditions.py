@@ -1,7 +1,8 @@
 from typing import *
 import abc
+import decimal
 
-from dynamoplus.utils.utils import auto_str, get_values_by_key_recursive
+from dynamoplus.utils.utils import auto_str, convert_to_string
 
 
 @auto_str
@@ -121,6 +122,76 @@ class And(Predicate):
         return super().__eq__(o)
 
 
+@auto_str
+class Or(Predicate):
+
+    def __init__(self, conditions: List[Predicate]):
+        self.conditions = conditions
+
+    def to_string(self):
+        return "or({})".format("__".join(map(lambda c: c.to_string(), self.conditions)))
+
+    def is_range(self):
+        return False
+
+    def get_fields(self):
+        fields = []
+        for c in self.conditions:
+            fields.extend(c.get_fields())
+        return fields
+
+    def get_values(self):
+        values = []
+        for c in self.conditions:
+            values.extend(c.get_values())
+        return values
+
+    def __eq__(self, o: object) -> bool:
+        if isinstance(o, Or):
+            return self.conditions.__eq__(o.conditions)
+        return super().__eq__(o)
+
+
+@auto_str
+class In(Predicate):
+
+    def __init__(self, field_name: str, values: List[str] = None):
+        self.field_name = field_name
+        self.values = values
+
+    def to_string(self):
+        return "in({})".format(self.field_name)
+
+    def get_fields(self):
+        return [self.field_name]
+
+    def get_values(self):
+        return self.values
+
+    def __eq__(self, o: object) -> bool:
+        if isinstance(o, In):
+            return self.field_name == o.field_name and self.values == o.values
+        return super().__eq__(o)
+
+
+def expand_disjunctions(predicate: Predicate) -> List[Predicate]:
+    """
+    rewrites the predicate as a list of predicates without Or and In (one query each) whose union matches the
+    same documents, e.g. and(eq(a), in(b, [1, 2])) becomes [and(eq(a), eq(b, 1)), and(eq(a), eq(b, 2))]
+    """
+    if isinstance(predicate, Or):
+        return [d for c in predicate.conditions for d in expand_disjunctions(c)]
+    elif isinstance(predicate, In):
+        return [Eq(predicate.field_name, v) for v in predicate.values]
+    elif isinstance(predicate, And):
+        disjuncts = [[]]
+        for c in predicate.conditions:
+            disjuncts = [d + (e.conditions if isinstance(e, And) else [e])
+                         for d in disjuncts for e in expand_disjunctions(c)]
+        return [And(d) if len(d) > 1 else d[0] for d in disjuncts]
+    return [predicate]
+
+
 def is_valid(field_match: FieldMatch):
     results = __get_range_conditions(field_match)
     return results is None or len(results) <= 1
@@ -159,20 +230,108 @@ def get_field_names_in_order(field_match: FieldMatch):
     return None
 
 
-def match_predicate(d:dict, predicate:Predicate):
+def match_predicate(d: dict, predicate: Predicate):
+    ## compiles the predicate at every call, use compile_predicate to evaluate the same predicate many times
+    return compile_predicate(predicate)(d)
+
 
-    ## if and call recursively on all conditions
-    ## if eq get the value from the field_name and compare with the field_value
-    ## if range get the value from the field and compare with value1 and value2
+def compile_predicate(predicate: Predicate, inclusive_ranges: bool = True) -> Callable[[dict], bool]:
+    """
+    compiles the predicate into a function matching a document, the field paths are split and the values of the
+    predicate converted once.
+
+    Numbers are compared as numbers when the value of the predicate is a number too (e.g. 10 matches "10.0"),
+    everything else as strings, booleans are "true" and "false". A missing field doesn't match. The ranges include
+    their bounds, like the queries on the indexes, unless `inclusive_ranges` is False: the filters of the
+    aggregations have always excluded them.
+    """
     if isinstance(predicate, Eq):
-        value = get_values_by_key_recursive(d,[predicate.field_name],True)
-        if value and len(value)>0:
-            return value[0].__eq__(predicate.value)
+        get_value = __compile_accessor(predicate.field_name)
+        expected = __to_operand(predicate.value)
+        return lambda d: __compare(get_value(d), expected) == 0
     elif isinstance(predicate, Range):
-        value = get_values_by_key_recursive(d, [predicate.field_name], True)
-        if value and len(value) > 0:
-            return predicate.from_value < value[0] < predicate.to_value
+        get_value = __compile_accessor(predicate.field_name)
+        from_value = __to_operand(predicate.from_value)
+        to_value = __to_operand(predicate.to_value)
+
+        def match_range(d: dict):
+            value = get_value(d)
+            if value is None:
+                return False
+            if inclusive_ranges:
+                return __compare(value, from_value) >= 0 and __compare(value, to_value) <= 0
+            return __compare(value, from_value) > 0 and __compare(value, to_value) < 0
+
+        return match_range
+    elif isinstance(predicate, In):
+        get_value = __compile_accessor(predicate.field_name)
+        operands = list(map(__to_operand, predicate.values))
+        strings = set(map(lambda o: o[0], operands))
+        numbers = set(map(lambda o: o[1], filter(lambda o: o[1] is not None, operands)))
+
+        def match_in(d: dict):
+            value = get_value(d)
+            if isinstance(value, decimal.Decimal):
+                return value in numbers or str(value) in strings
+            return value is not None and value in strings
+
+        return match_in
     elif isinstance(predicate, And):
-        return all(map(lambda p: match_predicate(d,p), predicate.conditions))
-
-    return False
\ No newline at end of file
+        matchers = list(map(lambda c: compile_predicate(c, inclusive_ranges), predicate.conditions))
+        return lambda d: all(m(d) for m in matchers)
+    elif isinstance(predicate, Or):
+        matchers = list(map(lambda c: compile_predicate(c, inclusive_ranges), predicate.conditions))
+        return lambda d: any(m(d) for m in matchers)
+    elif isinstance(predicate, AnyMatch):
+        return lambda d: True
+    return lambda d: False
+
+
+def __compile_accessor(field_name: str) -> Callable[[dict], Any]:
+    ## the value of the (nested) field as number or string, None if missing or not comparable (e.g. a list)
+    keys = field_name.split(".")
+
+    def get_value(d: dict):
+        value = d
+        for k in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(k)
+        return __to_comparable(value)
+
+    return get_value
+
+
+def __to_comparable(value):
+    if value is None or isinstance(value, (dict, list, set)):
+        return None
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (int, float, decimal.Decimal)):
+        number = decimal.Decimal(str(value)) if isinstance(value, float) else decimal.Decimal(value)
+        return number if number.is_finite() else str(value)
+    return str(convert_to_string(value))
+
+
+def __to_operand(value) -> Tuple[str, Optional[decimal.Decimal]]:
+    ## a value of the predicate as string and, if it's a number, as number
+    comparable = __to_comparable(value)
+    if isinstance(comparable, decimal.Decimal):
+        return str(value), comparable
+    try:
+        number = decimal.Decimal(comparable)
+    except (decimal.InvalidOperation, TypeError):
+        return comparable, None
+    return comparable, number if number.is_finite() else None
+
+
+def __compare(value, operand: Tuple[str, Optional[decimal.Decimal]]) -> Optional[int]:
+    ## None if the value is missing
+    if value is None:
+        return None
+    string, number = operand
+    if isinstance(value, decimal.Decimal):
+        if number is not None:
+            return (value > number) - (value < number)
+        value = str(value)
+    return (value > string) - (value < string)
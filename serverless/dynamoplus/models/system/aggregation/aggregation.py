@@ -2,7 +2,7 @@ from typing import *
 
 from enum import Enum
 
-from dynamoplus.models.query.conditions import Predicate
+from dynamoplus.models.query.conditions import Predicate, compile_predicate
 from dynamoplus.utils.utils import auto_str
 
 
@@ -13,13 +13,20 @@ class AggregationType(str, Enum):
     #AVG_JOIN = "AVG_JOIN"
     SUM = "SUM"
     #SUM_COUNT = "SUM_COUNT"
-    #MIN = "MIN"
-    #MAX = "MAX"
+    MIN = "MIN"
+    MAX = "MAX"
 
     @classmethod
     def types(cls):
         return [t for t, v in cls.__members__.items()]
 
+    def is_extreme(self) -> bool:
+        ## MIN and MAX keep a single value of the target field, read from an index when it's removed
+        return self in [AggregationType.MIN, AggregationType.MAX]
+
+    def is_better(self, value, current) -> bool:
+        return value > current if self == AggregationType.MAX else value < current
+
     @staticmethod
     def value_of(value) -> Enum:
         for m, mm in AggregationType.__members__.items():
@@ -68,9 +75,11 @@ class AggregationJoin(object):
 
 @auto_str
 class Aggregation(object):
-    def __init__(self, name: str, configuration_name: str):
+    def __init__(self, name: str, configuration_name: str, group: str = None):
         self.name = name
         self.configuration_name = configuration_name
+        ## the value of the group_by field of the configuration, None for the aggregations without groups
+        self.group = group
 
     def __members(self):
         return self.name, self.configuration_name
@@ -159,35 +168,102 @@ class AggregationAvg(Aggregation):
         return hash(self.__members())
 
 
+@auto_str
+class AggregationMin(Aggregation):
+    min: float
+
+    def __init__(self, name: str, configuration_name: str, min: float):
+        super().__init__(name, configuration_name)
+        self.min = min
+
+    def __members(self):
+        return self.name, self.configuration_name, self.min
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__members() == other.__members()
+        else:
+            return False
+
+    def __str__(self):
+        return "{" + ",".join(map(lambda x: x.__str__(), self.__members())) + "}"
+
+    def __hash__(self):
+        return hash(self.__members())
+
+
+@auto_str
+class AggregationMax(Aggregation):
+    max: float
+
+    def __init__(self, name: str, configuration_name: str, max: float):
+        super().__init__(name, configuration_name)
+        self.max = max
+
+    def __members(self):
+        return self.name, self.configuration_name, self.max
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__members() == other.__members()
+        else:
+            return False
+
+    def __str__(self):
+        return "{" + ",".join(map(lambda x: x.__str__(), self.__members())) + "}"
+
+    def __hash__(self):
+        return hash(self.__members())
+
+
 @auto_str
 class AggregationConfiguration(object):
 
     def __init__(self, collection_name: str, type: AggregationType, on: List[AggregationTrigger], target_field: str,
-                 matches: Predicate, join: AggregationJoin):
+                 matches: Predicate, join: AggregationJoin, shards: int = None, group_by: str = None):
         self.collection_name = collection_name
         self.type = type
         self.on = on
         self.target_field = target_field
         self.matches = matches
         self.join = join
-        self.name = AggregationConfiguration.get_name(collection_name, type, target_field, matches, join)
+        ## the increments are spread across `shards` items to avoid a hot item on collections with many writes
+        self.shards = shards
+        ## one aggregation for every value of the field instead of a single one
+        self.group_by = group_by
+        self.name = AggregationConfiguration.get_name(collection_name, type, target_field, matches, join, group_by)
+        self.__matcher = None
+
+    @property
+    def matcher(self) -> Callable[[dict], bool]:
+        ## `matches` compiled once, the configurations are cached and evaluated on every stream record. Its ranges
+        ## exclude the bounds, as they always have, so that the existing aggregations keep counting the same records
+        if self.__matcher is None:
+            self.__matcher = compile_predicate(self.matches, inclusive_ranges=False) if self.matches \
+                else lambda d: True
+        return self.__matcher
 
     @staticmethod
     def get_name(collection_name: str, type: AggregationType, target_field: str,
-                 matches: Predicate, join: AggregationJoin):
+                 matches: Predicate, join: AggregationJoin, group_by: str = None):
         matches_part = ""
         join_part = ""
         target_part = ""
+        group_by_part = ""
         if target_field:
             target_part = "_{}".format(target_field)
         if matches:
             matches_part = "_{}".format("_".join(matches.get_fields() + matches.get_values()))
         if join:
             join_part = "by_{}".format(join.collection_name)
-        return "{}{}_{}{}{}".format(collection_name, matches_part, type.name.lower(), target_part, join_part)
+        if group_by:
+            group_by_part = "_group_by_{}".format(group_by)
+        return "{}{}_{}{}{}{}".format(collection_name, matches_part, type.name.lower(), target_part, join_part,
+                                      group_by_part)
 
     def __members(self):
-        return self.collection_name, self.type, self.on, self.target_field, self.matches, self.join, self.name
+        return self.collection_name, self.type, self.on, self.target_field, self.matches, self.join, self.name, self.shards, \
+               self.group_by
 
     def __eq__(self, other):
         if type(other) is type(self):
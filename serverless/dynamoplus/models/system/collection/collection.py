@@ -38,16 +38,16 @@ class AttributeDefinition(object):
 class Collection(object):
     def __init__(self, name: str, id_key: str, ordering_key: str = None,
                  attributes_definition: List[AttributeDefinition] = None,
-                 auto_generate_id = False):
+                 auto_generate_id = False, shards: int = None):
         self.name = name
         self.id_key = id_key
         self.attribute_definition = attributes_definition
         self.ordering_key = ordering_key
         self.auto_generate_id = auto_generate_id
-
+        self.shards = shards
 
     def __members(self):
-        return self.name, self.id_key, self.attribute_definition, self.ordering_key, self.auto_generate_id
+        return self.name, self.id_key, self.attribute_definition, self.ordering_key, self.auto_generate_id, self.shards
 
     def __eq__(self, other):
         if type(other) is type(self):
@@ -18,7 +18,8 @@ class IndexConfiguration(Enum):
 @auto_str
 class Index(object):
     def __init__(self, collection_name: str, conditions: List[str],
-                 index_configuration: IndexConfiguration = IndexConfiguration.OPTIMIZE_READ, ordering_key: str = None):
+                 index_configuration: IndexConfiguration = IndexConfiguration.OPTIMIZE_READ, ordering_key: str = None,
+                 shards: int = None, locked: bool = False):
         self._collection_name = collection_name
         self._conditions = conditions
         conditions_set = set(self._conditions)
@@ -29,6 +30,9 @@ class Index(object):
         self._ordering_key = ordering_key
         self._index_name = Index.index_name_generator(self.collection_name, self._conditions, self._ordering_key)
         self._index_configuration = index_configuration
+        self._shards = shards
+        ## a locked index is needed by the system (e.g. by a MIN or MAX aggregation) and can't be deleted
+        self._locked = locked
 
     @property
     def range_condition(self):
@@ -79,11 +83,28 @@ class Index(object):
     def index_configuration(self, value: IndexConfiguration):
         self._index_configuration = value
 
+    @property
+    def shards(self):
+        return self._shards
+
+    @shards.setter
+    def shards(self, value: int):
+        self._shards = value
+
+    @property
+    def locked(self):
+        return self._locked
+
+    @locked.setter
+    def locked(self, value: bool):
+        self._locked = value
+
     def __eq__(self, o: object) -> bool:
         if isinstance(o, Index):
             return self._collection_name.__eq__(o.collection_name) \
                    and self._conditions.__eq__(o.conditions) \
                    and self._ordering_key.__eq__(o.ordering_key) \
                    and self._index_name.__eq__(o._index_name) \
-                   and self._index_configuration.__eq__(o.index_configuration)
+                   and self._index_configuration.__eq__(o.index_configuration) \
+                   and self._shards == o.shards
         return super().__eq__(o)
@@ -1,10 +1,14 @@
 import fastjsonschema
+import hashlib
+import json
 import logging
+import os
 from fastjsonschema import JsonSchemaDefinitionException, JsonSchemaException
 
 from dynamoplus.models.system.aggregation.aggregation import AggregationType, AggregationTrigger
 from dynamoplus.models.system.collection.collection import Collection, AttributeConstraint, AttributeType, \
     AttributeDefinition
+from dynamoplus.utils.cache import TTLCache
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -31,6 +35,7 @@ COLLECTION_SCHEMA_DEFINITION = {
         "name": {"type": "string"},
         "ordering": {"type": "string"},
         "auto_generate_id": {"type": "boolean"},
+        "shards": {"type": "integer", "minimum": 1},
         "attributes": {
             "type": "array",
             "items": COLLECTION_ATTRIBUTE_SCHEMA_DEFINITION
@@ -58,16 +63,38 @@ PREDICATE_SCHEMA_DEFINITION = {
         "value"
     ]
 }
+IN_PREDICATE_SCHEMA_DEFINITION = {
+    "properties": {
+        "field_name": {"type": "string"},
+        "values": {"type": "array", "items": {"type": "string"}, "minItems": 1}
+    },
+    "required": [
+        "field_name",
+        "values"
+    ]
+}
 MATCHES_SCHEMA_DEFINITION = {
     "properties": {
         "eq": PREDICATE_SCHEMA_DEFINITION,
+        "in": IN_PREDICATE_SCHEMA_DEFINITION,
         "and": {
             "type": "array",
             "items": {
                 "properties": {
-                    "eq": PREDICATE_SCHEMA_DEFINITION
+                    "eq": PREDICATE_SCHEMA_DEFINITION,
+                    "in": IN_PREDICATE_SCHEMA_DEFINITION
+                },
+                "anyOf": [{"required": ["eq"]}, {"required": ["in"]}]
+            }
+        },
+        "or": {
+            "type": "array",
+            "items": {
+                "properties": {
+                    "eq": PREDICATE_SCHEMA_DEFINITION,
+                    "in": IN_PREDICATE_SCHEMA_DEFINITION
                 },
-                "required": ["eq"]
+                "anyOf": [{"required": ["eq"]}, {"required": ["in"]}]
             }
         }
     }
@@ -82,7 +109,9 @@ AGGREGATION_SCHEMA_DEFINITION = {
             "properties": {
                 "on": {"type": "array", "items":{"type": "string", "enum": AggregationTrigger.types()}},
                 "target_field": {"type": "string"},
-                "matches": MATCHES_SCHEMA_DEFINITION
+                "matches": MATCHES_SCHEMA_DEFINITION,
+                "shards": {"type": "integer", "minimum": 1},
+                "group_by": {"type": "string"}
             },
             "required": ["on"]
         }
@@ -96,7 +125,8 @@ INDEX_SCHEMA_DEFINITION = {
     "properties": {
         "collection": BASE_COLLECTION_SCHEMA_DEFINITION,
         "conditions": {"type": "array", "items": {"type": "string"}},
-        "configuration": {"type": "string", "enum": ["OPTIMIZE_READ", "OPTIMIZE_WRITE"]}
+        "configuration": {"type": "string", "enum": ["OPTIMIZE_READ", "OPTIMIZE_WRITE"]},
+        "shards": {"type": "integer", "minimum": 1}
     },
     "required": [
         "collection",
@@ -137,20 +167,15 @@ CLIENT_AUTHORIZATION_API_KEY_SCHEMA_DEFINITION = {
 QUERY_SCHEMA_DEFINITION = {
     "type": "object",
     "properties": {
-        "matches": MATCHES_SCHEMA_DEFINITION
+        "matches": MATCHES_SCHEMA_DEFINITION,
+        "order_by": {"type": "string"},
+        "direction": {"type": "string", "enum": ["ASC", "DESC"], "description": "uppercase, DESC by default"},
+        "count": {"type": "boolean"}
     },
     "required": ["matches"]
 }
 
 
-def __validate(d: dict, schema: dict):
-    validator = __compile_json_schema(schema)
-    if validator:
-        validator(d)
-    else:
-        raise SyntaxError("invalid json schema")
-
-
 def __compile_json_schema(collection_schema):
     try:
         return fastjsonschema.compile(collection_schema)
@@ -159,34 +184,62 @@ def __compile_json_schema(collection_schema):
         return None
 
 
+## compiling a schema generates and executes python code, so the system schemas are compiled once at import time
+__index_validator = __compile_json_schema(INDEX_SCHEMA_DEFINITION)
+__collection_validator = __compile_json_schema(COLLECTION_SCHEMA_DEFINITION)
+__client_authorization_validator = __compile_json_schema(CLIENT_AUTHORIZATION_SCHEMA_DEFINITION)
+__client_authorization_http_signature_validator = __compile_json_schema(
+    CLIENT_AUTHORIZATION_HTTP_SIGNATURE_SCHEMA_DEFINITION)
+__client_authorization_api_key_validator = __compile_json_schema(CLIENT_AUTHORIZATION_API_KEY_SCHEMA_DEFINITION)
+__query_validator = __compile_json_schema(QUERY_SCHEMA_DEFINITION)
+__aggregation_validator = __compile_json_schema(AGGREGATION_SCHEMA_DEFINITION)
+
+## document validators are compiled once per collection definition
+document_validator_cache = TTLCache(int(os.environ.get("DOCUMENT_VALIDATOR_CACHE_MAX_SIZE", "256")),
+                                    float(os.environ.get("DOCUMENT_VALIDATOR_CACHE_TTL", "3600")))
+
+
+def __get_document_validator(document_schema: dict):
+    schema_hash = hashlib.sha1(json.dumps(document_schema, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return document_validator_cache.get_or_load(schema_hash, lambda: __compile_json_schema(document_schema))
+
+
+def __validate(d: dict, schema: dict):
+    validator = __get_document_validator(schema)
+    if validator:
+        validator(d)
+    else:
+        raise SyntaxError("invalid json schema")
+
+
 def is_collection_schema_valid(collection_schema: dict):
     return __compile_json_schema(collection_schema) is not None
 
 
 def validate_index(index: dict):
-    __validate(index, INDEX_SCHEMA_DEFINITION)
+    __index_validator(index)
 
 
 def validate_collection(collection: dict):
-    __validate(collection, COLLECTION_SCHEMA_DEFINITION)
+    __collection_validator(collection)
 
 
 def validate_client_authorization_http_signature(client_authorization: dict):
-    __validate(client_authorization, CLIENT_AUTHORIZATION_SCHEMA_DEFINITION)
-    __validate(client_authorization, CLIENT_AUTHORIZATION_HTTP_SIGNATURE_SCHEMA_DEFINITION)
+    __client_authorization_validator(client_authorization)
+    __client_authorization_http_signature_validator(client_authorization)
 
 
 def validate_client_authorization_api_key(client_authorization: dict):
-    __validate(client_authorization, CLIENT_AUTHORIZATION_SCHEMA_DEFINITION)
-    __validate(client_authorization, CLIENT_AUTHORIZATION_API_KEY_SCHEMA_DEFINITION)
+    __client_authorization_validator(client_authorization)
+    __client_authorization_api_key_validator(client_authorization)
 
 
 def validate_query(query: dict):
-    __validate(query, QUERY_SCHEMA_DEFINITION)
+    __query_validator(query)
 
 
 def validate_aggregation(aggregation: dict):
-    __validate(aggregation, AGGREGATION_SCHEMA_DEFINITION)
+    __aggregation_validator(aggregation)
 
 
 def validate_document(document: dict, collection_metadata: Collection):
@@ -223,7 +276,7 @@ def validate_client_authorization(client_authorization: dict):
         raise JsonSchemaException("type not valid")
 
 def validate_aggregation(aggregation: dict):
-    __validate(aggregation,AGGREGATION_SCHEMA_DEFINITION)
+    __aggregation_validator(aggregation)
 
 
 # def validate_document(document: dict, collection_schema: dict):
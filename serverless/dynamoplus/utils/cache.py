@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+
+class TTLCache(object):
+    """
+    bounded LRU cache whose entries expire `ttl` seconds after they have been stored
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self.__lock:
+            if key in self.__items:
+                expires_at, value = self.__items[key]
+                if expires_at > time.monotonic():
+                    self.__items.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return value
+                del self.__items[key]
+            self.misses = self.misses + 1
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self.__lock:
+            self.__items[key] = (time.monotonic() + self.ttl, value)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.max_size:
+                self.__items.popitem(last=False)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]):
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            self.__items.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {"size": len(self.__items), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,158 @@
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import *
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+## boto3 calls release the GIL while waiting for DynamoDB, so independent requests can overlap in a small pool
+max_workers = int(os.environ.get("INDEXING_MAX_WORKERS", "8"))
+
+__executor = None
+__executor_lock = threading.Lock()
+__worker = threading.local()
+
+
+def __get_executor():
+    global __executor
+    if __executor is None:
+        with __executor_lock:
+            if __executor is None:
+                __executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dynamoplus",
+                                                initializer=__init_worker)
+    return __executor
+
+
+def __init_worker():
+    __worker.active = True
+
+
+def __is_worker():
+    return getattr(__worker, "active", False)
+
+
+def run_in_parallel(tasks: List[Callable[[], Any]]) -> List[Any]:
+    """
+    runs the tasks in the shared pool and waits for all of them, the results have the same order of the tasks.
+
+    The first task runs in the calling thread while the pool executes the others. A task that fails doesn't stop
+    the others, the first error is raised once every task has completed.
+    Tasks submitted by a worker (e.g. the batch write of an aggregation executed in the pool) run in the calling
+    thread, so that a full pool can't deadlock waiting for itself.
+    """
+    if len(tasks) == 0:
+        return []
+    if max_workers <= 1 or len(tasks) == 1 or __is_worker():
+        return [t() for t in tasks]
+    futures = [__get_executor().submit(t) for t in tasks[1:]]
+    first_result = None
+    first_error = None
+    try:
+        first_result = tasks[0]()
+    except Exception as e:
+        first_error = e
+    wait(futures)
+    errors = [first_error] + [f.exception() for f in futures]
+    for e in errors:
+        if e is not None:
+            logger.error("parallel task failed {}".format(e))
+            raise e
+    return [first_result] + [f.result() for f in futures]
+
+
+def get_background_executor() -> Optional[ThreadPoolExecutor]:
+    ## None in a worker of the pool, its background tasks run in its own thread so that a full pool can't deadlock
+    if max_workers <= 1 or __is_worker():
+        return None
+    return __get_executor()
+
+
+class PrefetchingIterator(object):
+    """
+    iterates the items of a paginated source, fetching the next page in the shared pool while the consumer
+    processes the current one.
+
+    `fetch_page(cursor)` returns the items of the page starting after `cursor` (None for the first page) and the
+    cursor of the next page, None when it's the last one. At most `prefetch_depth` pages are fetched ahead of the
+    consumer, one at a time since every page starts from the cursor of the previous one. No page is fetched once the
+    consumer is closed or collected, and a consumer running in the pool fetches its pages in its own thread.
+    """
+
+    __END = object()
+
+    def __init__(self, fetch_page: Callable[[Any], Tuple[List[Any], Any]], prefetch_depth: int = 1):
+        self.__fetch_page = fetch_page
+        self.__prefetch_depth = max(prefetch_depth, 1)
+        self.__pages = collections.deque()
+        self.__condition = threading.Condition()
+        self.__cursor = None
+        self.__fetching = False
+        self.__last_fetched = False
+        self.__stopped = False
+        self.__current = iter([])
+        self.__done = False
+        self.__executor = get_background_executor()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            item = next(self.__current, PrefetchingIterator.__END)
+            if item is not PrefetchingIterator.__END:
+                return item
+            if self.__done:
+                raise StopIteration
+            with self.__condition:
+                self.__schedule()
+                while len(self.__pages) == 0 and self.__fetching:
+                    self.__condition.wait()
+            if len(self.__pages) == 0:
+                self.__fetch()
+            with self.__condition:
+                items, error = self.__pages.popleft()
+                self.__schedule()
+            if error is not None:
+                self.__done = True
+                raise error
+            if items is None:
+                self.__done = True
+                raise StopIteration
+            self.__current = iter(items)
+
+    def close(self):
+        with self.__condition:
+            self.__done = True
+            self.__stopped = True
+            self.__pages.clear()
+
+    def __del__(self):
+        self.close()
+
+    def __schedule(self):
+        ## called holding the condition, the pending fetch keeps the iterator alive until it completes
+        if self.__executor is None or self.__fetching or self.__last_fetched or self.__stopped or \
+                len(self.__pages) >= self.__prefetch_depth:
+            return
+        self.__fetching = True
+        self.__executor.submit(self.__fetch)
+
+    def __fetch(self):
+        cursor = None
+        try:
+            items, cursor = self.__fetch_page(self.__cursor)
+            pages = [(items, None)] if cursor is not None else [(items, None), (None, None)]
+        except Exception as e:
+            logger.error("unable to fetch the next page {}".format(e))
+            pages = [(None, e)]
+        with self.__condition:
+            self.__fetching = False
+            self.__cursor = cursor
+            self.__last_fetched = cursor is None
+            if not self.__stopped:
+                self.__pages.extend(pages)
+                self.__schedule()
+            self.__condition.notify_all()
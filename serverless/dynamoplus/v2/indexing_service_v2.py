@@ -1,16 +1,20 @@
 import logging
+from typing import *
 
 # from dynamoplus.models.system.aggregation.aggregation import AggregationTrigger
-from dynamoplus.models.system.aggregation.aggregation import AggregationTrigger
-from dynamoplus.models.system.index.index import IndexConfiguration
+from dynamoplus.models.system.aggregation.aggregation import AggregationTrigger, AggregationConfiguration
+from dynamoplus.models.system.index.index import IndexConfiguration, Index
 from dynamoplus.models.system.collection.collection import Collection
 from dynamoplus.v2.service.system.system_service import IndexService, CollectionService, AggregationConfigurationService
-from dynamoplus.v2.service.model_service import get_index_model
+from dynamoplus.v2.service.model_service import get_index_model, get_model
+from dynamoplus.v2.service.query_service import QueryService
+from dynamoplus.models.query.conditions import AnyMatch
 from dynamoplus.v2.service.common import is_system, get_repository_factory
+from dynamoplus.utils.executor import run_in_parallel
 from dynamoplus.utils.utils import find_added_values, find_removed_values, find_updated_values, \
     filter_out_not_included_fields
 
-from dynamoplus.v2.service.system.aggregation_service import AggregationProcessingService
+from dynamoplus.v2.service.system.aggregation_service import AggregationProcessingService, AggregationAccumulator
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -22,73 +26,200 @@ def __indexing(collection_metadata: Collection,
     is_system_collection = is_system(collection_metadata)
     if not is_system_collection:
         ## This doesn't work, if an attribute not indexed it's updated then it doesn't update it
-        to_remove_index_models = get_index_models_to_remove(collection_metadata, new_record, old_record)
-        to_add_index_models = get_index_models_to_add(collection_metadata, new_record, old_record)
-        to_update_index_models = get_index_models_to_update(collection_metadata, new_record, old_record)
+        to_write_index_models, to_remove_index_models = get_index_changes(collection_metadata, new_record, old_record)
 
         repository = get_repository_factory(collection_metadata)
-        for remove in to_remove_index_models:
-            repository.delete(remove.pk, remove.sk)
 
-        for add in to_add_index_models:
-            repository.create(add)
+        aggregations = list(
+            AggregationConfigurationService.get_aggregation_configurations_by_collection_name_generator(
+                collection_metadata.name))
+
+        ## index rows and aggregations are independent, the delete-before-put ordering of a key is kept by batch_write
+        tasks = get_aggregation_tasks(aggregations, collection_metadata, new_record, old_record)
+        if any(map(lambda a: a.type.is_extreme(), aggregations)):
+            ## MIN and MAX may read the index rows of the change
+            repository.batch_write(to_write_index_models, to_remove_index_models)
+        else:
+            tasks.append(lambda: repository.batch_write(to_write_index_models, to_remove_index_models))
+        run_in_parallel(tasks)
+
+
+def index_batch(collection_name: str, changes: List[Tuple[dict, dict]], applied: List[Set[str]] = None) -> List[int]:
+    """
+    indexes a batch of changes (new_record, old_record) of the same collection, in stream order.
+
+    The collection metadata is loaded once for the whole batch, the index rows of all the changes are written with
+    a single batch write where the last change of an index row wins, and the increments of the aggregations are
+    summed across the changes and written once per aggregation. Returns the positions of the changes that failed.
+
+    A failed change may have been added to some aggregations anyway, `applied` has the keys of the aggregations
+    already applied to every change (e.g. by a previous attempt), they are skipped and the keys applied by this
+    call are added.
+    """
+    collection_metadata = CollectionService.get_collection(collection_name)
+    if collection_metadata is None:
+        logger.debug('Skipping indexing on records of type {}:  collection not found'.format(collection_name))
+        return []
+    if is_system(collection_metadata):
+        return []
+    indexes = list(IndexService.get_indexes_from_collection_name_generator(collection_name))
+    aggregations = list(
+        AggregationConfigurationService.get_aggregation_configurations_by_collection_name_generator(collection_name))
+
+    failed = []
+    writers = []
+    index_writes = {}
+    for i, (new_record, old_record) in enumerate(changes):
+        try:
+            to_write, to_remove = get_index_changes(collection_metadata, new_record, old_record, indexes)
+        except Exception as e:
+            logger.error("unable to compute the indexes of {}: {}".format(new_record or old_record, e))
+            failed.append(i)
+            continue
+        for m in to_remove:
+            index_writes[(m.pk, m.sk)] = (m, False)
+        for m in to_write:
+            index_writes[(m.pk, m.sk)] = (m, True)
+        if to_write or to_remove:
+            writers.append(i)
+
+    def write():
+        try:
+            get_repository_factory(collection_metadata).batch_write(
+                [m for m, is_put in index_writes.values() if is_put],
+                [m for m, is_put in index_writes.values() if not is_put])
+            return []
+        except Exception as e:
+            logger.error("unable to write the indexes of {}: {}".format(collection_name, e))
+            return writers
+
+    def aggregate():
+        ## the increments of the whole batch are summed, one write per aggregation
+        accumulator = AggregationAccumulator(collection_metadata)
+        aggregation_failed = []
+        for i, (new_record, old_record) in enumerate(changes):
+            if i in failed:
+                continue
+            try:
+                trigger = get_aggregation_trigger(new_record, old_record)
+                for a in aggregations:
+                    if trigger in a.on:
+                        accumulator.add(a, new_record, old_record, i, applied[i] if applied else None)
+            except Exception as e:
+                logger.error("unable to aggregate {}: {}".format(new_record or old_record, e))
+                aggregation_failed.append(i)
+        return aggregation_failed + accumulator.flush(applied)
+
+    if any(map(lambda a: a.type.is_extreme(), aggregations)):
+        ## MIN and MAX may read the index rows written by the batch
+        write_failed = write()
+        aggregation_failed = aggregate()
+    else:
+        write_failed, aggregation_failed = run_in_parallel([write, aggregate])
+    return sorted(set(failed + write_failed + aggregation_failed))
+
+
+def reindex(collection_name: str, start_from: str = None, limit: int = 100):
+    """
+    rewrites the main rows and the index rows of a page of documents of a collection with the current encoding of
+    their data, e.g. the rows written before the typed encoding of numbers and dates. Returns the last key of the
+    page, None when all the documents have been rewritten.
+
+    The main rows are read by the data that is being rewritten: a rewritten row may be read again, but a row not
+    yet rewritten keeps its position and isn't skipped.
+    """
+    collection_metadata = CollectionService.get_collection(collection_name)
+    if collection_metadata is None or is_system(collection_metadata):
+        raise Exception("{} is not a valid collection".format(collection_name))
+    indexes = list(IndexService.get_indexes_from_collection_name_generator(collection_name))
+    result = QueryService.query(collection_metadata, AnyMatch(), None, start_from, limit)
+    to_write = []
+    for row in result.data:
+        model = get_model(collection_metadata, row.document)
+        if model.data != row.data:
+            to_write.append(model)
+        index_models, _ = get_index_changes(collection_metadata, row.document, None, indexes)
+        to_write.extend(index_models)
+    if to_write:
+        get_repository_factory(collection_metadata).batch_write(to_write, [])
+    logger.info("{} rows of {} documents of {} rewritten".format(len(to_write), len(result.data), collection_name))
+    return result.lastEvaluatedKey
+
+
+def get_index_changes(collection_metadata: Collection, new_record: dict, old_record: dict,
+                      indexes: List[Index] = None):
+    """
+    returns the index rows to write and the index rows to delete for a change of a record
+    """
+    to_remove_index_models = get_index_models_to_remove(collection_metadata, new_record, old_record, indexes)
+    to_add_index_models = get_index_models_to_add(collection_metadata, new_record, old_record, indexes)
+    to_update_index_models = get_index_models_to_update(collection_metadata, new_record, old_record, indexes)
+    return to_add_index_models + to_update_index_models, to_remove_index_models
+
+
+def get_aggregation_trigger(new_record: dict, old_record: dict):
+    if old_record is None:
+        return AggregationTrigger.INSERT
+    elif new_record is None:
+        return AggregationTrigger.DELETE
+    return AggregationTrigger.UPDATE
 
-        for update in to_update_index_models:
-            repository.update(update)
 
-        aggregations = AggregationConfigurationService.get_aggregation_configurations_by_collection_name_generator(
-            collection_metadata.name)
-        trigger = AggregationTrigger.UPDATE
-        if old_record is None:
-            trigger = AggregationTrigger.INSERT
-        elif new_record is None:
-            trigger = AggregationTrigger.DELETE
-        for a in aggregations:
-            if trigger in a.on:
-                AggregationProcessingService.execute_aggregation(a, collection_metadata, new_record, old_record)
+def get_aggregation_tasks(aggregations: Iterable[AggregationConfiguration], collection_metadata: Collection,
+                          new_record: dict, old_record: dict):
+    trigger = get_aggregation_trigger(new_record, old_record)
+    return [lambda a=a: AggregationProcessingService.execute_aggregation(a, collection_metadata, new_record,
+                                                                          old_record)
+            for a in aggregations if trigger in a.on]
 
 
-def get_index_models_to_remove(collection_metadata, new_record: dict, old_record: dict):
+def get_index_models_to_remove(collection_metadata, new_record: dict, old_record: dict, indexes: List[Index] = None):
     to_remove = []
     if old_record is not None and len(old_record.keys()) > 0:
         removed = find_removed_values(old_record, new_record)
         # changed_fields = get_all_keys(removed)
-        to_remove = find_matching_indexes(removed, collection_metadata, old_record) if removed else []
+        to_remove = find_matching_indexes(removed, collection_metadata, old_record, indexes) if removed else []
     return to_remove
 
 
-def get_index_models_to_add(collection_metadata, new_record, old_record):
+def get_index_models_to_add(collection_metadata, new_record, old_record, indexes: List[Index] = None):
     to_add = []
     if new_record is not None:
         added = find_added_values(old_record, new_record)
-        to_add = find_matching_indexes(added, collection_metadata, new_record) if added else []
+        to_add = find_matching_indexes(added, collection_metadata, new_record, indexes) if added else []
     return to_add
 
 
-def get_index_models_to_update(collection_metadata, new_record, old_record):
+def get_index_models_to_update(collection_metadata, new_record, old_record, indexes: List[Index] = None):
     to_update = []
     if old_record is not None and new_record is not None:
         logger.debug("updated index new record = {} and old record = {}".format(new_record,old_record))
         updated = find_updated_values(old_record, new_record)
-        to_update = find_matching_indexes(updated, collection_metadata, new_record) if updated else []
+        to_update = find_matching_indexes(updated, collection_metadata, new_record, indexes) if updated else []
     return to_update
 
 
 def find_matching_indexes(values: dict,
                           collection_metadata: Collection,
-                          record: dict):
+                          record: dict,
+                          indexes: List[Index] = None):
     result = []
     if values:
         logger.debug("changed dict = {} while new record is {} ".format(values,record))
         changed_fields = get_all_keys(values)
         logger.debug("changed fields = {}".format(changed_fields))
-        for index in IndexService.get_indexes_from_collection_name_generator(collection_metadata.name):
+        if indexes is None:
+            indexes = IndexService.get_indexes_from_collection_name_generator(collection_metadata.name)
+        for index in indexes:
             for field in changed_fields:
                 if field in index.conditions or index.index_configuration == IndexConfiguration.OPTIMIZE_READ or field == index.ordering_key:
                     document = record if index and (
                             index.index_configuration is None or index.index_configuration == IndexConfiguration.OPTIMIZE_READ) \
                         else filter_out_not_included_fields(record, index.conditions + [collection_metadata.id_key])
                     index_model = get_index_model(collection_metadata, index, document)
+                    ## without the indexed fields there is no data, the key of the GSI can't be null
+                    if index_model.data is None:
+                        continue
                     if index_model not in result:
                         result.append(index_model)
     return result
@@ -1,32 +1,101 @@
 import abc
+import heapq
 import json
 import logging
 import os
+import threading
+import time
+import zlib
+from itertools import islice, takewhile
 from _decimal import Decimal
 from typing import *
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+from dynamoplus.utils.executor import run_in_parallel
 from dynamoplus.utils.utils import sanitize
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logging.getLogger("botocore").setLevel(logging.WARNING)
 logging.getLogger("boto3").setLevel(logging.DEBUG)
-connection = None
+
+
+def get_client_config() -> Config:
+    config = {
+        "max_pool_connections": int(os.environ.get("DYNAMODB_MAX_POOL_CONNECTIONS", "50")),
+        "connect_timeout": int(os.environ.get("DYNAMODB_CONNECT_TIMEOUT", "5")),
+        "read_timeout": int(os.environ.get("DYNAMODB_READ_TIMEOUT", "10")),
+        "retries": {
+            "max_attempts": int(os.environ.get("DYNAMODB_MAX_ATTEMPTS", "5")),
+            "mode": os.environ.get("DYNAMODB_RETRY_MODE", "standard")
+        }
+    }
+    if os.environ.get("DYNAMODB_TCP_KEEPALIVE", "true") == "true":
+        config["tcp_keepalive"] = True
+    try:
+        return Config(**config)
+    except TypeError:
+        ## tcp_keepalive is available from botocore 1.27
+        logger.info("tcp keepalive not supported by botocore")
+        del config["tcp_keepalive"]
+        return Config(**config)
+
+
+endpoint_url = None
 try:
     if os.environ["STAGE"] and "local" == os.environ["STAGE"]:
         host = os.environ["DYNAMODB_HOST"]
         port = os.environ["DYNAMODB_PORT"]
         logging.info("using dynamolocal")
         endpoint_url = "{}:{}/".format(host, port) if host else "http://localhost:8000/"
-        connection = boto3.resource('dynamodb', endpoint_url=endpoint_url)
-    elif not os.environ["TEST_FLAG"]:
-        connection = boto3.resource('dynamodb')
 except:
     logger.info("Unable to instantiate")
 
+## boto3 sessions and resources are not thread safe: every thread gets its own resource and table handles.
+## The threads of the pool are long lived, so the handles are still reused across warm invocations
+__local = threading.local()
+__generation = 0
+
+
+def __get_thread_state():
+    if getattr(__local, "generation", None) != __generation:
+        __local.generation = __generation
+        __local.connection = None
+        __local.tables = {}
+    return __local
+
+
+def get_connection():
+    state = __get_thread_state()
+    if state.connection is None:
+        state.connection = boto3.session.Session().resource('dynamodb', endpoint_url=endpoint_url,
+                                                            config=get_client_config())
+    return state.connection
+
+
+def get_table(table_name: str):
+    tables = __get_thread_state().tables
+    table = tables.get(table_name)
+    if table is None:
+        table = tables[table_name] = get_connection().Table(table_name)
+    return table
+
+
+def clear_tables():
+    ## the handles of the other threads are dropped the next time they are used
+    global __generation
+    __generation += 1
+
+
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_GET_MAX_KEYS = 100
+BATCH_MAX_RETRIES = 5
+BATCH_RETRY_BASE_DELAY = 0.05
+
 
 class Counter:
     def __init__(self,field_name:str, count:Decimal, is_increment:bool = True):
@@ -119,6 +188,74 @@ class Model:
         }
 
 
+## the rows of a sharded index (or of the main rows of a sharded collection) are spread across `shards` GSI
+## partitions, the shard of a row depends only on its partition key
+SHARD_SEPARATOR = "@"
+
+
+def get_shard(pk: str, shards: int) -> int:
+    return zlib.crc32(pk.encode("utf-8")) % shards
+
+
+def get_shard_sk(sk: str, shard: int) -> str:
+    return "{}{}{}".format(sk, SHARD_SEPARATOR, shard)
+
+
+def get_unsharded_sk(sk: str) -> str:
+    return sk.split(SHARD_SEPARATOR, 1)[0]
+
+
+def get_shard_of_sk(sk: str) -> int:
+    return int(sk.rsplit(SHARD_SEPARATOR, 1)[1])
+
+
+class ShardedKey(object):
+    """
+    the last evaluated key of a query across shards: for each shard the key of the last row returned (None when
+    the shard hasn't been read yet), `done` are the shards with no more rows
+    """
+
+    def __init__(self, sk: str, keys: List[Optional[Model]], done: List[int] = None):
+        self.sk = sk
+        self.keys = keys
+        self.done = done or []
+
+    def __members(self):
+        return self.sk, self.keys, self.done
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__members() == other.__members()
+        else:
+            return False
+
+    def __str__(self):
+        return "{" + ",".join(map(lambda x: x.__str__(), self.__members())) + "}"
+
+
+class CompositeKey(object):
+    """
+    the last evaluated key of the queries of an Or (one per branch): the last key of each branch (a document id
+    when the branch hasn't returned any row yet), `done` are the branches with no more rows
+    """
+
+    def __init__(self, keys: List[Union[Model, ShardedKey, str, None]], done: List[int] = None):
+        self.keys = keys
+        self.done = done or []
+
+    def __members(self):
+        return self.keys, self.done
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.__members() == other.__members()
+        else:
+            return False
+
+    def __str__(self):
+        return "{" + ",".join(map(lambda x: x.__str__(), self.__members())) + "}"
+
+
 class QueryResult(object):
     def __init__(self, data: List["Model"], last_evaluated_key: dict = None):
         self.data = data
@@ -157,13 +294,23 @@ class RepositoryInterface(abc.ABC):
     def delete(self, partition_key: str, sort_key: str):
         pass
 
+    @abc.abstractmethod
+    def batch_write(self, puts: List[Model] = None, deletes: List[Model] = None):
+        pass
+
+    @abc.abstractmethod
+    def batch_get(self, keys: List[Tuple[str, str]]):
+        pass
+
 
 class Repository(RepositoryInterface):
 
     def __init__(self, table_name: str) -> None:
         self.tableName = table_name
-        self.dynamoDB = connection if connection is not None else boto3.resource('dynamodb')
-        self.table = self.dynamoDB.Table(self.tableName)
+
+    @property
+    def table(self):
+        return get_table(self.tableName)
 
     def create(self, model: Model):
         dynamoDbItem = model.to_dynamo_db_item()
@@ -208,6 +355,117 @@ class Repository(RepositoryInterface):
             return False
 
 
+    def add_counters(self, partition_key: str, sort_key: str, counters: Dict[str, Decimal]):
+        ## ADD creates the top level attributes when they don't exist yet
+        expression_attribute_names = {"#c{}".format(i): k for i, k in enumerate(counters.keys())}
+        expression_attribute_values = {":c{}".format(i): v for i, v in enumerate(counters.values())}
+        update_expression = "ADD {}".format(", ".join("#c{} :c{}".format(i, i) for i in range(len(counters))))
+        response = self.table.update_item(
+            Key={
+                'pk': partition_key,
+                'sk': sort_key
+            },
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=expression_attribute_names,
+            ExpressionAttributeValues=expression_attribute_values
+        )
+        logger.info("Response from add counters operation is " + response.__str__())
+
+    def add_to_document(self, model: Model, increments: Dict[str, Decimal]) -> Tuple[Model, bool]:
+        """
+        adds the increments to the numeric fields of the document with a single UpdateItem, a missing field starts
+        from 0. When the item doesn't exist it's created from `model` with the increments as values.
+
+        Returns the updated model and whether it has been created. ADD works only on top level attributes, so the
+        fields of the document are updated by SET with if_not_exists, the item must exist for the document path.
+        """
+        expression_attribute_names = {"#c{}".format(i): k for i, k in enumerate(increments.keys())}
+        expression_attribute_values = {":c{}".format(i): v for i, v in enumerate(increments.values())}
+        expression_attribute_values[":zero"] = Decimal(0)
+        update_expression = "SET {}".format(", ".join(
+            "document.#c{0} = if_not_exists(document.#c{0}, :zero) + :c{0}".format(i) for i in range(len(increments))))
+        for attempt in range(2):
+            try:
+                response = self.table.update_item(
+                    Key={
+                        'pk': model.pk,
+                        'sk': model.sk
+                    },
+                    UpdateExpression=update_expression,
+                    ConditionExpression="attribute_exists(pk)",
+                    ExpressionAttributeNames=expression_attribute_names,
+                    ExpressionAttributeValues=expression_attribute_values,
+                    ReturnValues="ALL_NEW"
+                )
+                logger.info("Response from add to document operation is " + response.__str__())
+                return Model.from_dynamo_db_item(response["Attributes"]), False
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException" or attempt > 0:
+                    raise e
+            created = Model(model.pk, model.sk, model.data, {**(model.document or {}), **increments})
+            try:
+                self.table.put_item(Item=sanitize(created.to_dynamo_db_item()),
+                                    ConditionExpression="attribute_not_exists(pk)")
+                return created, True
+            except ClientError as e:
+                ## created in the meantime by a concurrent update, the increments are added to it
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise e
+
+    def set_in_document(self, model: Model, field_name: str, value: Any, replaces: str = None,
+                        replaces_one_of: List[Any] = None) -> bool:
+        """
+        sets a field of the document of an existing item, a None value removes it. With `replaces` ("<" or ">") the
+        field is set only if it's missing or its value is `replaces` the new one (e.g. "<" for a new maximum), with
+        `replaces_one_of` only if it's missing or one of those values.
+
+        Returns False when the condition doesn't hold.
+        """
+        condition_expression = "attribute_exists(pk)"
+        expression_attribute_values = {}
+        if value is None:
+            update_expression = "REMOVE document.#f"
+        else:
+            update_expression = "SET document.#f = :v"
+            expression_attribute_values[":v"] = value
+            if replaces:
+                condition_expression += " AND (attribute_not_exists(document.#f) OR document.#f {} :v)".format(
+                    replaces)
+        if replaces_one_of:
+            names = []
+            for i, v in enumerate(replaces_one_of):
+                names.append(":r{}".format(i))
+                expression_attribute_values[names[-1]] = v
+            condition_expression += " AND (attribute_not_exists(document.#f) OR document.#f IN ({}))".format(
+                ", ".join(names))
+        try:
+            response = self.table.update_item(
+                Key={
+                    'pk': model.pk,
+                    'sk': model.sk
+                },
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames={"#f": field_name},
+                **({"ExpressionAttributeValues": expression_attribute_values} if expression_attribute_values else {})
+            )
+            logger.info("Response from set in document operation is " + response.__str__())
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+            return False
+
+    def get_counters(self, partition_key: str, sort_key: str) -> Dict[str, Decimal]:
+        result = self.table.get_item(
+            Key={
+                'pk': partition_key,
+                'sk': sort_key
+            })
+        if 'Item' in result:
+            return {k: v for k, v in result['Item'].items() if k not in ["pk", "sk"]}
+        return {}
+
     # def increment_counter(self, partition_key:str, sort_key:str, field_name:str, increase:Decimal):
     #
     #     # only updates attributes in the id_key or pk or sk
@@ -283,67 +541,219 @@ class Repository(RepositoryInterface):
             logger.error("The status is {}".format(response['ResponseMetadata']['HTTPStatusCode']))
             raise Exception("Error code {}".format(response['ResponseMetadata']['HTTPStatusCode']))
 
+    def batch_write(self, puts: List[Model] = None, deletes: List[Model] = None):
+        """
+        writes and deletes the models using BatchWriteItem, 25 items per request.
+
+        A key can be sent only once per request, so a put wins over a delete of the same key (the same
+        result of deleting and then putting the item) and the last put of a key wins over the previous ones.
+        Since every key appears once, the requests are independent and they are sent in parallel.
+        """
+        write_requests = {}
+        for d in (deletes or []):
+            write_requests[(d.pk, d.sk)] = {"DeleteRequest": {"Key": {"pk": d.pk, "sk": d.sk}}}
+        for p in (puts or []):
+            write_requests[(p.pk, p.sk)] = {"PutRequest": {"Item": sanitize(p.to_dynamo_db_item())}}
+        requests = list(write_requests.values())
+        run_in_parallel([lambda chunk=requests[i:i + BATCH_WRITE_MAX_ITEMS]: self.__batch_write_chunk(chunk)
+                         for i in range(0, len(requests), BATCH_WRITE_MAX_ITEMS)])
+
+    def __batch_write_chunk(self, requests: List[dict]):
+        request_items = {self.tableName: requests}
+        attempt = 0
+        while request_items:
+            response = self.table.meta.client.batch_write_item(RequestItems=request_items)
+            logger.info("Response from batch write operation is " + response.__str__())
+            request_items = response.get("UnprocessedItems")
+            if request_items:
+                if attempt >= BATCH_MAX_RETRIES:
+                    raise Exception("unable to write {} items after {} retries".format(
+                        len(request_items[self.tableName]), attempt))
+                time.sleep(BATCH_RETRY_BASE_DELAY * (2 ** attempt))
+                attempt = attempt + 1
+
+
+    def batch_get(self, keys: List[Tuple[str, str]]):
+        """
+        loads the items by (partition_key, sort_key) using BatchGetItem, 100 keys per request.
+
+        The result has the same order of the keys, with None where the item doesn't exist.
+        """
+        items = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), BATCH_GET_MAX_KEYS):
+            for item in self.__batch_get_chunk(unique_keys[i:i + BATCH_GET_MAX_KEYS]):
+                items[(item["pk"], item["sk"])] = item
+        return list(map(lambda k: Model.from_dynamo_db_item(items[k]) if k in items else None, keys))
+
+    def __batch_get_chunk(self, keys: List[Tuple[str, str]]):
+        result = []
+        request_items = {self.tableName: {"Keys": list(map(lambda k: {"pk": k[0], "sk": k[1]}, keys))}}
+        attempt = 0
+        while request_items:
+            response = self.table.meta.client.batch_get_item(RequestItems=request_items)
+            logger.info("Response from batch get operation is " + response.__str__())
+            result.extend(response["Responses"].get(self.tableName, []))
+            request_items = response.get("UnprocessedKeys")
+            if request_items:
+                if attempt >= BATCH_MAX_RETRIES:
+                    raise Exception("unable to get {} items after {} retries".format(
+                        len(request_items[self.tableName]["Keys"]), attempt))
+                time.sleep(BATCH_RETRY_BASE_DELAY * (2 ** attempt))
+                attempt = attempt + 1
+        return result
+
 
 class QueryRepository:
 
     def __init__(self, table_name: str):
         self.tableName = table_name
-        self.dynamoDB = connection if connection is not None else boto3.resource('dynamodb')
-        self.table = self.dynamoDB.Table(self.tableName)
-
-    def query_begins_with(self, sk: str, data: str, last_key: Model = None, limit: int = 20):
-        key = Key('sk').eq(sk) & Key('data').begins_with(data)
-        logger.info(
-            "The key that will be used is sk={} begins with data={}".format(sk, data))
-        return self.__query_gsi(key, limit, last_key)
 
-    def query_gt(self, sk: str, data: str, limit: int = 20, last_key: Model = None):
-        key = Key('sk').eq(sk) & Key('data').gt(data)
-        logger.info(
-            "The key that will be used is sk={} begins with data={}".format(sk, data))
-        return self.__query_gsi(key, limit, last_key)
+    @property
+    def table(self):
+        return get_table(self.tableName)
 
-    def query_lt(self, sk: str, data: str, limit: int = 20, last_key: Model = None):
-        key = Key('sk').eq(sk) & Key('data').lt(data)
+    def query_begins_with(self, sk: str, data: str, last_key: Model = None, limit: int = 20, filter_expression=None,
+                          shards: int = None, ascending: bool = False):
         logger.info(
             "The key that will be used is sk={} begins with data={}".format(sk, data))
-        return self.__query_gsi(key, limit, last_key)
+        return self.__query(sk, QueryRepository.__begins_with(data), limit, last_key,
+                            filter_expression, shards, ascending)
 
-    def query_gt(self, sk: str, data: str, limit: int = 20, last_key: Model = None):
-        key = Key('sk').eq(sk) & Key('data').gte(data)
+    def query_gt(self, sk: str, data: str, limit: int = 20, last_key: Model = None, filter_expression=None,
+                 shards: int = None, ascending: bool = False):
         logger.info(
             "The key that will be used is sk={} begins with data={}".format(sk, data))
-        return self.__query_gsi(key, limit, last_key)
+        return self.__query(sk, lambda s: Key('sk').eq(s) & Key('data').gte(data), limit, last_key,
+                            filter_expression, shards, ascending)
 
-    def query_lt(self, sk: str, data: str, limit: int = 20, last_key: Model = None):
-        key = Key('sk').eq(sk) & Key('data').lte(data)
+    def query_lt(self, sk: str, data: str, limit: int = 20, last_key: Model = None, filter_expression=None,
+                 shards: int = None, ascending: bool = False):
         logger.info(
             "The key that will be used is sk={} begins with data={}".format(sk, data))
-        return self.__query_gsi(key, limit, last_key)
+        return self.__query(sk, lambda s: Key('sk').eq(s) & Key('data').lte(data), limit, last_key,
+                            filter_expression, shards, ascending)
 
-    def query_all(self, sk: str, last_key: Model = None, limit: int = 20):
-        key = Key('sk').eq(sk)
+    def query_all(self, sk: str, last_key: Model = None, limit: int = 20, filter_expression=None, shards: int = None,
+                  ascending: bool = False):
         logger.info("The key that will be used is sk={} with no data".format(sk))
-        return self.__query_gsi(key, limit, last_key)
+        return self.__query(sk, QueryRepository.__all(), limit, last_key, filter_expression, shards, ascending)
 
-    def query_range(self, sk: str, from_data: str, to_data: str, limit: int = 20, last_key: Model = None):
+    def query_range(self, sk: str, from_data: str, to_data: str, limit: int = 20, last_key: Model = None,
+                    filter_expression=None, shards: int = None, ascending: bool = False):
         v_1 = from_data
         v_2 = to_data
-        key = Key('sk').eq(sk) & Key('data').between(v_1, v_2)
         logger.info(
-            "the key that will be used is sk={} and data between {} and {}".format(sk, v_1, v_2))
+            "the key that will be used is sk={} and data between {} and {}".format(sk, v_1, v_2))
+        return self.__query(sk, QueryRepository.__between(v_1, v_2), limit, last_key,
+                            filter_expression, shards, ascending)
 
-        return self.__query_gsi(key, limit, last_key)
+    def count_begins_with(self, sk: str, data: str, filter_expression=None, shards: int = None) -> int:
+        logger.info("counting sk={} begins with data={}".format(sk, data))
+        return self.__count(sk, QueryRepository.__begins_with(data), filter_expression, shards)
 
-    def __query_gsi(self, key, limit, last_key):
+    def count_all(self, sk: str, filter_expression=None, shards: int = None) -> int:
+        logger.info("counting sk={} with no data".format(sk))
+        return self.__count(sk, QueryRepository.__all(), filter_expression, shards)
+
+    def count_range(self, sk: str, from_data: str, to_data: str, filter_expression=None, shards: int = None) -> int:
+        logger.info("counting sk={} and data between {} and {}".format(sk, from_data, to_data))
+        return self.__count(sk, QueryRepository.__between(from_data, to_data), filter_expression, shards)
+
+    ## the key conditions on the sk (or the sk of a shard) of the queries and of the counts
+    @staticmethod
+    def __begins_with(data: str) -> Callable[[str], Any]:
+        return lambda s: Key('sk').eq(s) & Key('data').begins_with(data)
+
+    @staticmethod
+    def __between(from_data: str, to_data: str) -> Callable[[str], Any]:
+        return lambda s: Key('sk').eq(s) & Key('data').between(from_data, to_data)
+
+    @staticmethod
+    def __all() -> Callable[[str], Any]:
+        return lambda s: Key('sk').eq(s)
+
+    def __count(self, sk: str, key: Callable[[str], Any], filter_expression, shards: int) -> int:
+        ## the shards are counted in parallel
+        if shards is None or shards <= 1:
+            return self.__count_gsi(key(sk), filter_expression)
+        return sum(run_in_parallel(list(map(
+            lambda i: lambda: self.__count_gsi(key(get_shard_sk(sk, i)), filter_expression), range(shards)))))
+
+    def __count_gsi(self, key, filter_expression=None) -> int:
+        ## Select=COUNT returns only the number of items (matching the filter) of every page, not the items
+        count = 0
+        dynamo_query = dict(
+            IndexName="sk-data-index",
+            KeyConditionExpression=key,
+            FilterExpression=filter_expression,
+            Select="COUNT"
+        )
+        while True:
+            response = self.table.query(**{k: v for k, v in dynamo_query.items() if v is not None})
+            count = count + response["Count"]
+            if "LastEvaluatedKey" not in response:
+                return count
+            dynamo_query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def __query(self, sk: str, key: Callable[[str], Any], limit, last_key, filter_expression, shards: int,
+                ascending: bool):
+        if shards is None or shards <= 1:
+            return self.__query_gsi(key(sk), limit, last_key, filter_expression, ascending)
+        return self.__query_shards(sk, key, limit, last_key, filter_expression, shards, ascending)
+
+    def __query_shards(self, sk: str, key: Callable[[str], Any], limit, last_key, filter_expression, shards: int,
+                       ascending: bool):
+        """
+        queries the shards in parallel and merges their rows by data, in the same direction every shard is read.
+
+        A shard that has more rows bounds the page: its next rows could sort before the rows of the other shards
+        after its last key, so they are kept for the next page. The last key of the result has the position of
+        every shard.
+        """
+        if isinstance(last_key, ShardedKey):
+            keys = list(last_key.keys)
+            done = list(last_key.done)
+        else:
+            ## a row of the collection (e.g. the document id used as start_from), every shard starts after its data
+            keys = [Model(last_key.pk, get_shard_sk(sk, i), last_key.data, None) if last_key else None
+                    for i in range(shards)]
+            done = []
+        active = [i for i in range(shards) if i not in done]
+        results = run_in_parallel(list(map(
+            lambda i: lambda: self.__query_gsi(key(get_shard_sk(sk, i)), limit, keys[i], filter_expression,
+                                               ascending),
+            active)))
+        last_data = [r.lastEvaluatedKey.data for r in results if r.lastEvaluatedKey]
+        bound = (min(last_data) if ascending else max(last_data)) if last_data else None
+        merged = heapq.merge(*[[(m.data, n, m) for m in r.data] for n, r in enumerate(results)],
+                             key=lambda e: e[0], reverse=not ascending)
+        page = list(islice(takewhile(lambda e: bound is None or (e[0] <= bound if ascending else e[0] >= bound),
+                                     merged), limit))
+        consumed = [0] * len(active)
+        for _, n, m in page:
+            consumed[n] = consumed[n] + 1
+            keys[active[n]] = Model(m.pk, m.sk, m.data, None)
+        for n, r in enumerate(results):
+            if consumed[n] == len(r.data):
+                if r.lastEvaluatedKey:
+                    keys[active[n]] = r.lastEvaluatedKey
+                else:
+                    done.append(active[n])
+        next_key = ShardedKey(sk, keys, sorted(done)) if len(done) < shards else None
+        return QueryResult(list(map(lambda e: e[2], page)), next_key)
+
+    def __query_gsi(self, key, limit, last_key, filter_expression=None, ascending: bool = False):
+        ## the filter is applied to the `limit` items read, so a page can contain less items
         start_from = None
         if last_key:
             start_from = {"pk": last_key.pk, "sk": last_key.sk, "data": last_key.data}
         dynamo_query = dict(
             IndexName="sk-data-index",
             KeyConditionExpression=key,
+            FilterExpression=filter_expression,
             Limit=limit,
-            ScanIndexForward=False,
+            ScanIndexForward=ascending,
             ExclusiveStartKey=start_from
         )
         response = self.table.query(
@@ -372,7 +782,7 @@ def cleanup_tables():
         return None
     try:
         tableName = os.environ['DYNAMODB_DOMAIN_TABLE']
-        dynamo_db = connection if connection is not None else boto3.resource('dynamodb')
+        dynamo_db = get_connection()
         table = dynamo_db.Table(tableName)
         scan = table.scan()
         with table.batch_writer() as batch:
@@ -403,7 +813,7 @@ def cleanup_tables():
 
 def create_tables():
     logger.info("create tables")
-    dynamo_db = connection if connection is not None else boto3.resource('dynamodb')
+    dynamo_db = get_connection()
     try:
         domain_table = dynamo_db.create_table(TableName=os.environ['DYNAMODB_DOMAIN_TABLE'],
                                               KeySchema=[
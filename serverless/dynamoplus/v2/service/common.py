@@ -8,4 +8,5 @@ def get_repository_factory(collection: Collection) -> Repository:
 
 
 def is_system(collection: Collection) -> bool:
-    return collection.name in ["collection", "index", "client_authorization","aggregation_configuration","aggregation"]
\ No newline at end of file
+    return collection.name in ["collection", "index", "client_authorization","aggregation_configuration","aggregation",
+                               "aggregation_group", "aggregation_ledger", "metadata_generation"]
\ No newline at end of file
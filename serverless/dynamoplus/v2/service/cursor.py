@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+from typing import *
+
+from dynamoplus.v2.repository.repositories import Model, ShardedKey, CompositeKey
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SIGNATURE_LENGTH = 12
+
+
+class InvalidCursorException(Exception):
+    ## a valid cursor of another query
+    pass
+
+
+def __get_secret():
+    ## without a secret anyone could sign a cursor
+    secret = os.environ.get("PAGINATION_CURSOR_SECRET") or os.environ.get("JWT_SECRET")
+    if not secret:
+        raise Exception("PAGINATION_CURSOR_SECRET (or JWT_SECRET) is needed to sign the cursors")
+    return secret.encode("utf-8")
+
+
+def __sign(payload: str):
+    signature = hmac.new(__get_secret(), payload.encode("utf-8"), hashlib.sha256).digest()[:SIGNATURE_LENGTH]
+    return base64.urlsafe_b64encode(signature).decode("utf-8").rstrip("=")
+
+
+def __b64encode(s: str):
+    return base64.urlsafe_b64encode(s.encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def __b64decode(s: str):
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4)).decode("utf-8")
+
+
+def __to_key(last_key: Union[Model, ShardedKey, CompositeKey, str]):
+    if isinstance(last_key, ShardedKey):
+        return {"sk": last_key.sk, "keys": list(map(__to_key, last_key.keys)), "done": last_key.done}
+    elif isinstance(last_key, CompositeKey):
+        return {"branches": list(map(__to_key, last_key.keys)), "done": last_key.done}
+    elif isinstance(last_key, Model):
+        return [last_key.pk, last_key.sk, last_key.data]
+    return last_key
+
+
+def __from_key(key: Union[list, dict, str]):
+    if isinstance(key, dict) and "branches" in key:
+        return CompositeKey(list(map(__from_key, key["branches"])), key["done"])
+    elif isinstance(key, dict):
+        return ShardedKey(key["sk"], list(map(__from_key, key["keys"])), key["done"])
+    elif isinstance(key, list):
+        pk, sk, data = key
+        return Model(pk, sk, data, None)
+    return key
+
+
+def encode_cursor(last_key: Union[Model, ShardedKey, CompositeKey]) -> Optional[str]:
+    """
+    serializes the last evaluated key of a query into an opaque, url safe and signed cursor, the key of a query
+    across shards (or of an Or) has the position of every shard (or branch)
+    """
+    if last_key is None:
+        return None
+    payload = __b64encode(json.dumps(__to_key(last_key), separators=(",", ":")))
+    return "{}.{}".format(payload, __sign(payload))
+
+
+def decode_cursor(cursor: str) -> Optional[Union[Model, ShardedKey, CompositeKey]]:
+    """
+    returns the last evaluated key of a cursor created by `encode_cursor`, None if the cursor is not valid
+    (e.g. it's a document id used as start_from or it has been tampered)
+    """
+    if not cursor or "." not in cursor:
+        return None
+    payload, signature = cursor.rsplit(".", 1)
+    if not hmac.compare_digest(__sign(payload), signature):
+        logger.debug("invalid cursor signature {}".format(cursor))
+        return None
+    try:
+        key = __from_key(json.loads(__b64decode(payload)))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.debug("invalid cursor {} {}".format(cursor, e))
+        return None
+    return key if isinstance(key, (Model, ShardedKey, CompositeKey)) else None
@@ -0,0 +1,123 @@
+import decimal
+import logging
+from datetime import datetime, timezone
+from typing import *
+
+from dynamoplus.models.system.collection.collection import Collection, AttributeType
+from dynamoplus.utils.utils import convert_to_string
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SEPARATOR = "#"
+## appended to the upper bound of a range, it sorts after every value that has the bound as prefix followed by the
+## separator (e.g. the ordering value) but before any longer value
+DATA_UPPER_BOUND_SUFFIX = SEPARATOR + "\uffff"
+
+EXPONENT_OFFSET = 5000
+EXPONENT_MAX = 9999
+ZERO = "1"
+POSITIVE = "2"
+NEGATIVE = "0"
+POSITIVE_END = "."
+NEGATIVE_END = "~"
+
+
+def escape(value: str) -> str:
+    ## % first, otherwise the escape sequences would be escaped again
+    return value.replace("%", "%25").replace(SEPARATOR, "%23")
+
+
+def encode_number(value) -> str:
+    """
+    encodes a number in a string that sorts as the number: a sign prefix (0 negative, 1 zero, 2 positive), the
+    exponent on 4 digits and the significant digits. The exponent and the digits of the negative numbers are
+    complemented so that greater magnitudes come first, the end marker keeps 1.2 after 1 and -1.2 before -1.
+    """
+    try:
+        number = decimal.Decimal(str(value)) if isinstance(value, float) else decimal.Decimal(value)
+    except (decimal.InvalidOperation, TypeError, ValueError):
+        raise Exception("{} is not a number".format(value))
+    if not number.is_finite():
+        raise Exception("{} is not a number".format(value))
+    if number.is_zero():
+        return ZERO
+    sign, digits, exponent = number.normalize().as_tuple()
+    ## exponent of the most significant digit
+    exponent = len(digits) + exponent - 1 + EXPONENT_OFFSET
+    if exponent < 0 or exponent > EXPONENT_MAX:
+        raise Exception("{} is out of the range of the index".format(value))
+    mantissa = "".join(map(str, digits))
+    if sign == 0:
+        return "{}{:04d}{}{}".format(POSITIVE, exponent, mantissa, POSITIVE_END)
+    complement = "".join(map(lambda d: str(9 - int(d)), mantissa))
+    return "{}{:04d}{}{}".format(NEGATIVE, EXPONENT_MAX - exponent, complement, NEGATIVE_END)
+
+
+def encode_date(value) -> str:
+    """
+    encodes a date as fixed width ISO 8601 in UTC (e.g. 2020-01-31T10:00:00.000000Z), numbers are epoch seconds
+    and the dates without timezone are considered UTC
+    """
+    if isinstance(value, datetime):
+        date = value
+    elif isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+        date = datetime.fromtimestamp(float(value), tz=timezone.utc)
+    elif isinstance(value, str):
+        try:
+            date = datetime.fromtimestamp(float(decimal.Decimal(value)), tz=timezone.utc)
+        except (decimal.InvalidOperation, ValueError):
+            try:
+                date = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+            except ValueError:
+                raise Exception("{} is not a date".format(value))
+    else:
+        raise Exception("{} is not a date".format(value))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc).replace(tzinfo=None).isoformat(timespec="microseconds") + "Z"
+
+
+def get_attribute_type(collection: Collection, field_name: str) -> Optional[AttributeType]:
+    ## nested fields (e.g. address.zip_code) are looked up in the attributes of the parent
+    attributes = collection.attribute_definition if collection else None
+    attribute = None
+    for name in field_name.split("."):
+        attribute = next(filter(lambda a: a.name == name, attributes or []), None)
+        if attribute is None:
+            return None
+        attributes = attribute.attributes
+    return attribute.type
+
+
+def encode_value(collection: Collection, field_name: str, value) -> str:
+    """
+    encodes a value of the `data` attribute of the index rows (and of the queries on them), numbers and dates are
+    encoded only when the collection defines the type of the field
+    """
+    attribute_type = get_attribute_type(collection, field_name)
+    if attribute_type == AttributeType.NUMBER:
+        return encode_number(value)
+    elif attribute_type == AttributeType.DATE:
+        return encode_date(value)
+    return escape(str(convert_to_string(value)))
+
+
+def to_document_value(collection: Collection, field_name: str, value):
+    """
+    converts a value of a query (usually a string) to the type of the field in the stored documents, e.g. to compare
+    it in a FilterExpression: the NUMBER fields are stored as numbers
+    """
+    if get_attribute_type(collection, field_name) == AttributeType.NUMBER and not isinstance(value, decimal.Decimal):
+        try:
+            number = decimal.Decimal(str(value))
+        except (decimal.InvalidOperation, TypeError, ValueError):
+            raise Exception("{} is not a number".format(value))
+        if not number.is_finite():
+            raise Exception("{} is not a number".format(value))
+        return number
+    return value
+
+
+def encode_values(collection: Collection, field_names: List[str], values: List[Any]) -> str:
+    return SEPARATOR.join(map(lambda f_v: encode_value(collection, f_v[0], f_v[1]), zip(field_names, values)))
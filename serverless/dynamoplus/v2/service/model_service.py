@@ -3,8 +3,8 @@ from typing import *
 
 from dynamoplus.models.system.index.index import Index
 from dynamoplus.models.system.collection.collection import Collection
-from dynamoplus.utils.utils import get_values_by_key_recursive, convert_to_string
-from dynamoplus.v2.repository.repositories import Model
+from dynamoplus.v2.repository.repositories import Model, get_shard, get_shard_sk
+from dynamoplus.v2.service.key_encoding import encode_value, SEPARATOR
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -14,9 +14,11 @@ def get_model(collection: Collection, document: dict) -> Model:
     if collection.id_key not in document:
         raise Exception("{} not found in document".format(collection.id_key))
     id = document[collection.id_key]
-    return Model("{}#{}".format(collection.name, id),
-                 collection.name,
-                 document[collection.ordering_key] if collection.ordering_key in document else id,
+    pk = get_pk(collection, id)
+    return Model(pk,
+                 get_sk(collection, pk),
+                 encode_value(collection, collection.ordering_key, document[collection.ordering_key])
+                 if collection.ordering_key in document else id,
                  document
                  )
 
@@ -38,22 +40,44 @@ def get_index_model(collection: Collection, index: Index, document: dict):
         '''
             attr1#attr2#attr3#attr4#orderValue
         '''
-        values = get_values_by_key_recursive(document, index.conditions)
+        ## the fields missing in the document are skipped
+        values = [encode_value(collection, field, value) for field, value in
+                  map(lambda f: (f, __find_value(document, f)), index.conditions) if value is not None]
         logging.info("Found {} in conditions ".format(values))
 
         if values:
-            data = "#".join(list(map(lambda v: convert_to_string(v), values)))
+            data = SEPARATOR.join(values)
             if order_value:
-                data = data + "#" + order_value
+                data = data + SEPARATOR + encode_value(collection, index.ordering_key, order_value)
+            elif index.ordering_key or len(values) < len(index.conditions):
+                ## the queries on the first fields look for their values followed by the separator
+                data = data + SEPARATOR
             return data
 
     sk = index.collection_name + "#" + \
          "#".join(map(lambda x: x, index.conditions)) if index.conditions else index.collection_name
+    pk = get_pk(collection, document[collection.id_key])
+    if index.shards and index.shards > 1:
+        sk = get_shard_sk(sk, get_shard(pk, index.shards))
     data = build_data()
-    return Model(get_pk(collection, document[collection.id_key]), sk, data, document)
+    return Model(pk, sk, data, document)
 
 
-def get_sk(collection: Collection):
+def __find_value(document: dict, field: str):
+    value = document
+    for k in field.split("."):
+        if not isinstance(value, dict) or k not in value:
+            return None
+        value = value[k]
+    return value
+
+
+def get_sk(collection: Collection, pk: str = None):
+    ## the main rows of a sharded collection are spread by partition key
+    if collection.shards and collection.shards > 1:
+        if pk is None:
+            raise Exception("the partition key is needed to find the shard of {}".format(collection.name))
+        return get_shard_sk(collection.name, get_shard(pk, collection.shards))
     return collection.name
 
 
@@ -0,0 +1,217 @@
+import logging
+from typing import *
+
+from dynamoplus.models.query.conditions import Predicate, AnyMatch, Eq, Range, And
+from dynamoplus.models.system.index.index import Index, IndexConfiguration
+from dynamoplus.utils.utils import auto_str
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@auto_str
+class QueryPlan(object):
+    """
+    the index chosen for a query: `predicate` has the conditions covered by the index in the order of the index
+    conditions, `residual` the conditions that the index can't resolve (None when it covers the whole query)
+    """
+
+    def __init__(self, index: Index, predicate: Predicate, residual: Predicate, explanation: str):
+        self.index = index
+        self.predicate = predicate
+        self.residual = residual
+        self.explanation = explanation
+
+    def __eq__(self, o: object) -> bool:
+        if isinstance(o, QueryPlan):
+            return self.index == o.index and self.predicate == o.predicate and self.residual == o.residual
+        return False
+
+
+class QueryPlanner:
+
+    @staticmethod
+    def plan(indexes: Iterable[Index], predicate: Predicate, ordering_key: str = None) -> Optional[QueryPlan]:
+        """
+        picks the best index of the catalog for the predicate, without querying DynamoDB.
+
+        The candidates are compared by the number of conditions they resolve (the longest prefix of equalities,
+        optionally followed by a range on the next field), then by the absence of residual conditions, the index
+        configuration (OPTIMIZE_READ doesn't need to load the documents) and the number of fields not used by the
+        query. Returns None when no index can resolve any condition.
+
+        With an `ordering_key` only the indexes returning the rows in that order are candidates: the field after the
+        equalities is the ordering key, or the equalities cover all the fields and the index is ordered by it.
+        """
+        if isinstance(predicate, AnyMatch):
+            return QueryPlan(None, predicate, None, "no conditions, all the documents of the collection")
+        equalities, ranges, duplicates = QueryPlanner.__get_conditions(predicate)
+        index, covered_fields, covered_range, candidates = QueryPlanner.__choose(indexes, list(equalities.keys()),
+                                                                                 ranges, ordering_key)
+        if index is None:
+            logger.info("no index for {}{}".format(predicate.to_string(),
+                                                   " ordered by {}".format(ordering_key) if ordering_key else ""))
+            return None
+        residual = [e for f, e in equalities.items() if f not in covered_fields] + \
+                   [r for r in ranges if r is not covered_range] + duplicates
+        covered = [equalities[f] for f in covered_fields] + ([covered_range] if covered_range else [])
+        explanation = "{} (best of {} candidate indexes)".format(
+            QueryPlanner.__explain(index, covered_fields, covered_range, residual), candidates)
+        logger.info("query plan for {}: {}".format(predicate.to_string(), explanation))
+        return QueryPlan(index, QueryPlanner.__to_predicate(covered), QueryPlanner.__to_predicate(residual),
+                         explanation)
+
+    @staticmethod
+    def find_index(indexes: Iterable[Index], fields: List[str], ordering_key: str = None) -> Optional[Index]:
+        """
+        picks the best index for equalities on `fields`, with the same rules of `plan` but without their values.
+        """
+        index, _, _, _ = QueryPlanner.__choose(indexes, list(dict.fromkeys(fields)), [], ordering_key)
+        return index
+
+    @staticmethod
+    def __choose(indexes: Iterable[Index], equality_fields: List[str], ranges: List[Range], ordering_key: str) \
+            -> Tuple[Optional[Index], List[str], Optional[Range], int]:
+        ## the best index with the fields of the equalities and the range it covers, and the number of candidates
+        best = (None, [], None)
+        best_score = None
+        candidates = 0
+        for index in indexes:
+            covered_fields = []
+            covered_range = None
+            for field in index.conditions:
+                if field in covered_fields:
+                    continue
+                if field in equality_fields:
+                    covered_fields.append(field)
+                else:
+                    covered_range = next(filter(lambda r: r.field_name == field, ranges), None)
+                    break
+            if len(covered_fields) == 0 and covered_range is None:
+                continue
+            if ordering_key is not None and not QueryPlanner.__is_ordered_by(index, covered_fields, ordering_key):
+                continue
+            candidates = candidates + 1
+            residual = len(equality_fields) - len(covered_fields) + len(ranges) - (1 if covered_range else 0)
+            score = (len(covered_fields) + (1 if covered_range else 0),
+                     residual == 0,
+                     index.index_configuration != IndexConfiguration.OPTIMIZE_WRITE,
+                     -len(set(index.conditions)))
+            if best_score is None or score > best_score:
+                best_score = score
+                best = (index, covered_fields, covered_range)
+        return best + (candidates,)
+
+    @staticmethod
+    def plan_intersection(indexes: Iterable[Index], predicate: Predicate) -> Optional[List[QueryPlan]]:
+        """
+        covers the conditions of an And with more indexes (e.g. one index per field), to be intersected on the
+        document pk instead of creating a composite index for every combination of fields.
+
+        The indexes are picked greedily by the number of conditions still uncovered they resolve, the first plan
+        resolves the most conditions and drives the pagination. Returns None when the conditions can't be all
+        covered or a single index is enough.
+        """
+        if not isinstance(predicate, And):
+            return None
+        equalities, ranges, duplicates = QueryPlanner.__get_conditions(predicate)
+        if len(duplicates) > 0:
+            ## the plans of an intersection have no residual conditions
+            return None
+        uncovered = list(equalities.values()) + ranges
+        candidates = list(indexes)
+        plans = []
+        while len(uncovered) > 0:
+            best = None
+            best_score = None
+            for index in candidates:
+                covered = [c for c in QueryPlanner.__get_covered(index, equalities, ranges) if c in uncovered]
+                score = (len(covered), index.index_configuration != IndexConfiguration.OPTIMIZE_WRITE,
+                         -len(set(index.conditions)))
+                if len(covered) > 0 and (best_score is None or score > best_score):
+                    best_score = score
+                    best = (index, covered)
+            if best is None:
+                logger.info("no intersection of indexes for {}".format(predicate.to_string()))
+                return None
+            index, covered = best
+            candidates.remove(index)
+            uncovered = [c for c in uncovered if c not in covered]
+            ## the index must be queried by all the conditions it covers, even if they are covered by another one
+            index_conditions = QueryPlanner.__get_covered(index, equalities, ranges)
+            plans.append(QueryPlan(index, QueryPlanner.__to_predicate(index_conditions), None,
+                                   QueryPlanner.__explain(index, [c.field_name for c in index_conditions
+                                                                  if isinstance(c, Eq)],
+                                                          next(filter(lambda c: isinstance(c, Range),
+                                                                      index_conditions), None), [])))
+        if len(plans) < 2:
+            return None
+        logger.info("query plan for {}: intersection of {}".format(predicate.to_string(),
+                                                                 [p.explanation for p in plans]))
+        return plans
+
+    @staticmethod
+    def __get_covered(index: Index, equalities: Dict[str, Eq], ranges: List[Range]) -> List[Predicate]:
+        ## the longest prefix of equalities of the index conditions, optionally followed by a range
+        covered = []
+        for field in index.conditions:
+            if field in map(lambda c: c.field_name, covered):
+                continue
+            if field in equalities:
+                covered.append(equalities[field])
+            else:
+                covered_range = next(filter(lambda r: r.field_name == field, ranges), None)
+                if covered_range:
+                    covered.append(covered_range)
+                break
+        return covered
+
+    @staticmethod
+    def __is_ordered_by(index: Index, covered_fields: List[str], ordering_key: str):
+        next_field = next(filter(lambda f: f not in covered_fields, index.conditions), None)
+        if next_field is not None:
+            return next_field == ordering_key
+        return index.ordering_key == ordering_key
+
+    @staticmethod
+    def __explain(index: Index, covered_fields: List[str], covered_range: Range, residual: List[Predicate]):
+        explanation = "{}: equality on {}".format(index.index_name, covered_fields)
+        if covered_range:
+            explanation += ", range on {}".format(covered_range.field_name)
+        if residual:
+            explanation += ", residual on {}".format([r.field_name for r in residual])
+        if index.ordering_key:
+            explanation += ", ordered by {}".format(index.ordering_key)
+        if index.index_configuration:
+            explanation += ", {}".format(index.index_configuration.value)
+        return explanation
+
+    @staticmethod
+    def __to_predicate(conditions: List[Predicate]) -> Optional[Predicate]:
+        if len(conditions) == 0:
+            return None
+        return conditions[0] if len(conditions) == 1 else And(conditions)
+
+    @staticmethod
+    def __get_conditions(predicate: Predicate) -> Tuple[Dict[str, Eq], List[Range], List[Eq]]:
+        ## the equalities by field, the ranges and the other equalities on a field that already has one, they are
+        ## residual conditions (e.g. f = a and f = b matches nothing)
+        if isinstance(predicate, Eq):
+            return {predicate.field_name: predicate}, [], []
+        elif isinstance(predicate, Range):
+            return {}, [predicate], []
+        elif isinstance(predicate, And):
+            equalities = {}
+            ranges = []
+            duplicates = []
+            for c in predicate.conditions:
+                c_equalities, c_ranges, c_duplicates = QueryPlanner.__get_conditions(c)
+                for f, e in c_equalities.items():
+                    if f not in equalities:
+                        equalities[f] = e
+                    elif equalities[f] != e and e not in duplicates:
+                        duplicates.append(e)
+                ranges.extend(c_ranges)
+                duplicates.extend(d for d in c_duplicates if d not in duplicates)
+            return equalities, ranges, duplicates
+        raise Exception("{} is not supported by the query planner".format(predicate))
@@ -1,10 +1,37 @@
+import heapq
+import logging
+import os
+from functools import reduce
+from itertools import takewhile
 from typing import *
-from dynamoplus.models.query.conditions import Predicate, get_range_predicate, AnyMatch
+
+from boto3.dynamodb.conditions import Attr
+
+from dynamoplus.utils.executor import PrefetchingIterator, run_in_parallel
+from dynamoplus.models.query.conditions import Predicate, get_range_predicate, AnyMatch, Eq, And, Range, \
+    compile_predicate
 from dynamoplus.models.system.collection.collection import Collection
 from dynamoplus.models.system.index.index import Index, IndexConfiguration
-from dynamoplus.v2.repository.repositories import QueryResult, get_table_name, QueryRepository, Repository, Model
+from dynamoplus.v2.repository.repositories import QueryResult, get_table_name, QueryRepository, Repository, Model, \
+    ShardedKey, CompositeKey, get_shard, get_shard_sk, get_shard_of_sk, get_unsharded_sk
 from dynamoplus.v2.service.model_service import get_pk, get_sk
 from dynamoplus.v2.service.common import is_system
+from dynamoplus.v2.service.cursor import decode_cursor, InvalidCursorException
+from dynamoplus.v2.service.key_encoding import encode_value, encode_values, to_document_value, SEPARATOR, \
+    DATA_UPPER_BOUND_SUFFIX
+from dynamoplus.v2.service.query_planner import QueryPlan
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+query_page_size = int(os.environ.get("QUERY_PAGE_SIZE", "20"))
+query_prefetch_depth = int(os.environ.get("QUERY_PREFETCH_DEPTH", "1"))
+## the pks of every index of an intersection but the first are kept in memory, up to this number of rows
+query_intersection_max_rows = int(os.environ.get("QUERY_INTERSECTION_MAX_ROWS", "10000"))
+## the counts that can't be done by DynamoDB read the rows in pages of this size
+query_count_page_size = int(os.environ.get("QUERY_COUNT_PAGE_SIZE", "1000"))
+## query_first with a matcher reads at most this number of rows looking for one matching
+query_first_max_rows = int(os.environ.get("QUERY_FIRST_MAX_ROWS", "10000"))
 
 
 def find_sk_query(collection: Collection, fields: List[str]) -> str:
@@ -15,129 +42,502 @@ def find_sk_query(collection: Collection, fields: List[str]) -> str:
 class QueryService:
 
     @staticmethod
-    def query_generator(collection: Collection, predicate: Predicate, index: Index):
-        has_more = True
-        start_from = None
-        while has_more:
+    def query_generator(collection: Collection, predicate: Predicate, index: Index, page_size: int = None,
+                        prefetch_depth: int = None):
+        ## the next pages are queried in background while the current one is consumed
+        page_size = page_size or query_page_size
+        prefetch_depth = prefetch_depth or query_prefetch_depth
+
+        def fetch_page(start_from: Model):
             try:
-                query_result = QueryService.__query(collection,predicate,index, start_from, 20)
-                if query_result and query_result.data and len(query_result.data)>0:
-                    has_more = query_result.lastEvaluatedKey is not None
+                query_result = QueryService.__query(collection, predicate, index, start_from, page_size)
+            except StopIteration:
+                return [], None
+            if query_result and query_result.data and len(query_result.data) > 0:
+                return query_result.data, query_result.lastEvaluatedKey
+            return [], None
+
+        iterator = PrefetchingIterator(fetch_page, prefetch_depth)
+        try:
+            yield from iterator
+        finally:
+            iterator.close()
+
+    @staticmethod
+    def query(collection: Collection, predicate: Predicate, index: Index, start_from: str = None,
+              limit: int = 20, residual: Predicate = None, ascending: bool = False) -> QueryResult:
+        ## the rows are in the order of the index data, descending unless `ascending`
+        if residual is not None:
+            return QueryService.__query_with_residual(collection, predicate, index, start_from, limit, residual,
+                                                      ascending)
+        result = QueryService.__query_index(collection, predicate, index, start_from, limit, ascending=ascending)
+        if index is not None and index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE:
+            result = QueryService.__load_documents(collection, result)
+        return result
+
+    @staticmethod
+    def query_first(collection: Collection, index: Index, ascending: bool = False,
+                    matcher: Callable[[dict], bool] = None, max_rows: int = None) -> Optional[Model]:
+        """
+        the first row of all the rows of the index (e.g. the greatest value of its field), a Limit=1 query.
+
+        With a `matcher` it's the first row whose document matches, the index is read page after page until one does
+        or `max_rows` (query_first_max_rows by default) rows have been read, then it's None.
+        """
+        max_rows = max_rows or query_first_max_rows
+        repo = QueryRepository(get_table_name(is_system(collection)))
+        last_key = None
+        read = 0
+        while True:
+            result = repo.query_all(find_sk_query(collection, index.conditions), last_key,
+                                    1 if matcher is None else min(query_page_size, max_rows - read),
+                                    shards=index.shards, ascending=ascending)
+            read = read + len(result.data)
+            if index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE:
+                result = QueryService.__load_documents(collection, result)
+            first = next(filter(lambda m: matcher is None or matcher(m.document), result.data), None)
+            if first is not None or matcher is None or result.lastEvaluatedKey is None:
+                return first
+            if read >= max_rows:
+                logger.warning("no row of {} matching in the first {} rows".format(index.index_name, read))
+                return None
+            last_key = result.lastEvaluatedKey
+
+    @staticmethod
+    def count(collection: Collection, predicate: Predicate, index: Index, residual: Predicate = None) -> int:
+        """
+        counts the documents matching the predicate with the same key conditions of `query`, DynamoDB returns only
+        the number of rows (Select=COUNT) and the residual conditions are a FilterExpression.
+
+        The rows of an OPTIMIZE_WRITE index don't have the whole document, with residual conditions the documents
+        are loaded and counted page after page.
+        """
+        if residual is not None and index is not None and index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE:
+            return QueryService.__count_pages(
+                lambda last_key: QueryService.query(collection, predicate, index, last_key, query_count_page_size,
+                                                    residual))
+        filter_expression = QueryService.__get_filter_expression(collection, residual) if residual is not None \
+            else None
+        repo = QueryRepository(get_table_name(is_system(collection)))
+        if isinstance(predicate, AnyMatch):
+            return repo.count_all(find_sk_query(collection, []), filter_expression, collection.shards)
+        sk = find_sk_query(collection, index.conditions)
+        if predicate.is_range():
+            data1, data2 = QueryService.__get_range_data(collection, predicate)
+            return repo.count_range(sk, data1, data2, filter_expression, index.shards)
+        data, exact = QueryService.__get_equality_key(collection, predicate, index)
+        if exact:
+            return repo.count_range(sk, data, data, filter_expression, index.shards)
+        return repo.count_begins_with(sk, data, filter_expression, index.shards)
 
-                    for d in query_result.data:
-                        yield d
-                    start_from = query_result.lastEvaluatedKey
+    @staticmethod
+    def count_union(collection: Collection, plans: List[QueryPlan]) -> int:
+        ## a document matching more branches is counted once, so the pks of every branch are read
+        pk_sets = run_in_parallel(list(map(lambda p: lambda: QueryService.__get_matching_pks(collection, p), plans)))
+        return len(set().union(*pk_sets))
+
+    @staticmethod
+    def count_intersection(collection: Collection, plans: List[QueryPlan]) -> int:
+        return QueryService.__count_pages(
+            lambda last_key: QueryService.query_intersection(collection, plans, last_key, query_count_page_size))
+
+    @staticmethod
+    def __count_pages(query_page: Callable[[Any], QueryResult]) -> int:
+        count = 0
+        last_key = None
+        while True:
+            page = query_page(last_key)
+            count = count + len(page.data)
+            last_key = page.lastEvaluatedKey
+            if last_key is None:
+                return count
+
+    @staticmethod
+    def __get_matching_pks(collection: Collection, plan: QueryPlan) -> Set[str]:
+        pks = set()
+        last_key = None
+        while True:
+            page = QueryService.query(collection, plan.predicate, plan.index, last_key, query_count_page_size,
+                                      plan.residual)
+            pks.update(map(lambda m: m.pk, page.data))
+            last_key = page.lastEvaluatedKey
+            if last_key is None:
+                return pks
+
+    @staticmethod
+    def query_union(collection: Collection, plans: List[QueryPlan], start_from: str = None, limit: int = 20,
+                    ascending: bool = False) -> QueryResult:
+        """
+        queries the branches of an Or (e.g. the values of an In) in parallel and merges their rows.
+
+        The rows are merged by their data after the values of the equalities of the branch, i.e. by the range or
+        the ordering value, and a document matching more branches is returned once per page. A branch that has more
+        rows bounds the page like a shard does, the last key has the position of every branch.
+        """
+        last_key = decode_cursor(start_from) if isinstance(start_from, str) else start_from
+        if isinstance(last_key, CompositeKey) and len(last_key.keys) == len(plans):
+            keys = list(last_key.keys)
+            done = list(last_key.done)
+        else:
+            ## no cursor or the id of a document, each branch starts after the row of the document in its index
+            keys = [start_from] * len(plans)
+            done = []
+        active = [i for i in range(len(plans)) if i not in done]
+        results = run_in_parallel(list(map(
+            lambda i: lambda: QueryService.query(collection, plans[i].predicate, plans[i].index, keys[i], limit,
+                                                 plans[i].residual, ascending),
+            active)))
+        prefixes = list(map(lambda i: QueryService.__get_equality_data(collection, plans[i].predicate), active))
+
+        def sort_key(n: int, data: str):
+            return data[len(prefixes[n]):] if data and data.startswith(prefixes[n]) else (data or "")
+
+        frontiers = [sort_key(n, d) for n, d in enumerate(map(QueryService.__get_frontier, results))
+                     if d is not None]
+        bound = (min(frontiers) if ascending else max(frontiers)) if frontiers else None
+        ## a sharded branch with more rows but none in its page can have any row next, only its key moves on
+        stalled = any(isinstance(r.lastEvaluatedKey, ShardedKey) and len(r.data) == 0 for r in results)
+        merged = heapq.merge(*[[(sort_key(n, m.data), n, m) for m in r.data] for n, r in enumerate(results)],
+                             key=lambda e: e[0], reverse=not ascending) if not stalled else []
+        page = []
+        seen = set()
+        consumed = [0] * len(active)
+        for _, n, m in takewhile(lambda e: bound is None or (e[0] <= bound if ascending else e[0] >= bound), merged):
+            if m.pk not in seen and limit is not None and len(page) >= limit:
+                break
+            consumed[n] = consumed[n] + 1
+            if m.pk not in seen:
+                seen.add(m.pk)
+                page.append(m)
+        for n, r in enumerate(results):
+            i = active[n]
+            if consumed[n] == len(r.data):
+                if r.lastEvaluatedKey:
+                    keys[i] = r.lastEvaluatedKey
                 else:
-                    has_more = False
-            except StopIteration:
+                    done.append(i)
+            elif consumed[n] > 0:
+                shards = plans[i].index.shards if plans[i].index else collection.shards
+                keys[i] = QueryService.__get_partial_key(keys[i], r, consumed[n], shards)
+        next_key = CompositeKey(keys, sorted(done)) if len(done) < len(plans) else None
+        return QueryResult(page, next_key)
+
+    @staticmethod
+    def query_intersection(collection: Collection, plans: List[QueryPlan], start_from: str = None, limit: int = 20,
+                           ascending: bool = False) -> QueryResult:
+        """
+        resolves an And with more indexes: the first one is read page after page, in its order, and its rows are
+        kept if their pk is in the rows of all the other indexes, read in parallel into a set of pks.
+
+        An index with more than `query_intersection_max_rows` rows is not kept in memory, its conditions are
+        evaluated on the documents instead. The documents of the rows left are loaded with a batch get when the
+        first index doesn't have them, the last key is a key of the first index.
+        """
+        driver = plans[0]
+        pk_sets = run_in_parallel(list(map(
+            lambda p: lambda: QueryService.__get_pks(collection, p, query_intersection_max_rows), plans[1:])))
+        residual = [p.predicate for p, pks in zip(plans[1:], pk_sets) if pks is None]
+        matcher = compile_predicate(And(residual)) if len(residual) > 0 else None
+        pk_sets = [pks for pks in pk_sets if pks is not None]
+        load_documents = driver.index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE
+        matches = []
+        last_key = start_from
+        while limit is None or len(matches) < limit:
+            page = QueryService.__query_index(collection, driver.predicate, driver.index, last_key, limit,
+                                              ascending=ascending)
+            rows = [(n, m) for n, m in enumerate(page.data) if all(m.pk in pks for pks in pk_sets)]
+            documents = QueryService.__get_documents(collection, list(map(lambda r: r[1], rows))) \
+                if load_documents else list(map(lambda r: r[1], rows))
+            rows = [(n, d) for (n, _), d in zip(rows, documents)
+                    if d is not None and (matcher is None or matcher(d.document))]
+            if limit is not None and len(matches) + len(rows) > limit:
+                consumed = rows[limit - len(matches) - 1][0] + 1
+                matches.extend(map(lambda r: r[1], rows[:limit - len(matches)]))
+                if consumed == len(page.data):
+                    return QueryResult(matches, page.lastEvaluatedKey)
+                return QueryResult(matches, QueryService.__get_partial_key(last_key, page, consumed,
+                                                                           driver.index.shards))
+            matches.extend(map(lambda r: r[1], rows))
+            last_key = page.lastEvaluatedKey
+            if last_key is None or limit is None:
                 break
+        return QueryResult(matches, last_key)
 
+    @staticmethod
+    def __get_pks(collection: Collection, plan: QueryPlan, max_rows: int) -> Optional[Set[str]]:
+        ## None if the index has more than max_rows rows
+        pks = set()
+        last_key = None
+        while True:
+            ## DynamoDB returns at most 1MB per page anyway
+            page = QueryService.__query_index(collection, plan.predicate, plan.index, last_key, max_rows + 1)
+            pks.update(map(lambda m: m.pk, page.data))
+            if len(pks) > max_rows:
+                logger.info("{} has more than {} rows, it's not intersected".format(plan.explanation, max_rows))
+                return None
+            last_key = page.lastEvaluatedKey
+            if last_key is None:
+                return pks
 
+    @staticmethod
+    def __get_equality_data(collection: Collection, predicate: Predicate) -> str:
+        equalities = QueryService.__get_equalities(predicate)
+        return encode_values(collection, list(map(lambda e: e.field_name, equalities)),
+                             list(map(lambda e: e.value, equalities)))
 
     @staticmethod
-    def query(collection: Collection, predicate: Predicate, index: Index, start_from: str = None,
-              limit: int = 20) -> QueryResult:
-        result = None
+    def __get_frontier(result: QueryResult) -> Optional[str]:
+        ## the data of the last row read, the rows not read yet are after it. The page of a sharded index is complete
+        ## up to its last row, a shard whose key is still None hasn't been read and can have any row after it
+        if isinstance(result.lastEvaluatedKey, ShardedKey):
+            return result.data[-1].data if result.data else None
+        return result.lastEvaluatedKey.data if result.lastEvaluatedKey else None
+
+    @staticmethod
+    def __get_partial_key(previous_key, result: QueryResult, consumed: int, shards: int = None):
+        ## the key after the first `consumed` rows of the result, a shard resumes after its last row returned
+        last_row = result.data[consumed - 1]
+        if not shards or shards <= 1:
+            return Model(last_row.pk, last_row.sk, last_row.data, None)
+        previous_key = previous_key if isinstance(previous_key, ShardedKey) else \
+            ShardedKey(get_unsharded_sk(last_row.sk), [None] * shards)
+        keys = list(previous_key.keys)
+        done = list(previous_key.done)
+        for m in result.data[:consumed]:
+            keys[get_shard_of_sk(m.sk)] = Model(m.pk, m.sk, m.data, None)
+        remaining_shards = set(map(lambda m: get_shard_of_sk(m.sk), result.data[consumed:]))
+        next_key = result.lastEvaluatedKey
+        for s in range(shards):
+            if s in remaining_shards:
+                continue
+            if next_key is None or s in next_key.done:
+                if s not in done:
+                    done.append(s)
+            else:
+                keys[s] = next_key.keys[s]
+        return ShardedKey(previous_key.sk, keys, sorted(done))
+
+    @staticmethod
+    def __query_index(collection: Collection, predicate: Predicate, index: Index,
+                      start_from: Union[str, Model] = None, limit: int = 20, filter_expression=None,
+                      ascending: bool = False) -> QueryResult:
         if predicate.is_range():
-            result = QueryService.__query_range(collection, predicate, index.conditions, start_from, limit)
+            return QueryService.__query_range(collection, predicate, index.conditions, start_from, limit,
+                                              filter_expression, index.shards, ascending)
         elif isinstance(predicate, AnyMatch):
-            result = QueryService.__query_all(collection, limit, start_from)
+            return QueryService.__query_all(collection, limit, start_from, filter_expression, ascending)
         else:
-            result = QueryService.__query_begins_with(collection, predicate, index.conditions, start_from, limit)
-        if index is not None and index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE:
-            result = QueryResult(list(map(lambda m: Repository(get_table_name(is_system(collection))).get(m.pk, collection.name), result.data)), result.lastEvaluatedKey)
-        return result
+            return QueryService.__query_begins_with(collection, predicate, index, start_from, limit,
+                                                    filter_expression, ascending)
+
+    @staticmethod
+    def __query_with_residual(collection: Collection, predicate: Predicate, index: Index, start_from: str,
+                              limit: int, residual: Predicate, ascending: bool = False) -> QueryResult:
+        """
+        queries the index and keeps only the documents matching the residual conditions, the index is read page
+        after page until `limit` documents match.
+
+        The residual conditions are a FilterExpression on the document of the rows, but the rows of an
+        OPTIMIZE_WRITE index don't have the whole document so they are evaluated once the documents are loaded.
+        """
+        push_down = index is None or index.index_configuration != IndexConfiguration.OPTIMIZE_WRITE
+        filter_expression = QueryService.__get_filter_expression(collection, residual) if push_down else None
+        matcher = compile_predicate(residual) if not push_down else None
+        matches = []
+        last_key = start_from
+        has_more = True
+        while has_more and (limit is None or len(matches) < limit):
+            page = QueryService.__query_index(collection, predicate, index, last_key, limit, filter_expression,
+                                              ascending)
+            ## (position in the page, document) since a page cut by the limit resumes after its last row returned
+            if push_down:
+                rows = list(enumerate(page.data))
+            else:
+                documents = QueryService.__get_documents(collection, page.data)
+                rows = [(n, d) for n, d in enumerate(documents) if d is not None and matcher(d.document)]
+            if limit is not None and len(matches) + len(rows) > limit:
+                consumed = rows[limit - len(matches) - 1][0] + 1
+                matches.extend(map(lambda r: r[1], rows[:limit - len(matches)]))
+                shards = index.shards if index else collection.shards
+                return QueryResult(matches, QueryService.__get_partial_key(last_key, page, consumed, shards))
+            matches.extend(map(lambda r: r[1], rows))
+            last_key = page.lastEvaluatedKey
+            has_more = last_key is not None
+            if limit is None:
+                break
+        return QueryResult(matches, last_key)
+
+    @staticmethod
+    def __get_filter_expression(collection: Collection, predicate: Predicate):
+        ## the values are compared with the stored documents, so they have the type of the field (e.g. N for numbers)
+        if isinstance(predicate, Eq):
+            return Attr("document." + predicate.field_name).eq(
+                to_document_value(collection, predicate.field_name, predicate.value))
+        elif isinstance(predicate, Range):
+            return Attr("document." + predicate.field_name).between(
+                to_document_value(collection, predicate.field_name, predicate.from_value),
+                to_document_value(collection, predicate.field_name, predicate.to_value))
+        elif isinstance(predicate, And):
+            return reduce(lambda f1, f2: f1 & f2,
+                          map(lambda c: QueryService.__get_filter_expression(collection, c), predicate.conditions))
+        raise Exception("{} can't be used as filter".format(predicate))
 
     @staticmethod
     def __query(collection: Collection, predicate: Predicate, index: Index, start_from: Model = None,
               limit: int = 20) -> QueryResult:
         result = None
         if predicate.is_range():
-            result = QueryService.__query_range_starting_after_model(collection, predicate, index.conditions, start_from, limit)
+            result = QueryService.__query_range_starting_after_model(collection, predicate, index.conditions, start_from, limit,
+                                                                     index.shards)
         elif isinstance(predicate, AnyMatch):
             result = QueryService.__query_all_starting_after_model(collection, limit, start_from)
         else:
-            result = QueryService.__query_begins_with_starting_after_model(collection, predicate, index.conditions, start_from, limit)
+            result = QueryService.__query_begins_with_starting_after_model(collection, predicate, index, start_from,
+                                                                           limit)
         if index is not None and index.index_configuration == IndexConfiguration.OPTIMIZE_WRITE:
-            result = QueryResult(list(
-                map(lambda m: Repository(get_table_name(is_system(collection))).get(m.pk, collection.name),
-                    result.data)), result.lastEvaluatedKey)
+            result = QueryService.__load_documents(collection, result)
         return result
 
     @staticmethod
-    def __query_range(collection: Collection, predicate: Predicate, fields: List[str], start_from: str = None,
-                      limit: int = 20) -> QueryResult:
-        table_name = get_table_name(is_system(collection))
+    def __load_documents(collection: Collection, index_result: QueryResult) -> QueryResult:
+        ## the index rows of an OPTIMIZE_WRITE index contain only the indexed fields
+        documents = QueryService.__get_documents(collection, index_result.data)
+        return QueryResult(list(filter(lambda m: m is not None, documents)), index_result.lastEvaluatedKey)
+
+    @staticmethod
+    def __get_documents(collection: Collection, index_rows: List[Model]) -> List[Model]:
+        ## the result keeps the key of the index rows, so that the rows of a page can be compared and resumed
+        keys = list(map(lambda m: (m.pk, get_sk(collection, m.pk)), index_rows))
+        documents = Repository(get_table_name(is_system(collection))).batch_get(keys) if keys else []
+        return list(map(lambda r_d: Model(r_d[0].pk, r_d[0].sk, r_d[0].data, r_d[1].document) if r_d[1] else None,
+                        zip(index_rows, documents)))
+
+    @staticmethod
+    def __get_equalities(predicate: Predicate) -> List[Eq]:
+        ## the equality conditions, their values are the prefix of the index data before the range
+        if isinstance(predicate, Eq):
+            return [predicate]
+        elif isinstance(predicate, And):
+            return [e for c in predicate.conditions for e in QueryService.__get_equalities(c)]
+        return []
+
+    @staticmethod
+    def __get_range_data(collection: Collection, predicate: Predicate) -> Tuple[str, str]:
+        ## the upper bound includes the rows having the ordering value after the range value
         range_predicate = get_range_predicate(predicate)
-        sk = find_sk_query(collection, fields)
+        equalities = QueryService.__get_equalities(predicate)
         data_prefix = ""
-        non_range_values = list(
-            filter(lambda v: range_predicate.to_value != v and range_predicate.from_value != v, predicate.get_values()))
-        if len(non_range_values) > 0:
-            data_prefix = "#".join(non_range_values)
-            data_prefix = data_prefix + "#"
-        data1 = data_prefix + range_predicate.from_value
-        data2 = data_prefix + range_predicate.to_value
+        if len(equalities) > 0:
+            data_prefix = encode_values(collection, list(map(lambda e: e.field_name, equalities)),
+                                        list(map(lambda e: e.value, equalities))) + SEPARATOR
+        data1 = data_prefix + encode_value(collection, range_predicate.field_name, range_predicate.from_value)
+        data2 = data_prefix + encode_value(collection, range_predicate.field_name, range_predicate.to_value) + \
+                DATA_UPPER_BOUND_SUFFIX
+        return data1, data2
+
+    @staticmethod
+    def __get_last_evaluated_item(collection: Collection, start_from: Union[str, Model, ShardedKey], sk: str,
+                                  row_sk: Callable[[str], str]) -> Union[Model, ShardedKey]:
+        ## start_from is either a cursor, decoded straight into the exclusive start key, or the id of the last
+        ## document, whose row (`row_sk` of its partition key) has to be read to rebuild the key
+        if not start_from:
+            return None
+        if isinstance(start_from, (Model, ShardedKey)):
+            return start_from
+        last_evaluated_item = decode_cursor(start_from)
+        if last_evaluated_item is not None:
+            ## e.g. the cursor of an Or used for a query on a single index
+            if not isinstance(last_evaluated_item, (Model, ShardedKey)) or last_evaluated_item.sk != sk:
+                raise InvalidCursorException("the cursor {} is not valid for this query".format(start_from))
+            return last_evaluated_item
+        table_name = get_table_name(is_system(collection))
+        pk = get_pk(collection, start_from)
+        return Repository(table_name).get(pk, row_sk(pk))
+
+    @staticmethod
+    def __get_index_row_sk(sk: str, shards: int = None) -> Callable[[str], str]:
+        if shards and shards > 1:
+            return lambda pk: get_shard_sk(sk, get_shard(pk, shards))
+        return lambda pk: sk
+
+    @staticmethod
+    def __query_range(collection: Collection, predicate: Predicate, fields: List[str],
+                      start_from: Union[str, Model] = None, limit: int = 20, filter_expression=None,
+                      shards: int = None, ascending: bool = False) -> QueryResult:
+        table_name = get_table_name(is_system(collection))
+        sk = find_sk_query(collection, fields)
+        data1, data2 = QueryService.__get_range_data(collection, predicate)
         repo = QueryRepository(table_name)
-        last_evaluated_item = None
-        if start_from:
-            last_evaluated_item = Repository(table_name).get(get_pk(collection, start_from), sk)
-        return repo.query_range(sk, data1, data2, limit, last_evaluated_item)
+        last_evaluated_item = QueryService.__get_last_evaluated_item(collection, start_from, sk,
+                                                                     QueryService.__get_index_row_sk(sk, shards))
+        return repo.query_range(sk, data1, data2, limit, last_evaluated_item, filter_expression=filter_expression,
+                                shards=shards, ascending=ascending)
 
     @staticmethod
     def __query_range_starting_after_model(collection: Collection, predicate: Predicate, fields: List[str], last_evaluated_item: Model = None,
-                      limit: int = 20) -> QueryResult:
+                      limit: int = 20, shards: int = None) -> QueryResult:
         table_name = get_table_name(is_system(collection))
-        range_predicate = get_range_predicate(predicate)
         sk = find_sk_query(collection, fields)
-        data_prefix = ""
-        non_range_values = list(
-            filter(lambda v: range_predicate.to_value != v and range_predicate.from_value != v, predicate.get_values()))
-        if len(non_range_values) > 0:
-            data_prefix = "#".join(non_range_values)
-            data_prefix = data_prefix + "#"
-        data1 = data_prefix + range_predicate.from_value
-        data2 = data_prefix + range_predicate.to_value
+        data1, data2 = QueryService.__get_range_data(collection, predicate)
         repo = QueryRepository(table_name)
-        return repo.query_range(sk, data1, data2, limit, last_evaluated_item)
+        return repo.query_range(sk, data1, data2, limit, last_evaluated_item, shards=shards)
 
     @staticmethod
-    def __query_begins_with(collection: Collection, predicate: Predicate, fields: List[str], start_from: str = None,
-                            limit: int = 20) -> QueryResult:
+    def __get_equality_key(collection: Collection, predicate: Predicate, index: Index) -> Tuple[str, bool]:
+        """
+        the data of the rows matching the equalities, and whether it's their whole data. When the index has other
+        values after the equalities it's a prefix ending with the separator, so that a value doesn't match the longer
+        values starting with it (e.g. open and opened)
+        """
+        fields = predicate.get_fields()
+        data = encode_values(collection, fields, predicate.get_values())
+        if len(fields) < len(index.conditions) or index.ordering_key:
+            return data + SEPARATOR, False
+        return data, True
+
+    @staticmethod
+    def __query_begins_with(collection: Collection, predicate: Predicate, index: Index,
+                            start_from: Union[str, Model] = None, limit: int = 20,
+                            filter_expression=None, ascending: bool = False) -> QueryResult:
         table_name = get_table_name(is_system(collection))
-        data = "#".join(predicate.get_values())
-        sk = find_sk_query(collection, fields)
+        data, exact = QueryService.__get_equality_key(collection, predicate, index)
+        sk = find_sk_query(collection, index.conditions)
         repo = QueryRepository(table_name)
-        last_evaluated_item = None
-        if start_from:
-            ## should start from last index row
-            last_evaluated_item = Repository(table_name).get(get_pk(collection, start_from), sk)
-        return repo.query_begins_with(sk, data, last_evaluated_item, limit)
+        last_evaluated_item = QueryService.__get_last_evaluated_item(collection, start_from, sk,
+                                                                     QueryService.__get_index_row_sk(sk, index.shards))
+        if exact:
+            return repo.query_range(sk, data, data, limit, last_evaluated_item, filter_expression=filter_expression,
+                                    shards=index.shards, ascending=ascending)
+        return repo.query_begins_with(sk, data, last_evaluated_item, limit, filter_expression=filter_expression,
+                                      shards=index.shards, ascending=ascending)
 
     @staticmethod
-    def __query_begins_with_starting_after_model(collection: Collection, predicate: Predicate, fields: List[str], last_evaluated_item: Model = None,
-                            limit: int = 20) -> QueryResult:
+    def __query_begins_with_starting_after_model(collection: Collection, predicate: Predicate, index: Index,
+                                                 last_evaluated_item: Model = None, limit: int = 20) -> QueryResult:
         table_name = get_table_name(is_system(collection))
-        data = "#".join(predicate.get_values())
-        sk = find_sk_query(collection, fields)
+        data, exact = QueryService.__get_equality_key(collection, predicate, index)
+        sk = find_sk_query(collection, index.conditions)
         repo = QueryRepository(table_name)
-        return repo.query_begins_with(sk, data, last_evaluated_item, limit)
+        if exact:
+            return repo.query_range(sk, data, data, limit, last_evaluated_item, shards=index.shards)
+        return repo.query_begins_with(sk, data, last_evaluated_item, limit, shards=index.shards)
 
     @staticmethod
-    def __query_all(collection: Collection, limit: int, start_from: str = None) -> QueryResult:
+    def __query_all(collection: Collection, limit: int, start_from: Union[str, Model] = None,
+                    filter_expression=None, ascending: bool = False) -> QueryResult:
         table_name = get_table_name(is_system(collection))
         repo = QueryRepository(table_name)
-        last_evaluated_item = None
-        if start_from:
-            ## this is the main row, not the index, since there is no index
-            last_evaluated_item = Repository(table_name).get(get_pk(collection, start_from), get_sk(collection))
         sk = find_sk_query(collection, [])
-        return repo.query_all(sk, last_evaluated_item, limit)
+        ## this is the main row, not the index, since there is no index
+        last_evaluated_item = QueryService.__get_last_evaluated_item(collection, start_from, sk,
+                                                                     lambda pk: get_sk(collection, pk))
+        return repo.query_all(sk, last_evaluated_item, limit, filter_expression=filter_expression,
+                              shards=collection.shards, ascending=ascending)
 
     @staticmethod
     def __query_all_starting_after_model(collection: Collection, limit: int, last_evaluated_item: Model = None) -> QueryResult:
         table_name = get_table_name(is_system(collection))
         repo = QueryRepository(table_name)
         sk = find_sk_query(collection, [])
-        res = repo.query_all(sk, last_evaluated_item, limit)
+        res = repo.query_all(sk, last_evaluated_item, limit, shards=collection.shards)
         return res
@@ -1,18 +1,14 @@
 import logging
-from _pydecimal import Decimal
-from typing import List
+from decimal import Decimal
+from typing import *
 
-from dynamoplus.models.query.conditions import match_predicate
-from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, Aggregation, \
-    AggregationCount, AggregationTrigger, AggregationSum, AggregationAvg
+from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, \
+    AggregationTrigger
 from dynamoplus.models.system.collection.collection import Collection
-from dynamoplus.v2.repository.repositories import Counter
-from dynamoplus.v2.repository.repositories import Repository, AtomicIncrement
-from dynamoplus.v2.service.common import get_repository_factory
-
-from dynamoplus.v2.service.model_service import get_model
-from dynamoplus.v2.service.system.system_service import AggregationConfigurationService, \
-    AggregationService
+from dynamoplus.utils.executor import run_in_parallel
+from dynamoplus.utils.utils import convert_to_string
+from dynamoplus.v2.service.key_encoding import escape, SEPARATOR
+from dynamoplus.v2.service.system.system_service import AggregationService
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -20,8 +16,6 @@ logger.setLevel(logging.INFO)
 
 # TODO
 #
-# - for MAX and MIN: an index by the field must be present so if it doesn't exist, then create it and make it unmodifiable
-#   - in the API or whatever may change the index, the update must be forbidden
 # - for count and sum: they are strictly connected, if avg is defined then sum is automatically created
 #
 
@@ -59,155 +53,51 @@ logger.setLevel(logging.INFO)
 
 class AggregationProcessingService:
 
+    ## every aggregation is a single item with count and sum, updated by one write per record (or per batch of
+    ## records) and without reading it, the average is derived when the aggregation is read
 
     def avg(aggregation_configuration: AggregationConfiguration,
             collection: Collection,
             new_record: dict,
-            old_record: dict):
-        ## load aggregation
-        ## TODO: the index should optimize READ so no need to copy the value on the index row
-
-        aggregations = map(lambda a: AggregationService.get_aggregation_by_name(a.name), AggregationService.get_aggregations_by_name_generator(aggregation_configuration.name))
-        # count_target_field
-        # sum_target_field
-        # avg_target_field
-        count_target_field_aggregation = next(filter(lambda a: isinstance(a, AggregationCount), aggregations),None)
-        sum_target_field_aggregation = next(filter(lambda a: isinstance(a, AggregationSum), aggregations),None)
-        avg_target_field_aggregation = next(filter(lambda a: isinstance(a, AggregationAvg), aggregations),None)
-
-        record = (new_record or old_record)
-        is_decrement = True if new_record is None else False
-        _sum = 0
-        _count = 1
-        if aggregation_configuration.target_field in record:
-
-            if count_target_field_aggregation:
-
-                is_increment = True if old_record is None else False
-                is_decrement = True if new_record is None else False
-
-                increment = 1 if is_increment else -1
-                AggregationService.increment(count_target_field_aggregation, "count", increment)
-                _count = count_target_field_aggregation.count + increment
-            else:
-                try:
-                    x = record[aggregation_configuration.target_field]
-                    value = int(x)
-                    if is_decrement:
-                        value = value * -1
-                    count_target_field_aggregation = AggregationService.create_aggregation(
-                        AggregationCount("count_" + aggregation_configuration.name, aggregation_configuration.name, 1))
-                    _count = 1
-                except Exception as e:
-                    logger.error("unable to count the value {} with message {}".format(x, e))
-                    raise e
-
-            if sum_target_field_aggregation:
-                try:
-                    x = record[aggregation_configuration.target_field]
-                    value = int(x)
-                    if is_decrement:
-                        value = value * -1
-                    sum_target_field_aggregation = AggregationService.increment(sum_target_field_aggregation, "sum", value)
-                    logger.info("aggregation aftre update {} ".format(sum_target_field_aggregation))
-                    _sum = sum_target_field_aggregation.sum
-
-
-                except Exception as e:
-                    logger.error("unable to count the value {} with message {}".format(x, e))
-                    raise e
-            else:
-                try:
-                    x = record[aggregation_configuration.target_field]
-                    value = int(x)
-                    if is_decrement:
-                        value = value * -1
-                    sum_target_field_aggregation = AggregationService.create_aggregation(
-                        AggregationSum("sum_" + aggregation_configuration.name, aggregation_configuration.name, value))
-                    _sum = value
-                except Exception as e:
-                    logger.error("unable to sum the value {} with message {}".format(x,e))
-                    raise e
-
-            logger.info("sum {} ".format(_sum))
-            logger.info("count {} ".format(_count))
-            avg = _sum / _count
-            logger.info("avg is {} ".format(avg))
-            if avg_target_field_aggregation:
-                try:
-
-                    avg_target_field_aggregation.avg = avg
-                    return AggregationService.updateAggregation(avg_target_field_aggregation)
-                except Exception as e:
-                    logger.error("unable to sum the value {}".format(x))
-                    raise e
-
-            else:
-
-                return AggregationService.create_aggregation(
-                    AggregationAvg(aggregation_configuration.name, aggregation_configuration.name, avg))
+            old_record: dict) -> Dict[str, Decimal]:
+        return AggregationProcessingService.__get_target_field_increments(aggregation_configuration, new_record,
+                                                                          old_record)
 
     def sum(aggregation_configuration: AggregationConfiguration,
             collection: Collection,
             new_record: dict,
-            old_record: dict):
-        ## load aggregation
-        aggregation = AggregationService.get_aggregation_by_name(aggregation_configuration.name)
-
-        record = (new_record or old_record)
-        is_decrement = True if new_record is None else False
-        if aggregation:
-            if isinstance(aggregation, AggregationSum):
-                if aggregation_configuration.target_field in record:
-                    try:
-                        x = record[aggregation_configuration.target_field]
-                        value = int(x)
-                        if is_decrement:
-                            value = value * -1
-                        if AggregationService.increment(aggregation, "sum", value):
-                            aggregation.sum = aggregation.sum + value
-                    except:
-                        logger.error("unable to sum the value {}".format(x))
-
-            return aggregation
-        else:
-            ## create the aggregation if it doesn't exist
-            if aggregation_configuration.target_field in record:
-                try:
-                    x = record[aggregation_configuration.target_field]
-                    value = int(x)
-                    if is_decrement:
-                        value = value * -1
-                    return AggregationService.create_aggregation(
-                        AggregationSum(aggregation_configuration.name, aggregation_configuration.name, value))
-                except:
-                    logger.error("unable to sum the value {}".format(x))
+            old_record: dict) -> Dict[str, Decimal]:
+        return AggregationProcessingService.__get_target_field_increments(aggregation_configuration, new_record,
+                                                                          old_record)
 
     def collection_count(aggregation_configuration: AggregationConfiguration,
                          collection: Collection,
                          new_record: dict,
-                         old_record: dict):
-        ## load aggregation
-        aggregation = AggregationService.get_aggregation_by_name(aggregation_configuration.name)
-        if aggregation:
-            if isinstance(aggregation, AggregationCount):
-                is_increment = True if old_record is None else False
-                is_decrement = True if new_record is None else False
-                if is_increment:
-                    if AggregationService.increment_count(aggregation):
-                        ## TODO: avoid set and copy
-                        aggregation.count = aggregation.count + 1
-
-                elif is_decrement:
-                    if AggregationService.decrement_count(aggregation):
-                        aggregation.count = aggregation.count - 1
-            return aggregation
+                         old_record: dict) -> Dict[str, Decimal]:
+        count = (1 if new_record is not None else 0) - (1 if old_record is not None else 0)
+        return {"count": Decimal(count)}
 
-        else:
-            ## create the aggregation if it doesn't exist
-            logger.info("found aggregation configuration {}".format(aggregation_configuration))
-            return AggregationService.create_aggregation(
-                AggregationCount(aggregation_configuration.name, aggregation_configuration.name, 1))
+    @staticmethod
+    def __get_target_field_increments(aggregation_configuration: AggregationConfiguration, new_record: dict,
+                                      old_record: dict) -> Dict[str, Decimal]:
+        ## an update changes the sum by the difference of the values, the count only if the field is added or removed
+        new_value = AggregationProcessingService.__get_value(new_record, aggregation_configuration.target_field)
+        old_value = AggregationProcessingService.__get_value(old_record, aggregation_configuration.target_field)
+        return {
+            "count": Decimal((1 if new_value is not None else 0) - (1 if old_value is not None else 0)),
+            "sum": (new_value or Decimal(0)) - (old_value or Decimal(0))
+        }
+
+    @staticmethod
+    def __get_value(record: dict, target_field: str) -> Optional[Decimal]:
+        if record is None or target_field not in record:
+            return None
+        x = record[target_field]
+        try:
+            return Decimal(str(x))
+        except Exception as e:
+            logger.error("unable to aggregate the value {} with message {}".format(x, e))
+            return None
 
     def avg_join(aggregation_configuration: AggregationConfiguration, collection: Collection, new_record: dict, old_record: dict):
         ## Load Collection by `aggregation_configuration.join.collection_name`
@@ -216,33 +106,242 @@ class AggregationProcessingService:
 
         return None
 
-    def max(aggregation: AggregationConfiguration, old_document: dict, new_document: dict):
-        ## create "normal" index by field ordered by itself
-        return None
-
-    def min(aggregation: AggregationConfiguration, old_document: dict, new_document: dict):
-        ## create "normal" index by field order by itself
-        return None
-
+    def max(aggregation_configuration: AggregationConfiguration,
+            collection: Collection,
+            new_record: dict,
+            old_record: dict) -> Dict[str, Decimal]:
+        ## the count of the records with the field, the extreme is in `get_extreme_change`
+        increments = AggregationProcessingService.__get_target_field_increments(aggregation_configuration,
+                                                                                new_record, old_record)
+        return {"count": increments["count"]}
 
+    def min(aggregation_configuration: AggregationConfiguration,
+            collection: Collection,
+            new_record: dict,
+            old_record: dict) -> Dict[str, Decimal]:
+        increments = AggregationProcessingService.__get_target_field_increments(aggregation_configuration,
+                                                                                new_record, old_record)
+        return {"count": increments["count"]}
 
-    aggregation_executor_factory = {
+    aggregation_increments_factory = {
         AggregationType.AVG: avg,
         AggregationType.COLLECTION_COUNT: collection_count,
         AggregationType.SUM: sum,
+        AggregationType.MAX: max,
+        AggregationType.MIN: min,
     }
 
     @staticmethod
-    def execute_aggregation(aggregation_configuration: AggregationConfiguration, collection: Collection,
-                            new_record: dict,
-                            old_record: dict):
+    def __get_change(aggregation_configuration: AggregationConfiguration, new_record: dict,
+                     old_record: dict) -> Optional[Tuple[Optional[dict], Optional[dict]]]:
+        """
+        the (new_record, old_record) of the change for the aggregation, None if it isn't triggered: a record not
+        matching the predicate isn't in the aggregation, so an update moving a record out of the predicate removes
+        it (and into the predicate adds it)
+        """
         if aggregation_configuration.matches:
-            if not match_predicate(new_record, aggregation_configuration.matches):
+            if new_record is not None and not aggregation_configuration.matcher(new_record):
+                new_record = None
+            if old_record is not None and not aggregation_configuration.matcher(old_record):
+                old_record = None
+            if new_record is None and old_record is None:
                 logger.debug("aggregation {} not matching  the predicate ".format(aggregation_configuration.__str__()))
-                return
+                return None
         aggregation_trigger = AggregationTrigger.INSERT if old_record is None else AggregationTrigger.DELETE if new_record is None else AggregationTrigger.UPDATE
         if aggregation_configuration.on is None or aggregation_trigger in aggregation_configuration.on:
-            return AggregationProcessingService.aggregation_executor_factory[aggregation_configuration.type](aggregation_configuration, collection, new_record,
-                                                                                                         old_record)
+            return new_record, old_record
+        logger.debug("aggregation {} not matching trigger {} ".format(aggregation_configuration,aggregation_trigger))
+        return None
+
+    @staticmethod
+    def get_increments(aggregation_configuration: AggregationConfiguration, collection: Collection,
+                       new_record: dict,
+                       old_record: dict) -> Optional[Dict[str, Decimal]]:
+        ## what the change adds to the aggregation, None if the aggregation doesn't change
+        change = AggregationProcessingService.__get_change(aggregation_configuration, new_record, old_record)
+        if change is None:
+            return None
+        new_record, old_record = change
+        increments = AggregationProcessingService.aggregation_increments_factory[aggregation_configuration.type](
+            aggregation_configuration, collection, new_record, old_record)
+        if increments is None or all(map(lambda i: i == 0, increments.values())):
+            logger.debug("nothing to add to {}".format(aggregation_configuration.name))
+            return None
+        return increments
+
+    @staticmethod
+    def get_extreme_change(aggregation_configuration: AggregationConfiguration, collection: Collection,
+                           new_record: dict,
+                           old_record: dict) -> Optional[Tuple[Optional[Decimal], Optional[Decimal]]]:
+        """
+        the new value of the target field of a MIN or MAX aggregation (a candidate extreme) and the old one (that
+        may have been the extreme), None if the change doesn't affect the aggregation
+        """
+        if not aggregation_configuration.type.is_extreme():
+            return None
+        change = AggregationProcessingService.__get_change(aggregation_configuration, new_record, old_record)
+        if change is None:
+            return None
+        new_record, old_record = change
+        new_value = AggregationProcessingService.__get_value(new_record, aggregation_configuration.target_field)
+        old_value = AggregationProcessingService.__get_value(old_record, aggregation_configuration.target_field)
+        if new_value == old_value:
+            return None
+        return new_value, old_value
+
+    @staticmethod
+    def get_group_increments(aggregation_configuration: AggregationConfiguration, collection: Collection,
+                             new_record: dict,
+                             old_record: dict) -> Dict[str, Dict[str, Decimal]]:
+        """
+        the increments of a group_by aggregation by group, an update that changes the value of the group_by field
+        moves the record from a group to the other. The records without the field aren't in any group.
+        """
+        change = AggregationProcessingService.__get_change(aggregation_configuration, new_record, old_record)
+        if change is None:
+            return {}
+        new_record, old_record = change
+        new_group = AggregationProcessingService.__get_group(new_record, aggregation_configuration.group_by)
+        old_group = AggregationProcessingService.__get_group(old_record, aggregation_configuration.group_by)
+        if new_group == old_group:
+            changes = [(new_group, new_record, old_record)]
         else:
-            logger.debug("aggregation {} not matching trigger {} ".format(aggregation_configuration,aggregation_trigger))
+            changes = [(old_group, None, old_record), (new_group, new_record, None)]
+        result = {}
+        for group, new, old in changes:
+            if group is None:
+                continue
+            increments = AggregationProcessingService.aggregation_increments_factory[aggregation_configuration.type](
+                aggregation_configuration, collection, new, old)
+            if increments and any(map(lambda i: i != 0, increments.values())):
+                result[group] = increments
+        return result
+
+    @staticmethod
+    def __get_group(record: dict, group_by: str) -> Optional[str]:
+        ## the group is the value as string (e.g. "true"), an empty value can't be a key of the GSI
+        if record is None or record.get(group_by) is None:
+            return None
+        group = str(convert_to_string(record[group_by]))
+        return group if group != "" else None
+
+    @staticmethod
+    def execute_aggregation(aggregation_configuration: AggregationConfiguration, collection: Collection,
+                            new_record: dict,
+                            old_record: dict):
+        if aggregation_configuration.group_by:
+            return [AggregationService.add_to_group(aggregation_configuration, group, increments)
+                    for group, increments in AggregationProcessingService.get_group_increments(
+                    aggregation_configuration, collection, new_record, old_record).items()]
+        increments = AggregationProcessingService.get_increments(aggregation_configuration, collection, new_record,
+                                                                 old_record)
+        if aggregation_configuration.type.is_extreme():
+            change = AggregationProcessingService.get_extreme_change(aggregation_configuration, collection,
+                                                                     new_record, old_record)
+            if change:
+                candidate, removed = change
+                return AggregationService.update_extreme(aggregation_configuration,
+                                                         (increments or {}).get("count", Decimal(0)), candidate,
+                                                         [removed] if removed is not None else [])
+        elif increments:
+            return AggregationService.add_to_aggregation(aggregation_configuration, increments)
+
+
+def get_aggregation_key(name: str, group: Optional[str]) -> str:
+    ## identifies an aggregation item, the aggregation or a group of a group_by aggregation
+    return name if group is None else "{}{}{}".format(name, SEPARATOR, escape(group))
+
+
+class AggregationAccumulator:
+    """
+    sums the increments of the aggregations of a batch of changes in memory, `flush` writes them with one atomic
+    update per aggregation (or per group of a group_by aggregation) instead of one per change. For MIN and MAX it
+    keeps the best candidate and the values that may have been the extreme.
+
+    The increments aren't idempotent, the keys (see `get_aggregation_key`) of the aggregations already applied to a
+    change can be skipped when it's added and `flush` reports the ones it applies.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self.__configurations = {}
+        self.__increments = {}
+        self.__extremes = {}
+        self.__sources = {}
+
+    def add(self, aggregation_configuration: AggregationConfiguration, new_record: dict, old_record: dict,
+            source: Any = None, applied: Set[str] = None):
+        ## `source` identifies the change, e.g. its position in the batch, `applied` the keys to skip
+        name = aggregation_configuration.name
+        applied = applied or set()
+        if aggregation_configuration.group_by:
+            for group, increments in AggregationProcessingService.get_group_increments(
+                    aggregation_configuration, self.collection, new_record, old_record).items():
+                if get_aggregation_key(name, group) not in applied:
+                    self.__add_increments((name, group), aggregation_configuration, increments, source)
+            return
+        if name in applied:
+            return
+        increments = AggregationProcessingService.get_increments(aggregation_configuration, self.collection,
+                                                                 new_record, old_record)
+        change = AggregationProcessingService.get_extreme_change(aggregation_configuration, self.collection,
+                                                                 new_record, old_record)
+        if not increments and not change:
+            return
+        self.__add_increments((name, None), aggregation_configuration, increments or {}, source)
+        if change:
+            candidate, removed = change
+            best, removed_values = self.__extremes.get((name, None), (None, []))
+            if candidate is not None and (best is None or aggregation_configuration.type.is_better(candidate, best)):
+                best = candidate
+            if removed is not None:
+                removed_values.append(removed)
+            self.__extremes[(name, None)] = (best, removed_values)
+
+    def __add_increments(self, key: Tuple[str, Optional[str]], aggregation_configuration: AggregationConfiguration,
+                         increments: Dict[str, Decimal], source: Any):
+        self.__configurations[key] = aggregation_configuration
+        total = self.__increments.setdefault(key, {})
+        for k, v in increments.items():
+            total[k] = total.get(k, Decimal(0)) + v
+        self.__sources.setdefault(key, []).append(source)
+
+    def flush(self, applied: Union[List[Set[str]], Dict[Any, Set[str]]] = None) -> List[Any]:
+        """
+        writes the aggregations in parallel and returns the sources of the changes added to the aggregations that
+        couldn't be written, the keys of the aggregations written (or with nothing to write) are added to the
+        `applied` of their sources
+        """
+
+        def write(key: Tuple[str, Optional[str]]):
+            name, group = key
+            increments = self.__increments[key]
+            try:
+                if key not in self.__extremes and all(map(lambda i: i == 0, increments.values())):
+                    ## the changes cancel each other
+                    pass
+                elif key in self.__extremes:
+                    candidate, removed = self.__extremes[key]
+                    AggregationService.update_extreme(self.__configurations[key],
+                                                      self.__increments[key].get("count", Decimal(0)), candidate,
+                                                      removed)
+                elif group is not None:
+                    AggregationService.add_to_group(self.__configurations[key], group, self.__increments[key])
+                else:
+                    AggregationService.add_to_aggregation(self.__configurations[key], self.__increments[key])
+            except Exception as e:
+                logger.error("unable to write the aggregation {}{}: {}".format(
+                    name, " group {}".format(group) if group is not None else "", e))
+                return self.__sources[key]
+            if applied is not None:
+                for source in self.__sources[key]:
+                    applied[source].add(get_aggregation_key(name, group))
+            return []
+
+        failed = [s for sources in run_in_parallel(list(map(lambda k: lambda: write(k), self.__increments.keys())))
+                  for s in sources]
+        self.__configurations = {}
+        self.__increments = {}
+        self.__extremes = {}
+        self.__sources = {}
+        return failed
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+from typing import *
+
+from dynamoplus.models.system.collection.collection import Collection
+from dynamoplus.utils.cache import TTLCache
+from dynamoplus.v2.service.common import get_repository_factory
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+## metadata is read on every request and changes rarely, the writes done by the system services invalidate it
+metadata_cache_ttl = float(os.environ.get("METADATA_CACHE_TTL", "60"))
+metadata_cache_max_size = int(os.environ.get("METADATA_CACHE_MAX_SIZE", "512"))
+collection_cache = TTLCache(metadata_cache_max_size, metadata_cache_ttl)
+index_cache = TTLCache(metadata_cache_max_size, metadata_cache_ttl)
+aggregation_configuration_cache = TTLCache(metadata_cache_max_size, metadata_cache_ttl)
+
+metadata_caches = {
+    "collection": collection_cache,
+    "index": index_cache,
+    "aggregation_configuration": aggregation_configuration_cache
+}
+
+## the generation item is not a document, it has only counters so it isn't indexed
+metadata_generation_metadata = Collection("metadata_generation", "name")
+METADATA_GENERATION_PK = "metadata_generation#metadata"
+METADATA_GENERATION_SK = "metadata_generation"
+GENERATION_COUNTER = "generation"
+
+
+def get_metadata_cache_stats():
+    return {name: cache.stats() for name, cache in metadata_caches.items()}
+
+
+def clear_metadata_cache():
+    for cache in metadata_caches.values():
+        cache.clear()
+
+
+class MetadataGeneration(object):
+    """
+    Tracks the generation item updated by the system table stream.
+
+    Every change to a collection, an index or an aggregation configuration increments the global generation and
+    the counter of its metadata type, a container reads the item at most once every `check_interval` seconds and
+    clears only the caches whose counter has changed since the previous check.
+    The counters are one per metadata type, so the item doesn't grow with the number of collections.
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.__generation = None
+        self.__entries = {}
+        self.__next_check = 0
+        self.__lock = threading.Lock()
+
+    def check(self):
+        if self.check_interval <= 0:
+            return
+        now = time.monotonic()
+        with self.__lock:
+            if now < self.__next_check:
+                return
+            self.__next_check = now + self.check_interval
+        try:
+            entries = get_repository_factory(metadata_generation_metadata).get_counters(METADATA_GENERATION_PK,
+                                                                                        METADATA_GENERATION_SK)
+        except Exception as e:
+            logger.error("unable to read the metadata generation {}".format(e))
+            return
+        generation = entries.pop(GENERATION_COUNTER, Decimal(0))
+        with self.__lock:
+            if self.__generation is not None and generation != self.__generation:
+                ## items written by older releases can still have a counter per collection, they are ignored
+                changed = [e for e in metadata_caches if self.__entries.get(e) != entries.get(e)]
+                logger.info("metadata generation changed to {}, clearing {}".format(generation, changed))
+                for e in changed:
+                    metadata_caches[e].clear()
+            self.__generation = generation
+            self.__entries = entries
+
+    @staticmethod
+    def bump(metadata_types: List[str]):
+        counters = {t: Decimal(1) for t in metadata_types if t in metadata_caches}
+        counters[GENERATION_COUNTER] = Decimal(1)
+        get_repository_factory(metadata_generation_metadata).add_counters(METADATA_GENERATION_PK,
+                                                                          METADATA_GENERATION_SK, counters)
+
+
+metadata_generation = MetadataGeneration(float(os.environ.get("METADATA_GENERATION_CHECK_INTERVAL", "0")))
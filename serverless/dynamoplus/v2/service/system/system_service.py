@@ -1,32 +1,52 @@
 import logging
+import os
+import random
 from decimal import Decimal
 from typing import *
 
-from dynamoplus.models.query.conditions import Eq, And, AnyMatch, Predicate, Range
+from dynamoplus.models.query.conditions import Eq, And, AnyMatch, Predicate, Range, Or, In
 from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationTrigger, \
     AggregationJoin, \
-    AggregationType, Aggregation, AggregationCount, AggregationSum, AggregationAvg
+    AggregationType, Aggregation, AggregationCount, AggregationSum, AggregationAvg, AggregationMin, AggregationMax
 from dynamoplus.models.system.client_authorization.client_authorization import ClientAuthorization, \
     ClientAuthorizationApiKey, ClientAuthorizationHttpSignature, Scope, ScopesType
 from dynamoplus.models.system.collection.collection import Collection, AttributeDefinition, AttributeType, \
     AttributeConstraint
 from dynamoplus.models.system.index.index import Index, IndexConfiguration
-from dynamoplus.v2.repository.repositories import AtomicIncrement,Counter
-from dynamoplus.v2.service.common import get_repository_factory
-from dynamoplus.v2.service.model_service import get_model, get_index_model
+from dynamoplus.v2.repository.repositories import AtomicIncrement, Counter, Model, QueryRepository, get_shard_sk, \
+    get_table_name
+from dynamoplus.utils.cache import TTLCache
+from dynamoplus.v2.service.common import get_repository_factory, is_system
+from dynamoplus.v2.service.cursor import decode_cursor
+from dynamoplus.v2.service.key_encoding import escape
+from dynamoplus.v2.service.model_service import get_model, get_index_model, get_pk
+from dynamoplus.v2.service.query_planner import QueryPlanner, QueryPlan
 from dynamoplus.v2.service.query_service import QueryService
+from dynamoplus.v2.service.system.metadata_cache import collection_cache, index_cache, \
+    aggregation_configuration_cache, metadata_generation, get_metadata_cache_stats, clear_metadata_cache
 
 collection_metadata = Collection("collection", "name")
 index_metadata = Collection("index", "name")
 client_authorization_metadata = Collection("client_authorization", "client_id")
 aggregation_configuration_metadata = Collection("aggregation_configuration", "name")
 aggregation_metadata = Collection("aggregation", "name")
+## the groups of a group_by aggregation, every group has its own partition and the same sort key
+aggregation_group_metadata = Collection("aggregation_group", "name")
+## the aggregations already applied to the stream records that are going to be retried, by the sequence number of the
+## first record of the retry
+aggregation_ledger_metadata = Collection("aggregation_ledger", "sequence_number")
 index_by_collection_and_name_metadata = Index(index_metadata.name, ["collection.name", "name"], None)
 index_by_collection_metadata = Index(index_metadata.name, ["collection.name"], None)
 index_by_name_metadata = Index(index_metadata.name, ["name"], None)
 aggregation_configuration_index_by_collection_name = Index("aggregation_configuration", ["collection.name"])
 aggregation_index_by_aggregation_name = Index("aggregation", ["configuration_name"],IndexConfiguration.OPTIMIZE_WRITE)
 
+## the sum of the shards of a sharded aggregation is cached for a short time, reading it is a BatchGetItem of all the
+## shards
+aggregation_shards_cache = TTLCache(int(os.environ.get("AGGREGATION_SHARDS_CACHE_MAX_SIZE", "256")),
+                                    float(os.environ.get("AGGREGATION_SHARDS_CACHE_TTL", "1")))
+aggregation_groups_page_size = int(os.environ.get("AGGREGATION_GROUPS_PAGE_SIZE", "1000"))
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -42,6 +62,10 @@ class Converter:
                 "range": {"field_name": predicate.field_name, "from": predicate.from_value, "to": predicate.to_value}}
         elif isinstance(predicate, And):
             return {"and": list(map(lambda c: Converter.from_predicate_to_dict(c), predicate.conditions))}
+        elif isinstance(predicate, Or):
+            return {"or": list(map(lambda c: Converter.from_predicate_to_dict(c), predicate.conditions))}
+        elif isinstance(predicate, In):
+            return {"in": {"field_name": predicate.field_name, "values": predicate.values}}
 
     @staticmethod
     def from_dict_to_predicate(d: dict):
@@ -52,6 +76,10 @@ class Converter:
         elif "and" in d:
             conditions = list(map(lambda cd: Converter.from_dict_to_predicate(cd), d["and"]))
             return And(conditions)
+        elif "or" in d:
+            return Or(list(map(lambda cd: Converter.from_dict_to_predicate(cd), d["or"])))
+        elif "in" in d:
+            return In(d["in"]["field_name"], d["in"]["values"])
 
     @staticmethod
     def from_collection_to_dict(collection: Collection):
@@ -67,7 +95,8 @@ class Converter:
             result["ordering_key"] = collection.ordering_key
         if collection.attribute_definition:
             result["attributes"] = list(map(lambda a: Converter.from_attribute_definition_to_API(a), collection.attribute_definition))
-
+        if collection.shards:
+            result["shards"] = collection.shards
         return result
 
     @staticmethod
@@ -86,13 +115,18 @@ class Converter:
             d["ordering_key"] = index.ordering_key
         if index.index_configuration:
             d["configuration"] = index.index_configuration.name
+        if index.shards:
+            d["shards"] = index.shards
+        if index.locked:
+            d["locked"] = True
         return d
 
     @staticmethod
     def from_dict_to_index(d: dict):
         return Index(d["collection"]["name"], d["conditions"],
                      IndexConfiguration.value_of(d["configuration"]) if "configuration" in d else None,
-                     d["ordering_key"] if "ordering_key" in d else None)
+                     d["ordering_key"] if "ordering_key" in d else None,
+                     int(d["shards"]) if d.get("shards") else None, bool(d.get("locked")))
 
     @staticmethod
     def from_client_authorization_http_signature_to_dict(client_authorization: ClientAuthorizationHttpSignature):
@@ -129,6 +163,8 @@ class Converter:
             attributes = list(
                 map(lambda a: Converter.from_attribute_definition_to_dict(a), collection.attribute_definition))
             d["attributes"] = attributes
+        if collection.shards:
+            d["shards"] = collection.shards
         return d
 
     @staticmethod
@@ -137,7 +173,7 @@ class Converter:
             map(Converter.from_dict_to_attribute_definition, d["attributes"])) if "attributes" in d else None
         auto_generate_id = d["auto_generate_id"] if "auto_generate_id" in d else False
         return Collection(d["name"], d["id_key"], d["ordering"] if "ordering" in d else None, attributes,
-                          auto_generate_id)
+                          auto_generate_id, int(d["shards"]) if d.get("shards") else None)
 
     @staticmethod
     def from_attribute_definition_to_dict(attribute: AttributeDefinition):
@@ -231,6 +267,10 @@ class Converter:
             a["target_field"] = aggregation.target_field
         if aggregation.matches:
             a["matches"] = Converter.from_predicate_to_dict(aggregation.matches)
+        if aggregation.shards:
+            a["shards"] = aggregation.shards
+        if aggregation.group_by:
+            a["group_by"] = aggregation.group_by
         d["aggregation"] = a
         d["name"] = aggregation.name
         return d
@@ -255,6 +295,10 @@ class Converter:
             a["target_field"] = aggregation_configuration.target_field
         if aggregation_configuration.matches:
             a["matches"] = Converter.from_predicate_to_dict(aggregation_configuration.matches)
+        if aggregation_configuration.shards:
+            a["shards"] = aggregation_configuration.shards
+        if aggregation_configuration.group_by:
+            a["group_by"] = aggregation_configuration.group_by
         d["configuration"] = a
         d["name"] = aggregation_configuration.name
         if aggregation:
@@ -267,6 +311,8 @@ class Converter:
             "name": aggregation.name,
             "configuration_name": aggregation.configuration_name
         }
+        if aggregation.group is not None:
+            a["group"] = aggregation.group
         if isinstance(aggregation, AggregationCount):
             a["count"] = aggregation.count
             a["type"] = "COLLECTION_COUNT"
@@ -277,6 +323,12 @@ class Converter:
         if isinstance(aggregation, AggregationAvg):
             a["avg"] = Decimal(aggregation.avg)
             a["type"] = "AVG"
+        if isinstance(aggregation, AggregationMin):
+            a["min"] = aggregation.min
+            a["type"] = "MIN"
+        if isinstance(aggregation, AggregationMax):
+            a["max"] = aggregation.max
+            a["type"] = "MAX"
         return a
 
     @staticmethod
@@ -284,6 +336,8 @@ class Converter:
         a = {
             "name": aggregation.name
         }
+        if aggregation.group is not None:
+            a["group"] = aggregation.group
         if isinstance(aggregation, AggregationCount):
             a["type"] = AggregationType.COLLECTION_COUNT.name
             a["payload"] = {
@@ -299,21 +353,19 @@ class Converter:
             a["payload"] = {
                 "avg": aggregation.avg
             }
+        if isinstance(aggregation, AggregationMin):
+            a["type"] = AggregationType.MIN.name
+            a["payload"] = {
+                "min": aggregation.min
+            }
+        if isinstance(aggregation, AggregationMax):
+            a["type"] = AggregationType.MAX.name
+            a["payload"] = {
+                "max": aggregation.max
+            }
         return a
 
 
-    @staticmethod
-    def from_predicate_to_dict(predicate: Predicate):
-        d = {}
-        if isinstance(predicate, And):
-            d["and"] = list(map(lambda p: Converter.from_predicate_to_dict(p), predicate.conditions))
-        elif isinstance(predicate, Eq):
-            d["eq"] = {
-                "field_name": predicate.field_name,
-                "value": predicate.value
-            }
-        return d
-
     @staticmethod
     def from_dict_to_aggregation_configuration(document: dict):
         collection_name = document["collection"]["name"]
@@ -331,7 +383,10 @@ class Converter:
         if "matches" in inner_aggregation_document:
             matches = Converter.from_dict_to_predicate(inner_aggregation_document["matches"])
 
-        return AggregationConfiguration(collection_name, t, on, target_field, matches, join)
+        return AggregationConfiguration(collection_name, t, on, target_field, matches, join,
+                                        int(inner_aggregation_document["shards"])
+                                        if inner_aggregation_document.get("shards") else None,
+                                        inner_aggregation_document.get("group_by"))
 
     @staticmethod
     def from_API_to_aggregation_configuration(document: dict):
@@ -350,13 +405,33 @@ class Converter:
         if "matches" in inner_aggregation_document:
             matches = Converter.from_dict_to_predicate(inner_aggregation_document["matches"])
 
-        return AggregationConfiguration(collection_name, t, on, target_field, matches, join)
+        return AggregationConfiguration(collection_name, t, on, target_field, matches, join,
+                                        int(inner_aggregation_document["shards"])
+                                        if inner_aggregation_document.get("shards") else None,
+                                        inner_aggregation_document.get("group_by"))
 
     @staticmethod
     def from_dict_to_aggregation(document: dict):
+        aggregation = Converter.__from_dict_to_aggregation(document)
+        aggregation.group = document.get("group")
+        return aggregation
+
+    @staticmethod
+    def __from_dict_to_aggregation(document: dict):
         name = document["name"]
         configuraton_name = document["configuration_name"]
 
+        ## the aggregations have count and sum, the average is derived
+        if document.get("type") == AggregationType.AVG.name and "count" in document:
+            count = document["count"]
+            return AggregationAvg(name, configuraton_name, document.get("sum", 0) / count if count else Decimal(0))
+        if document.get("type") == AggregationType.SUM.name and "sum" in document:
+            return AggregationSum(name, configuraton_name, document["sum"])
+        ## MIN and MAX have the count of the records with the field too, without records the extreme is missing
+        if document.get("type") == AggregationType.MIN.name:
+            return AggregationMin(name, configuraton_name, document.get("min"))
+        if document.get("type") == AggregationType.MAX.name:
+            return AggregationMax(name, configuraton_name, document.get("max"))
         if "count" in document:
             return AggregationCount(name,configuraton_name,  document["count"])
         if "sum" in document:
@@ -370,6 +445,12 @@ class CollectionService:
 
     @staticmethod
     def get_collection(collection_name: str) -> Collection:
+        metadata_generation.check()
+        return collection_cache.get_or_load(collection_name,
+                                            lambda: CollectionService.__load_collection(collection_name))
+
+    @staticmethod
+    def __load_collection(collection_name: str) -> Collection:
         repo = get_repository_factory(collection_metadata)
         model = get_model(collection_metadata, {"name": collection_name})
         result = repo.get(model.pk, model.sk)
@@ -381,6 +462,7 @@ class CollectionService:
         repo = get_repository_factory(collection_metadata)
         model = get_model(collection_metadata, Converter.from_collection_to_dict(collection))
         result = repo.create(model)
+        collection_cache.invalidate(collection.name)
         return Converter.from_dict_to_collection(result.document)
 
     @staticmethod
@@ -388,23 +470,21 @@ class CollectionService:
         repo = get_repository_factory(collection_metadata)
         model = get_model(collection_metadata, {collection_metadata.id_key: collection_name})
         repo.delete(model.pk, model.sk)
+        collection_cache.invalidate(collection_name)
+        index_cache.invalidate(collection_name)
+        aggregation_configuration_cache.invalidate(collection_name)
 
     @staticmethod
     def get_all_collections(start_from: str = None, limit: int = None) -> (Collection, dict):
-        result = QueryService.query(collection_metadata, AnyMatch(), None, limit, start_from)
+        result = QueryService.query(collection_metadata, AnyMatch(), None, start_from, limit)
         if result:
             return list(
                 map(lambda m: Converter.from_dict_to_collection(m.document), result.data)), result.lastEvaluatedKey
 
     @staticmethod
     def get_all_collections_generator():
-        has_more = True
-        while has_more:
-            last_evaluated_key = None
-            collections, last_evaluated_key = CollectionService.get_all_collections(last_evaluated_key)
-            has_more = last_evaluated_key is not None
-            for c in collections:
-                yield c
+        for m in QueryService.query_generator(collection_metadata, AnyMatch(), None):
+            yield Converter.from_dict_to_collection(m.document)
 
 
 class IndexService:
@@ -429,6 +509,7 @@ class IndexService:
         repo = get_repository_factory(index_metadata)
         model = get_model(index_metadata, index_dict)
         create_index_model = repo.create(model)
+        index_cache.invalidate(index.collection_name)
         logger.info("index created {}".format(create_index_model.__str__()))
         if create_index_model:
             created_index = Converter.from_dict_to_index(create_index_model.document)
@@ -441,6 +522,25 @@ class IndexService:
             logger.info("{} has been indexed {}".format(created_index.collection_name, index_by_name_model.document))
             return created_index
 
+    @staticmethod
+    def lock_index(index: Index):
+        ## the document is in the index rows by collection name and by name too
+        repo = get_repository_factory(index_metadata)
+        index_dict = Converter.from_index_to_dict(index)
+        for model in [get_model(index_metadata, index_dict),
+                      get_index_model(index_metadata, Index("index", ["collection.name"]), index_dict),
+                      get_index_model(index_metadata, Index("index", ["collection.name", "name"]), index_dict)]:
+            repo.set_in_document(model, "locked", True)
+        index.locked = True
+        index_cache.invalidate(index.collection_name)
+
+    @staticmethod
+    def is_locked(name: str) -> bool:
+        repo = get_repository_factory(index_metadata)
+        model = get_model(index_metadata, {index_metadata.id_key: name})
+        result = repo.get(model.pk, model.sk)
+        return result is not None and bool(result.document.get("locked"))
+
     @staticmethod
     def get_index_by_name_and_collection_name(name: str, collection_name: str):
         query_result = QueryService.query(index_metadata,
@@ -464,31 +564,42 @@ class IndexService:
 
     @staticmethod
     def get_index_matching_fields(fields: List[str], collection_name: str, ordering_key: str = None):
-        index_name = Index.index_name_generator(collection_name, fields, ordering_key)
-        index = IndexService.get_index_by_name_and_collection_name(index_name, collection_name)
-        fields_counter = len(fields) - 1
-        while index is None and fields_counter >= 1:
-            index_name = Index.index_name_generator(collection_name, fields[0:fields_counter], ordering_key)
-            index = IndexService.get_index_by_name_and_collection_name(index_name, collection_name)
-            fields_counter = fields_counter - 1
-        return index
+        return QueryPlanner.find_index(IndexService.get_indexes_from_collection_name_generator(collection_name),
+                                       fields, ordering_key)
+
+    @staticmethod
+    def get_query_plan(predicate: Predicate, collection_name: str, ordering_key: str = None) -> QueryPlan:
+        ## the plan is computed on the cached index catalog of the collection
+        return QueryPlanner.plan(IndexService.get_indexes_from_collection_name_generator(collection_name), predicate,
+                                 ordering_key)
+
+    @staticmethod
+    def get_intersection_plans(predicate: Predicate, collection_name: str) -> Optional[List[QueryPlan]]:
+        return QueryPlanner.plan_intersection(IndexService.get_indexes_from_collection_name_generator(collection_name),
+                                              predicate)
 
     @staticmethod
     def delete_index(name: str):
         repo = get_repository_factory(index_metadata)
         model = get_model(index_metadata, {index_metadata.id_key: name})
         repo.delete(model.pk, model.sk)
+        ## the index name doesn't identify the collection unambiguously
+        index_cache.clear()
 
     @staticmethod
     def get_indexes_from_collection_name_generator(collection_name: str, limit=10):
-        has_more = True
-        while has_more:
-            last_evaluated_key = None
-            indexes, last_evaluated_key = IndexService.get_index_by_collection_name(collection_name, last_evaluated_key,
-                                                                                    limit)
-            has_more = last_evaluated_key is not None
-            for i in indexes:
-                yield i
+        metadata_generation.check()
+        indexes = index_cache.get_or_load(collection_name,
+                                          lambda: list(IndexService.__load_indexes_by_collection_name(collection_name,
+                                                                                                      limit)))
+        for i in indexes:
+            yield i
+
+    @staticmethod
+    def __load_indexes_by_collection_name(collection_name: str, limit: int):
+        for m in QueryService.query_generator(index_metadata, Eq("collection.name", collection_name),
+                                              index_by_collection_metadata, limit):
+            yield Converter.from_dict_to_index(m.document)
 
 
 class AuthorizationService:
@@ -529,39 +640,38 @@ class AuthorizationService:
 class AggregationService:
     @staticmethod
     def get_aggregation_by_name(name:str)->Aggregation:
-
+        cached = aggregation_shards_cache.get(name)
+        if cached:
+            return cached
         repo = get_repository_factory(aggregation_metadata)
         model = get_model(aggregation_metadata, {aggregation_metadata.id_key: name})
         result = repo.get(model.pk, model.sk)
         if result:
-            return Converter.from_dict_to_aggregation(result.document)
+            document = AggregationService.__sum_shards([result.document])[0]
+            aggregation = Converter.from_dict_to_aggregation(document)
+            if document.get("shards"):
+                aggregation_shards_cache.put(name, aggregation)
+            return aggregation
 
     @staticmethod
     def get_aggregations_by_configuration_name(configuration_name: str, limit:int=20, start_from:str=None) -> Tuple[
         List[Union[AggregationCount, Aggregation]], Any]:
 
-        result = QueryService.query(aggregation_metadata, Eq("configuration_name",configuration_name), aggregation_index_by_aggregation_name, limit, start_from)
+        result = QueryService.query(aggregation_metadata, Eq("configuration_name",configuration_name), aggregation_index_by_aggregation_name, start_from, limit)
         if result:
             return list(
-                map(lambda m: Converter.from_dict_to_aggregation(m.document), result.data)), result.lastEvaluatedKey
-
-    @staticmethod
-    def get_aggregations_by_name_generator(configuration_name:str):
-        has_more = True
-        start_from = None
-        while has_more:
-            result,last_key = AggregationService.get_aggregations_by_configuration_name(configuration_name,20,start_from)
-            has_more = last_key is not None
-            for c in result:
-                yield c
-            start_from = last_key
+                map(lambda d: Converter.from_dict_to_aggregation(d),
+                    AggregationService.__sum_shards(list(map(lambda m: m.document, result.data))))), \
+                   result.lastEvaluatedKey
 
     @staticmethod
     def get_all_aggregations(limit: int, start_from:str)->Tuple[
         List[Union[AggregationCount, Aggregation]], Any]:
-        result = QueryService.query(aggregation_metadata, AnyMatch(), None, limit, start_from)
+        result = QueryService.query(aggregation_metadata, AnyMatch(), None, start_from, limit)
         if result:
-            return list(map(lambda m: Converter.from_dict_to_aggregation(m.document), result.data)), result.lastEvaluatedKey
+            return list(map(lambda d: Converter.from_dict_to_aggregation(d),
+                            AggregationService.__sum_shards(list(map(lambda m: m.document, result.data))))), \
+                   result.lastEvaluatedKey
 
     @staticmethod
     def increment_count(aggregation: AggregationCount)->Aggregation:
@@ -592,6 +702,178 @@ class AggregationService:
         repo.increment_counter(AtomicIncrement(model.pk, model.sk, [Counter("count", 1, False)]))
 
 
+    @staticmethod
+    def get_applied_aggregations(sequence_number: str) -> Dict[str, List[str]]:
+        """
+        the aggregations applied to the records of a batch of the stream that failed, by sequence number of the
+        record, saved for the retry that starts with `sequence_number`
+        """
+        repo = get_repository_factory(aggregation_ledger_metadata)
+        model = get_model(aggregation_ledger_metadata, {"sequence_number": sequence_number})
+        result = repo.get(model.pk, model.sk)
+        return result.document.get("applied", {}) if result else {}
+
+    @staticmethod
+    def set_applied_aggregations(sequence_number: str, applied: Dict[str, List[str]]):
+        repo = get_repository_factory(aggregation_ledger_metadata)
+        repo.create(get_model(aggregation_ledger_metadata, {"sequence_number": sequence_number, "applied": applied}))
+
+    @staticmethod
+    def delete_applied_aggregations(sequence_number: str):
+        repo = get_repository_factory(aggregation_ledger_metadata)
+        model = get_model(aggregation_ledger_metadata, {"sequence_number": sequence_number})
+        repo.delete(model.pk, model.sk)
+
+    @staticmethod
+    def add_to_aggregation(aggregation_configuration: AggregationConfiguration,
+                           increments: Dict[str, Decimal]) -> Aggregation:
+        ## a single atomic write, the first one creates the aggregation and its index row. A sharded aggregation is
+        ## written to a random shard, the result is the shard and not the whole aggregation
+        repo = get_repository_factory(aggregation_metadata)
+        document = {"name": aggregation_configuration.name, "configuration_name": aggregation_configuration.name,
+                    "type": aggregation_configuration.type.name}
+        shards = aggregation_configuration.shards
+        if shards and shards > 1:
+            document["shards"] = shards
+        aggregation_model = get_model(aggregation_metadata, document)
+        shard = random.randrange(shards) if shards and shards > 1 else 0
+        model, created = repo.add_to_document(AggregationService.__get_shard_model(aggregation_model, shard),
+                                              increments)
+        if created and shard > 0:
+            ## the first shard is the aggregation, it must exist to be found by name and by the index
+            aggregation_document, created = repo.add_to_document(aggregation_model,
+                                                                 {k: Decimal(0) for k in increments.keys()})
+        if created:
+            repo.create(get_index_model(aggregation_metadata, aggregation_index_by_aggregation_name, document))
+        return Converter.from_dict_to_aggregation(model.document)
+
+    @staticmethod
+    def add_to_group(aggregation_configuration: AggregationConfiguration, group: str,
+                     increments: Dict[str, Decimal]) -> Aggregation:
+        ## the same atomic write of `add_to_aggregation`, every group is a different item
+        repo = get_repository_factory(aggregation_group_metadata)
+        model, created = repo.add_to_document(AggregationService.__get_group_model(aggregation_configuration, group),
+                                              increments)
+        return Converter.from_dict_to_aggregation(model.document)
+
+    @staticmethod
+    def get_aggregation_groups(configuration_name: str, limit: int = None, start_from: Union[str, Model] = None) -> \
+            Tuple[List[Aggregation], Any]:
+        """
+        the groups of a group_by aggregation ordered by group, a single query on the GSI
+        """
+        repo = QueryRepository(get_table_name(is_system(aggregation_group_metadata)))
+        last_key = decode_cursor(start_from) if isinstance(start_from, str) else start_from
+        result = repo.query_all(AggregationService.__get_group_sk(configuration_name), last_key,
+                                limit or aggregation_groups_page_size, ascending=True)
+        return list(map(lambda m: Converter.from_dict_to_aggregation(m.document), result.data)), \
+               result.lastEvaluatedKey
+
+    @staticmethod
+    def get_aggregation_groups_generator(configuration_name: str):
+        last_key = None
+        while True:
+            groups, last_key = AggregationService.get_aggregation_groups(configuration_name, None, last_key)
+            yield from groups
+            if last_key is None:
+                return
+
+    @staticmethod
+    def __get_group_model(aggregation_configuration: AggregationConfiguration, group: str) -> Model:
+        document = {"name": "{}#{}".format(aggregation_configuration.name, escape(group)),
+                    "configuration_name": aggregation_configuration.name,
+                    "type": aggregation_configuration.type.name,
+                    "group": group}
+        return Model(get_pk(aggregation_group_metadata, document["name"]),
+                     AggregationService.__get_group_sk(aggregation_configuration.name), escape(group), document)
+
+    @staticmethod
+    def __get_group_sk(configuration_name: str) -> str:
+        return "{}#{}".format(aggregation_group_metadata.name, configuration_name)
+
+    @staticmethod
+    def update_extreme(aggregation_configuration: AggregationConfiguration, count: Decimal,
+                       candidate: Optional[Decimal], removed: List[Decimal]) -> Aggregation:
+        """
+        updates a MIN or MAX aggregation: adds `count` to the number of records with the target field and replaces
+        the extreme with the candidate by a conditional write, without reading the records.
+
+        When one of the `removed` values (deleted or updated records) is the current extreme, the new one is the
+        first row of the index of the target field, so the index rows of the changes must have been written. With
+        `matches` the index is read up to query_first_max_rows rows, the extreme is unset if none of them matches.
+        """
+        repo = get_repository_factory(aggregation_metadata)
+        field_name = aggregation_configuration.type.name.lower()
+        document = {"name": aggregation_configuration.name, "configuration_name": aggregation_configuration.name,
+                    "type": aggregation_configuration.type.name}
+        model, created = repo.add_to_document(get_model(aggregation_metadata, document), {"count": count})
+        if created:
+            repo.create(get_index_model(aggregation_metadata, aggregation_index_by_aggregation_name, document))
+        document = dict(model.document)
+        current = document.get(field_name)
+        if len(removed) > 0 and (current is None or current in removed):
+            value = AggregationService.__find_extreme(aggregation_configuration)
+            logger.info("{} of {} removed, recomputed {}".format(field_name, aggregation_configuration.name, value))
+            ## a concurrent update may have set a better candidate after the query
+            if repo.set_in_document(model, field_name, value, replaces_one_of=list(set(removed))):
+                document[field_name] = value
+            else:
+                logger.info("{} of {} changed by a concurrent update".format(field_name,
+                                                                             aggregation_configuration.name))
+        elif candidate is not None and (current is None or aggregation_configuration.type.is_better(candidate,
+                                                                                                     current)):
+            if repo.set_in_document(model, field_name, candidate, "<" if field_name == "max" else ">"):
+                document[field_name] = candidate
+            else:
+                logger.info("{} of {} changed by a concurrent update".format(field_name,
+                                                                             aggregation_configuration.name))
+        return Converter.from_dict_to_aggregation(document)
+
+    @staticmethod
+    def __find_extreme(aggregation_configuration: AggregationConfiguration) -> Optional[Decimal]:
+        ## the index is ordered by the target field, the first row in the right direction matching the configuration
+        collection = CollectionService.get_collection(aggregation_configuration.collection_name)
+        first = QueryService.query_first(collection,
+                                         AggregationConfigurationService.get_extreme_index(aggregation_configuration),
+                                         aggregation_configuration.type == AggregationType.MIN,
+                                         aggregation_configuration.matcher
+                                         if aggregation_configuration.matches else None)
+        value = first.document.get(aggregation_configuration.target_field) if first else None
+        return Decimal(str(value)) if value is not None else None
+
+    @staticmethod
+    def __get_shard_model(model: Model, shard: int) -> Model:
+        ## the other shards have their own partition and a sort key that isn't listed with the aggregations
+        if shard == 0:
+            return model
+        return Model(get_shard_sk(model.pk, shard), get_shard_sk(model.sk, shard), model.data, model.document)
+
+    @staticmethod
+    def __sum_shards(documents: List[dict]) -> List[dict]:
+        ## the counters of the other shards of the sharded aggregations are loaded with a single BatchGetItem
+        shard_keys = []
+        for document in documents:
+            if document.get("shards"):
+                model = get_model(aggregation_metadata, document)
+                shard_keys.extend(map(lambda s: AggregationService.__get_shard_model(model, s),
+                                      range(1, int(document["shards"]))))
+        if len(shard_keys) == 0:
+            return documents
+        shards_by_name = {}
+        for shard in get_repository_factory(aggregation_metadata).batch_get(
+                list(map(lambda m: (m.pk, m.sk), shard_keys))):
+            if shard:
+                shards_by_name.setdefault(shard.document["name"], []).append(shard.document)
+        result = []
+        for document in documents:
+            total = dict(document)
+            for shard in shards_by_name.get(document["name"], []):
+                for k, v in shard.items():
+                    if k != "shards" and isinstance(v, Decimal):
+                        total[k] = total.get(k, Decimal(0)) + v
+            result.append(total)
+        return result
+
     @staticmethod
     def create_aggregation(aggregation:Aggregation)->Aggregation:
         repo = get_repository_factory(aggregation_metadata)
@@ -618,7 +900,7 @@ class AggregationConfigurationService:
 
     @staticmethod
     def get_all_aggregation_configurations(limit: int, start_from: str):
-        result = QueryService.query(aggregation_configuration_metadata, AnyMatch(), None, limit, start_from)
+        result = QueryService.query(aggregation_configuration_metadata, AnyMatch(), None, start_from, limit)
         if result:
             return list(map(lambda m: Converter.from_dict_to_aggregation_configuration(m.document), result.data)), result.lastEvaluatedKey
 
@@ -630,11 +912,23 @@ class AggregationConfigurationService:
         if result:
             return Converter.from_dict_to_aggregation_configuration(result.document)
 
+    @staticmethod
+    def get_extreme_index(aggregation_configuration: AggregationConfiguration) -> Index:
+        ## MIN and MAX read the extreme from an index by the target field, it can't be deleted
+        return Index(aggregation_configuration.collection_name, [aggregation_configuration.target_field],
+                     IndexConfiguration.OPTIMIZE_READ, locked=True)
+
     @staticmethod
     def create_aggregation_configuration(aggregation: AggregationConfiguration):
+        if aggregation.type.is_extreme():
+            index = IndexService.create_index(AggregationConfigurationService.get_extreme_index(aggregation))
+            if not index.locked:
+                ## the index was already there
+                IndexService.lock_index(index)
         aggregation_document = Converter.from_aggregation_configuration_to_dict(aggregation)
         repo = get_repository_factory(aggregation_configuration_metadata)
         created_aggregation_model = repo.create(get_model(aggregation_configuration_metadata, aggregation_document))
+        aggregation_configuration_cache.invalidate(aggregation.collection_name)
         if created_aggregation_model:
             created_aggregation = Converter.from_dict_to_aggregation_configuration(created_aggregation_model.document)
             aggregation_by_collection_name = repo.create(
@@ -647,11 +941,14 @@ class AggregationConfigurationService:
 
     @staticmethod
     def get_aggregation_configurations_by_collection_name_generator(collection_name: str):
-        return map(lambda a: Converter.from_dict_to_aggregation_configuration(a.document),
-                   QueryService.query_generator(
-                       aggregation_configuration_metadata,
-                       Eq("collection.name", collection_name),
-                       aggregation_configuration_index_by_collection_name))
+        metadata_generation.check()
+        return iter(aggregation_configuration_cache.get_or_load(
+            collection_name,
+            lambda: list(map(lambda a: Converter.from_dict_to_aggregation_configuration(a.document),
+                             QueryService.query_generator(
+                                 aggregation_configuration_metadata,
+                                 Eq("collection.name", collection_name),
+                                 aggregation_configuration_index_by_collection_name)))))
 
     @staticmethod
     def get_aggregation_configurations_by_collection_name(collection_name: str, limit:int=20, start_from:str=None):
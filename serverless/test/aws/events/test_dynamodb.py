@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import patch
+
+import aws.events.dynamodb
+from aws.events.dynamodb import coalesce_changes, dynamo_stream_handler, dynamo_system_stream_handler
+from dynamoplus.v2.service.system.metadata_cache import MetadataGeneration
+from dynamoplus.v2.service.system.system_service import AggregationService
+
+
+def stream_record(event_name: str, sequence_number: str, pk: str, sk: str, new_document: str = None,
+                  old_document: str = None):
+    record = {"eventName": event_name,
+              "dynamodb": {"SequenceNumber": sequence_number, "Keys": {"pk": {"S": pk}, "sk": {"S": sk}}}}
+    if new_document:
+        record["dynamodb"]["NewImage"] = {"pk": {"S": pk}, "sk": {"S": sk}, "document": {"S": new_document}}
+    if old_document:
+        record["dynamodb"]["OldImage"] = {"pk": {"S": pk}, "sk": {"S": sk}, "document": {"S": old_document}}
+    return record
+
+
+class TestDynamoDbStreamHandler(unittest.TestCase):
+
+    def test_coalesce_insert_modify(self):
+        v1, v2, v3 = {"id": "1", "v": 1}, {"id": "1", "v": 2}, {"id": "1", "v": 3}
+        self.assertEqual([(["1", "2", "3"], v3, None)],
+                         coalesce_changes([("example#1", "1", v1, None),
+                                           ("example#1", "2", v2, v1),
+                                           ("example#1", "3", v3, v2)]))
+
+    def test_coalesce_modify(self):
+        v1, v2, v3 = {"id": "1", "v": 1}, {"id": "1", "v": 2}, {"id": "1", "v": 3}
+        self.assertEqual([(["1", "2"], v3, v1)],
+                         coalesce_changes([("example#1", "1", v2, v1), ("example#1", "2", v3, v2)]))
+
+    def test_coalesce_remove(self):
+        v1, v2 = {"id": "1", "v": 1}, {"id": "1", "v": 2}
+        self.assertEqual([(["1", "2"], None, v1)],
+                         coalesce_changes([("example#1", "1", v2, v1), ("example#1", "2", None, v2)]))
+
+    def test_coalesce_remove_insert(self):
+        v1, v2 = {"id": "1", "v": 1}, {"id": "1", "v": 2}
+        self.assertEqual([(["1", "2"], v2, v1)],
+                         coalesce_changes([("example#1", "1", None, v1), ("example#1", "2", v2, None)]))
+
+    def test_coalesce_insert_remove(self):
+        v1, v2 = {"id": "1", "v": 1}, {"id": "2", "v": 2}
+        self.assertEqual([(["2"], v2, None)],
+                         coalesce_changes([("example#1", "1", v1, None),
+                                           ("example#2", "2", v2, None),
+                                           ("example#1", "3", None, v1)]))
+
+    def test_coalesce_applied(self):
+        v1, v2, v3 = {"id": "1", "v": 1}, {"id": "1", "v": 2}, {"id": "1", "v": 3}
+        ## the records already added to an aggregation aren't folded with the others
+        self.assertEqual([(["1", "2"], v2, None), (["3"], v3, v2)],
+                         coalesce_changes([("example#1", "1", v1, None),
+                                           ("example#1", "2", v2, v1),
+                                           ("example#1", "3", v3, v2)], {"1": ["count"], "2": ["count"]}))
+
+    @patch.object(AggregationService, "delete_applied_aggregations")
+    @patch.object(AggregationService, "set_applied_aggregations")
+    @patch.object(AggregationService, "get_applied_aggregations")
+    @patch.object(aws.events.dynamodb, "index_batch")
+    def test_handler_retry(self, mock_index_batch, mock_get_applied_aggregations, mock_set_applied_aggregations,
+                           mock_delete_applied_aggregations):
+        mock_get_applied_aggregations.return_value = {"1": ["count"]}
+
+        def index_batch(collection_name, changes, applied):
+            applied[0].add("sum")
+            applied[1].add("count")
+            return [1]
+
+        mock_index_batch.side_effect = index_batch
+        event = {"Records": [
+            stream_record("INSERT", "1", "example#1", "example", '{"id": "1", "v": 1}'),
+            stream_record("INSERT", "2", "example#2", "example", '{"id": "2", "v": 1}'),
+            stream_record("INSERT", "3", "example#3", "example", '{"id": "3", "v": 1}')
+        ]}
+        result = dynamo_stream_handler(event, None)
+        mock_get_applied_aggregations.assert_called_once_with("1")
+        self.assertEqual({"batchItemFailures": [{"itemIdentifier": "2"}]}, result)
+        ## the retry starts with the record 2, the count has been applied to it
+        mock_set_applied_aggregations.assert_called_once_with("2", {"2": ["count"]})
+        mock_delete_applied_aggregations.assert_called_once_with("1")
+
+    @patch.object(AggregationService, "get_applied_aggregations")
+    @patch.object(aws.events.dynamodb, "index_batch")
+    def test_handler(self, mock_index_batch, mock_get_applied_aggregations):
+        mock_get_applied_aggregations.return_value = {}
+        mock_index_batch.return_value = [0]
+        event = {"Records": [
+            stream_record("INSERT", "1", "example#1", "example", '{"id": "1", "v": 1}'),
+            stream_record("INSERT", "2", "example#1", "example#v", '{"id": "1", "v": 1}'),
+            stream_record("MODIFY", "3", "example#1", "example", '{"id": "1", "v": 2}', '{"id": "1", "v": 1}'),
+            stream_record("INSERT", "4", "example#2", "example", '{"id": "2", "v": 1}')
+        ]}
+        result = dynamo_stream_handler(event, None)
+        mock_index_batch.assert_called_once_with("example", [({"id": "1", "v": 2}, None),
+                                                             ({"id": "2", "v": 1}, None)], [set(), set()])
+        self.assertEqual({"batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "3"}]}, result)
+
+    @patch.object(MetadataGeneration, "bump")
+    def test_system_handler(self, mock_bump):
+        event = {"Records": [
+            stream_record("INSERT", "1", "collection#example", "collection", '{"name": "example"}'),
+            stream_record("INSERT", "2", "index#example__v", "index",
+                          '{"name": "example__v", "collection": {"name": "example"}}'),
+            stream_record("INSERT", "3", "collection#other", "collection", '{"name": "other"}'),
+            stream_record("INSERT", "4", "client_authorization#client", "client_authorization", '{}')
+        ]}
+        dynamo_system_stream_handler(event, None)
+        mock_bump.assert_called_once_with(["collection", "index"])
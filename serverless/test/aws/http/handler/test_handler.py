@@ -8,6 +8,7 @@ import boto3
 from moto import mock_dynamodb2
 
 from aws.http.handler.handler_v2 import HttpHandler
+from dynamoplus.v2.service.system.system_service import clear_metadata_cache
 
 
 @mock_dynamodb2
@@ -19,9 +20,11 @@ class TestHttpHandler(unittest.TestCase):
         os.environ["ALLOWED_ORIGINS"] = "http://localhost"
         os.environ["DYNAMODB_DOMAIN_TABLE"] = "example-domain"
         os.environ["DYNAMODB_SYSTEM_TABLE"] = "example-system"
+        os.environ["PAGINATION_CURSOR_SECRET"] = "secret"
         self.dynamodb = boto3.resource("dynamodb", region_name='eu-west-1')
         os.environ["ENTITIES"] = "collection,index,client_authorization"
         self.httpHandler = HttpHandler()
+        clear_metadata_cache()
         self.systemTable = self.getMockTable("example-system")
         self.table = self.getMockTable("example-domain")
 
@@ -63,7 +66,7 @@ class TestHttpHandler(unittest.TestCase):
         self.systemTable.put_item(Item={"pk": "index#example__field1__field2.field21", "sk": "index", "data": "example__field1__field2.field21",
                                         "document": json.loads("{\"uid\": \"1\",\"name\":\"collection.name\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"fields\": [{\"field1\": \"string\"}, {\"field2.field21\": \"string\"}]}")})
         self.systemTable.put_item(Item={"pk": "index#example__field1__field2.field21", "sk": "index#collection.name", "data": "example",
-                                        "document": json.loads("{\"uid\": \"1\",\"name\":\"collection.name\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"fields\": [{\"field1\": \"string\"}, {\"field2.field21\": \"string\"}]}")})
+                                        "document": json.loads("{\"uid\": \"1\",\"name\":\"collection.name\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"field1\",\"field2.field21\"],\"fields\": [{\"field1\": \"string\"}, {\"field2.field21\": \"string\"}]}")})
         self.systemTable.put_item(Item={"pk": "index#example__field1__field2.field21", "sk": "index#collection.name#name", "data": "example#example__field1__field2.field21",
                                         "document": json.loads("{\"uid\": \"1\",\"name\":\"collection.name\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"field1\",\"field2.field21\"],\"fields\": [{\"field1\": \"string\"}, {\"field2.field21\": \"string\"}]}")})
 
@@ -72,6 +75,8 @@ class TestHttpHandler(unittest.TestCase):
                                         "document": json.loads("{\"uid\": \"2\",\"name\":\"even\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"even\"]}")})
         self.systemTable.put_item(Item={"pk": "index#example__even", "sk": "index#name", "data": "example",
                                         "document": json.loads("{\"uid\": \"2\",\"name\":\"even\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"even\"]}")})
+        self.systemTable.put_item(Item={"pk": "index#example__even", "sk": "index#collection.name", "data": "example",
+                                        "document": json.loads("{\"uid\": \"2\",\"name\":\"even\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"even\"]}")})
         self.systemTable.put_item(Item={"pk": "index#example__even", "sk": "index#collection.name#name", "data": "example#example__even",
                                         "document": json.loads("{\"uid\": \"2\",\"name\":\"even\",\"collection\":{\"id_key\":\"id\",\"name\":\"example\"},\"conditions\": [\"even\"]}")})
         ## index 3 - starting
@@ -276,6 +281,170 @@ class TestHttpHandler(unittest.TestCase):
         self.assertIn("Access-Control-Allow-Origin", headers)
         self.assertEqual(origin, headers["Access-Control-Allow-Origin"])
 
+    def test_query_with_cursor_pagination(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        request_body = json.dumps({
+            "matches": {"eq": {"field_name": "even", "value": "1"}}
+        })
+        ids = []
+        query_string_parameters = {"limit": "3"}
+        has_more = True
+        while has_more:
+            result = self.httpHandler.query({"collection": "example"},
+                                            query_string_parameters=query_string_parameters,
+                                            body=request_body)
+            self.assertEqual(result["statusCode"], 200)
+            body = json.loads(result["body"])
+            ids.extend(map(lambda d: d["id"], body["data"]))
+            has_more = body["has_more"]
+            query_string_parameters = {"limit": "3", "start_from": body["last_key"]}
+        self.assertEqual(10, len(ids))
+        self.assertEqual(10, len(set(ids)))
+
+    def test_query_with_residual_conditions(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        ## only "even" is indexed, the title is filtered while reading the index
+        request_body = json.dumps({
+            "matches": {"and": [{"eq": {"field_name": "even", "value": "1"}},
+                                {"eq": {"field_name": "title", "value": "data_3"}}]}
+        })
+        result = self.httpHandler.query({"collection": "example"},
+                                        query_string_parameters={"limit": "2"},
+                                        body=request_body)
+        self.assertEqual(result["statusCode"], 200)
+        body = json.loads(result["body"])
+        self.assertEqual(["3"], list(map(lambda d: d["id"], body["data"])))
+        self.assertEqual(False, body["has_more"])
+
+    def test_query_intersection(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        ## "even" and "starting" have an index each, there is no index on both
+        starting = 1574169491000 / 1000
+        one_day = 60 * 60 * 24
+        request_body = json.dumps({
+            "matches": {"and": [{"eq": {"field_name": "even", "value": "1"}},
+                                {"range": {"field_name": "starting",
+                                           "from": datetime.utcfromtimestamp(starting + one_day * 3).isoformat(),
+                                           "to": datetime.utcfromtimestamp(starting + one_day * 8).isoformat()}}]}
+        })
+        ids = []
+        query_string_parameters = {"limit": "1"}
+        has_more = True
+        while has_more:
+            result = self.httpHandler.query({"collection": "example"},
+                                            query_string_parameters=query_string_parameters,
+                                            body=request_body)
+            self.assertEqual(result["statusCode"], 200)
+            body = json.loads(result["body"])
+            self.assertLessEqual(len(body["data"]), 1)
+            ids.extend(map(lambda d: d["id"], body["data"]))
+            has_more = body["has_more"]
+            query_string_parameters = {"limit": "1", "start_from": body["last_key"]}
+        self.assertEqual(sorted(["3", "5", "7"]), sorted(ids))
+
+    def test_count(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        starting = 1574169491000 / 1000
+        one_day = 60 * 60 * 24
+        queries = [({"eq": {"field_name": "even", "value": "1"}}, 10),
+                   ({"in": {"field_name": "even", "values": ["0", "1"]}}, 20),
+                   ({"and": [{"eq": {"field_name": "even", "value": "1"}},
+                             {"eq": {"field_name": "title", "value": "data_3"}}]}, 1),
+                   ## intersection of the "even" and "starting" indexes
+                   ({"and": [{"eq": {"field_name": "even", "value": "1"}},
+                             {"range": {"field_name": "starting",
+                                        "from": datetime.utcfromtimestamp(starting + one_day * 3).isoformat(),
+                                        "to": datetime.utcfromtimestamp(starting + one_day * 8).isoformat()}}]}, 3)]
+        for matches, expected_count in queries:
+            result = self.httpHandler.query({"collection": "example"},
+                                            body=json.dumps({"matches": matches, "count": True}))
+            self.assertEqual(result["statusCode"], 200)
+            self.assertEqual({"count": expected_count}, json.loads(result["body"]))
+
+    def test_query_with_residual_conditions_limit(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        request_body = json.dumps({
+            "matches": {"and": [{"eq": {"field_name": "even", "value": "1"}},
+                                {"range": {"field_name": "title", "from": "data_1", "to": "data_5"}}]}
+        })
+        ids = []
+        query_string_parameters = {"limit": "2"}
+        has_more = True
+        while has_more:
+            result = self.httpHandler.query({"collection": "example"},
+                                            query_string_parameters=query_string_parameters,
+                                            body=request_body)
+            body = json.loads(result["body"])
+            self.assertLessEqual(len(body["data"]), 2)
+            ids.extend(map(lambda d: d["id"], body["data"]))
+            has_more = body["has_more"]
+            query_string_parameters = {"limit": "2", "start_from": body["last_key"]}
+        ## data_1, data_11 ... data_19, data_3, data_5 are between data_1 and data_5
+        self.assertEqual(sorted(["1", "11", "13", "15", "17", "19", "3", "5"]), sorted(ids))
+
+    def test_query_in_with_cursor_pagination(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        ## two queries on the "even" index, merged by id
+        request_body = json.dumps({
+            "matches": {"in": {"field_name": "even", "values": ["0", "1"]}}
+        })
+        ids = []
+        query_string_parameters = {"limit": "3"}
+        has_more = True
+        while has_more:
+            result = self.httpHandler.query({"collection": "example"},
+                                            query_string_parameters=query_string_parameters,
+                                            body=request_body)
+            self.assertEqual(result["statusCode"], 200)
+            body = json.loads(result["body"])
+            self.assertLessEqual(len(body["data"]), 3)
+            ids.extend(map(lambda d: d["id"], body["data"]))
+            has_more = body["has_more"]
+            query_string_parameters = {"limit": "3", "start_from": body["last_key"]}
+        self.assertEqual(20, len(ids))
+        self.assertEqual(20, len(set(ids)))
+
+    def test_query_with_cursor_of_another_query(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        result = self.httpHandler.query({"collection": "example"}, query_string_parameters={"limit": "3"},
+                                        body=json.dumps({"matches": {"in": {"field_name": "even",
+                                                                            "values": ["0", "1"]}}}))
+        last_key = json.loads(result["body"])["last_key"]
+        result = self.httpHandler.query({"collection": "example"},
+                                        query_string_parameters={"limit": "3", "start_from": last_key},
+                                        body=json.dumps({"matches": {"eq": {"field_name": "even", "value": "1"}}}))
+        self.assertEqual(400, result["statusCode"])
+
+    def test_query_or(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        request_body = json.dumps({
+            "matches": {"or": [{"eq": {"field_name": "even", "value": "1"}},
+                               {"eq": {"field_name": "even", "value": "0"}}]}
+        })
+        result = self.httpHandler.query({"collection": "example"}, body=request_body)
+        self.assertEqual(result["statusCode"], 200)
+        body = json.loads(result["body"])
+        self.assertEqual(20, len(body["data"]))
+
+    def test_query_or_without_index(self):
+        self.fill_sytem_data()
+        self.fill_data()
+        ## title is not indexed
+        request_body = json.dumps({
+            "matches": {"or": [{"eq": {"field_name": "even", "value": "1"}},
+                               {"eq": {"field_name": "title", "value": "data_2"}}]}
+        })
+        result = self.httpHandler.query({"collection": "example"}, body=request_body)
+        self.assertEqual(result["statusCode"], 400)
+
     def test_access_control_allow_origin(self):
         self.fill_sytem_data()
         self.fill_data()
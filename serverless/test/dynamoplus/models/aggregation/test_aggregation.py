@@ -1,6 +1,7 @@
 import unittest
+from decimal import Decimal
 
-from dynamoplus.models.query.conditions import Eq, And
+from dynamoplus.models.query.conditions import Eq, And, Range
 from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, AggregationTrigger
 
 
@@ -23,6 +24,22 @@ class TestAggregation(unittest.TestCase):
                                      And([Eq("active", "true"), Eq("type", "pizzeria")]), None)
         self.assertEqual("restaurant_active_type_true_pizzeria_avg_seat", a.name)
 
+    def test_matcher(self):
+        a = AggregationConfiguration("restaurant", AggregationType.AVG, [AggregationTrigger.INSERT], "seat",
+                                     And([Eq("active", "true"), Eq("type", "pizzeria")]), None)
+        self.assertTrue(a.matcher({"active": True, "type": "pizzeria"}))
+        self.assertFalse(a.matcher({"active": False, "type": "pizzeria"}))
+        ## compiled once
+        self.assertIs(a.matcher, a.matcher)
+
+    def test_matcher_range_excludes_bounds(self):
+        ## the filters of the aggregations have always excluded the bounds, unlike the queries
+        a = AggregationConfiguration("restaurant", AggregationType.COLLECTION_COUNT, [AggregationTrigger.INSERT], None,
+                                     Range("seat", "10", "20"), None)
+        self.assertTrue(a.matcher({"seat": Decimal(15)}))
+        self.assertFalse(a.matcher({"seat": Decimal(10)}))
+        self.assertFalse(a.matcher({"seat": Decimal(20)}))
+
     @unittest.skip("Still implementing")
     def test_list_types(self):
         self.assertEqual(["COLLECTION_COUNT", "AVG", "AVG_JOIN", "SUM", "SUM_COUNT", "MIN", "MAX"],
@@ -1,7 +1,9 @@
 import unittest
+from decimal import Decimal
 
 from dynamoplus.models.query.conditions import And, Range, Eq, get_range_predicate, is_valid, \
-    get_field_names_in_order, AnyMatch, match_predicate
+    get_field_names_in_order, AnyMatch, match_predicate, Or, In, expand_disjunctions, \
+    compile_predicate
 
 
 class TestConditions(unittest.TestCase):
@@ -100,3 +102,46 @@ class TestConditions(unittest.TestCase):
             [Eq("fieldA", "valueA"), Eq("fieldB", "valueB"), Range("fieldC", "valueD1", "valueD2")])
         field_names = get_field_names_in_order(nested)
         self.assertEqual(["fieldA", "fieldB", "fieldC"], field_names)
+
+    def test_expand_disjunctions(self):
+        predicate = And([Eq("fieldA", "valueA"), In("fieldB", ["value1", "value2"])])
+        self.assertEqual([And([Eq("fieldA", "valueA"), Eq("fieldB", "value1")]),
+                          And([Eq("fieldA", "valueA"), Eq("fieldB", "value2")])], expand_disjunctions(predicate))
+        predicate = Or([Eq("fieldA", "valueA"), And([Eq("fieldB", "valueB"), Range("fieldC", "value1", "value2")])])
+        self.assertEqual([Eq("fieldA", "valueA"), And([Eq("fieldB", "valueB"), Range("fieldC", "value1", "value2")])],
+                         expand_disjunctions(predicate))
+        self.assertEqual([Eq("fieldA", "valueA")], expand_disjunctions(Eq("fieldA", "valueA")))
+
+    def test_match_predicate_or_in(self):
+        document = {"field1": "value1", "field2": "value2"}
+        self.assertTrue(match_predicate(document, Or([Eq("field1", "valueX"), Eq("field2", "value2")])))
+        self.assertFalse(match_predicate(document, Or([Eq("field1", "valueX"), Eq("field2", "valueX")])))
+        self.assertTrue(match_predicate(document, In("field1", ["valueX", "value1"])))
+        self.assertFalse(match_predicate(document, In("field1", ["valueX", "valueY"])))
+
+    def test_compiled_predicate_nested_fields(self):
+        matcher = compile_predicate(And([Eq("address.city", "Rome"), Range("address.number", "1", "10")]))
+        self.assertTrue(matcher({"address": {"city": "Rome", "number": Decimal(2)}}))
+        self.assertFalse(matcher({"address": {"city": "Rome", "number": Decimal(20)}}))
+        self.assertFalse(matcher({"address": {"city": "Rome"}}))
+        self.assertFalse(matcher({"address": "Rome"}))
+
+    def test_compiled_predicate_typed_comparisons(self):
+        ## as strings "2" > "10"
+        self.assertTrue(compile_predicate(Range("price", "1", "10"))({"price": Decimal(2)}))
+        self.assertTrue(compile_predicate(Eq("price", "10"))({"price": Decimal("10.0")}))
+        self.assertTrue(compile_predicate(In("price", ["5", "10"]))({"price": 10}))
+        self.assertTrue(compile_predicate(Eq("flag", "true"))({"flag": True}))
+        self.assertTrue(compile_predicate(Eq("flag", "True"))({"flag": True}))
+        self.assertFalse(compile_predicate(Eq("tags", "a"))({"tags": ["a"]}))
+
+    def test_compiled_range_includes_bounds(self):
+        matcher = compile_predicate(Range("field1", "value1", "value2"))
+        self.assertTrue(matcher({"field1": "value1"}))
+        self.assertTrue(matcher({"field1": "value2"}))
+        self.assertFalse(matcher({"field1": "value3"}))
+        matcher = compile_predicate(Or([Eq("field2", "a"), Range("field1", "value1", "value2")]),
+                                    inclusive_ranges=False)
+        self.assertFalse(matcher({"field1": "value1"}))
+        self.assertFalse(matcher({"field1": "value2"}))
+        self.assertTrue(matcher({"field1": "value15"}))
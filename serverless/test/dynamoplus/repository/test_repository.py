@@ -1,7 +1,9 @@
+import threading
 import unittest
 from decimal import Decimal
 
-from dynamoplus.v2.repository.repositories import Repository, Model, QueryRepository, AtomicIncrement, Counter
+from dynamoplus.v2.repository.repositories import Repository, Model, QueryRepository, AtomicIncrement, Counter, \
+    ShardedKey, get_shard, get_shard_sk, get_table
 from dynamoplus.models.system.collection.collection import Collection
 from moto import mock_dynamodb2
 import json
@@ -168,6 +170,65 @@ class TestDynamoPlusRepository(unittest.TestCase):
         result = repository.get("example#1234", "example")
         self.assertIsNone(result)
 
+    def test_batch_write(self):
+        repository = Repository(table_name)
+        self.table.put_item(
+            Item={"pk": "example#0", "sk": "example#attribute1", "data": "0", "document": {"id": "0"}})
+        puts = [Model("example#" + str(i), "example#attribute1", str(i % 2), {"id": str(i), "attribute1": str(i % 2)})
+                for i in range(1, 31)]
+        repository.batch_write(puts, [Model("example#0", "example#attribute1", None, None)])
+        result = self.table.scan()
+        self.assertEqual(len(result["Items"]), 30)
+        self.assertNotIn("example#0", map(lambda i: i["pk"], result["Items"]))
+
+    def test_batch_write_put_wins_over_delete(self):
+        repository = Repository(table_name)
+        model = Model("example#1", "example#attribute1", "1", {"id": "1", "attribute1": "1"})
+        repository.batch_write([model], [Model("example#1", "example#attribute1", "0", None)])
+        result = repository.get("example#1", "example#attribute1")
+        self.assertEqual(result, model)
+
+    def test_batch_get(self):
+        repository = Repository(table_name)
+        for i in range(1, 120):
+            self.table.put_item(
+                Item={"pk": "example#" + str(i), "sk": "example", "data": str(i), "document": {"id": str(i)}})
+        keys = [("example#" + str(i), "example") for i in range(119, 0, -1)]
+        result = repository.batch_get(keys + [("example#missing", "example")])
+        self.assertEqual(len(result), 120)
+        self.assertEqual(list(map(lambda m: m.pk, result[0:119])), list(map(lambda k: k[0], keys)))
+        self.assertEqual(result[0].document, {"id": "119"})
+        self.assertIsNone(result[119])
+
+    def test_table_is_shared(self):
+        self.assertIs(Repository(table_name).table, QueryRepository(table_name).table)
+        self.assertIs(get_table(table_name), Repository(table_name).table)
+
+    def test_table_is_per_thread(self):
+        tables = []
+        thread = threading.Thread(target=lambda: tables.append(Repository(table_name).table))
+        thread.start()
+        thread.join()
+        self.assertIsNot(tables[0], Repository(table_name).table)
+        self.assertEqual(tables[0].name, Repository(table_name).table.name)
+
+    def test_add_counters(self):
+        repository = Repository(table_name)
+        repository.add_counters("example#counters", "example", {"a": Decimal(1), "b#c": Decimal(2)})
+        repository.add_counters("example#counters", "example", {"a": Decimal(1)})
+        self.assertEqual({"a": Decimal(2), "b#c": Decimal(2)}, repository.get_counters("example#counters", "example"))
+        self.assertEqual({}, repository.get_counters("example#missing", "example"))
+
+    def test_add_to_document(self):
+        repository = Repository(table_name)
+        model = Model("aggregation#example", "aggregation", "example", {"name": "example"})
+        result, created = repository.add_to_document(model, {"count": Decimal(1), "sum": Decimal(3)})
+        self.assertTrue(created)
+        result, created = repository.add_to_document(model, {"count": Decimal(1), "sum": Decimal(-1)})
+        self.assertFalse(created)
+        self.assertEqual({"name": "example", "count": Decimal(2), "sum": Decimal(2)}, result.document)
+        self.assertEqual(result, repository.get("aggregation#example", "aggregation"))
+
     def test_get(self):
         document = {"id": "1234", "attribute1": "value1", "ordering": "1", "field1": "A", "field2": "B"}
         self.table.put_item(
@@ -301,3 +362,44 @@ class TestDynamoPlusRepository(unittest.TestCase):
         self.assertEqual("1", result.data[2].document["attribute1"])
         self.assertEqual("value_00000025", result.data[2].document["attribute2"])
         self.assertEqual("00000025", result.data[2].document["attribute3"])
+
+    def test_query_shards(self):
+        for i in range(1, 21):
+            document = {"id": f"{i:08}", "attribute1": str(i % 2)}
+            pk = "example#" + document["id"]
+            self.table.put_item(Item={"pk": pk, "sk": get_shard_sk("example#attribute1", get_shard(pk, 4)),
+                                      "data": str(i % 2) + "#" + document["id"], "document": document})
+        repository = QueryRepository(table_name)
+        ids = []
+        last_key = None
+        while True:
+            result = repository.query_begins_with("example#attribute1", "1", last_key, 3, shards=4)
+            self.assertLessEqual(len(result.data), 3)
+            ids.extend(map(lambda m: m.document["id"], result.data))
+            last_key = result.lastEvaluatedKey
+            if last_key is None:
+                break
+            self.assertIsInstance(last_key, ShardedKey)
+        self.assertEqual([f"{i:08}" for i in range(19, 0, -2)], ids)
+
+    def test_count_shards(self):
+        for i in range(1, 21):
+            pk = "example#" + f"{i:08}"
+            self.table.put_item(Item={"pk": pk, "sk": get_shard_sk("example#attribute1", get_shard(pk, 4)),
+                                      "data": str(i % 2) + "#" + f"{i:08}", "document": {"id": f"{i:08}"}})
+        repository = QueryRepository(table_name)
+        self.assertEqual(10, repository.count_begins_with("example#attribute1", "1", shards=4))
+        self.assertEqual(20, repository.count_all("example#attribute1", shards=4))
+        self.assertEqual(3, repository.count_range("example#attribute1", "0#00000002", "0#00000006", shards=4))
+        self.assertEqual(0, repository.count_begins_with("example#attribute1", "1"))
+
+    def test_query_shards_ascending(self):
+        for i in range(1, 21):
+            pk = "example#" + f"{i:08}"
+            self.table.put_item(Item={"pk": pk, "sk": get_shard_sk("example", get_shard(pk, 3)), "data": f"{i:08}",
+                                      "document": {"id": f"{i:08}"}})
+        repository = QueryRepository(table_name)
+        first_page = repository.query_all("example", None, 5, shards=3, ascending=True)
+        second_page = repository.query_all("example", first_page.lastEvaluatedKey, 5, shards=3, ascending=True)
+        self.assertEqual([f"{i:08}" for i in range(1, 11)],
+                         list(map(lambda m: m.data, first_page.data + second_page.data)))
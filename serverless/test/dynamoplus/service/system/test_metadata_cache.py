@@ -0,0 +1,56 @@
+import os
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from dynamoplus.v2.repository.repositories import Repository
+from dynamoplus.v2.service.system.metadata_cache import MetadataGeneration, collection_cache, index_cache, \
+    clear_metadata_cache
+
+domain_table_name = "domain"
+system_table_name = "system"
+
+
+class TestMetadataGeneration(unittest.TestCase):
+
+    def setUp(self):
+        os.environ["DYNAMODB_DOMAIN_TABLE"] = domain_table_name
+        os.environ["DYNAMODB_SYSTEM_TABLE"] = system_table_name
+        clear_metadata_cache()
+
+    @patch.object(Repository, "get_counters")
+    @patch.object(Repository, "__init__")
+    def test_check_evicts_changed_entries(self, mock_repository, mock_get_counters):
+        mock_repository.return_value = None
+        generation = MetadataGeneration(0.000001)
+        mock_get_counters.return_value = {"generation": Decimal(2), "collection": Decimal(1), "index": Decimal(1),
+                                          "collection#example": Decimal(1)}
+        generation.check()
+        collection_cache.put("example", "collection")
+        collection_cache.put("other", "collection")
+        index_cache.put("example", ["index"])
+        mock_get_counters.return_value = {"generation": Decimal(3), "collection": Decimal(2), "index": Decimal(1),
+                                          "collection#example": Decimal(1)}
+        generation.check()
+        self.assertIsNone(collection_cache.get("example"))
+        self.assertIsNone(collection_cache.get("other"))
+        self.assertEqual(["index"], index_cache.get("example"))
+
+    @patch.object(Repository, "get_counters")
+    @patch.object(Repository, "__init__")
+    def test_check_at_most_once_per_interval(self, mock_repository, mock_get_counters):
+        mock_repository.return_value = None
+        mock_get_counters.return_value = {}
+        generation = MetadataGeneration(60)
+        generation.check()
+        generation.check()
+        self.assertEqual(1, mock_get_counters.call_count)
+
+    @patch.object(Repository, "add_counters")
+    @patch.object(Repository, "__init__")
+    def test_bump(self, mock_repository, mock_add_counters):
+        mock_repository.return_value = None
+        MetadataGeneration.bump(["collection", "document"])
+        mock_repository.assert_called_once_with(system_table_name)
+        mock_add_counters.assert_called_once_with("metadata_generation#metadata", "metadata_generation",
+                                                  {"collection": Decimal(1), "generation": Decimal(1)})
@@ -2,10 +2,10 @@ import os
 import unittest
 from decimal import Decimal
 
-from dynamoplus.models.query.conditions import Eq, And, AnyMatch, Predicate, FieldMatch
+from dynamoplus.models.query.conditions import Eq, And, AnyMatch, Predicate, FieldMatch, In, Or, Range
 from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, \
     AggregationTrigger, \
-    AggregationJoin, Aggregation, AggregationCount
+    AggregationJoin, Aggregation, AggregationCount, AggregationAvg, AggregationSum
 from dynamoplus.models.system.collection.collection import Collection
 from dynamoplus.models.system.index.index import Index, IndexConfiguration
 from dynamoplus.models.system.client_authorization.client_authorization import ClientAuthorizationHttpSignature, \
@@ -14,10 +14,11 @@ from dynamoplus.models.system.client_authorization.client_authorization import C
 from mock import call
 from unittest.mock import patch
 
-from dynamoplus.v2.repository.repositories import Model, Repository, QueryResult, AtomicIncrement, Counter
+from dynamoplus.v2.repository.repositories import Model, Repository, QueryResult, AtomicIncrement, Counter, \
+    QueryRepository
 from dynamoplus.v2.service.query_service import QueryService
 from dynamoplus.v2.service.system.system_service import AuthorizationService, CollectionService, IndexService, \
-    Converter
+    Converter, clear_metadata_cache, get_metadata_cache_stats
 from dynamoplus.v2.service.system.system_service import AggregationConfigurationService
 
 domain_table_name = "domain"
@@ -29,6 +30,7 @@ class TestSystemService(unittest.TestCase):
     def setUp(self):
         os.environ["DYNAMODB_DOMAIN_TABLE"] = domain_table_name
         os.environ["DYNAMODB_SYSTEM_TABLE"] = system_table_name
+        clear_metadata_cache()
 
     def test_convert_aggregation_configuration(self):
         collection_name = "example"
@@ -78,6 +80,30 @@ class TestSystemService(unittest.TestCase):
         aggregation_result = Converter.from_dict_to_aggregation_configuration(expected)
         self.assertEqual(aggregation, aggregation_result)
 
+    def test_aggregation_configuration_with_in_match(self):
+        predicate = And([In("status", ["open", "closed"]), Or([Eq("field_x", "value1"),
+                                                                Range("field_y", "a", "b")])])
+        aggregation = AggregationConfiguration("example", AggregationType.COLLECTION_COUNT,
+                                               [AggregationTrigger.INSERT], None, predicate, None)
+        d = Converter.from_aggregation_configuration_to_dict(aggregation)
+        self.assertEqual({"field_name": "status", "values": ["open", "closed"]},
+                         d["aggregation"]["matches"]["and"][0]["in"])
+        self.assertEqual(predicate, Converter.from_dict_to_aggregation_configuration(d).matches)
+
+    def test_from_dict_to_aggregation(self):
+        document = {"name": "example_avg_rate", "configuration_name": "example_avg_rate", "type": "AVG",
+                    "count": Decimal(4), "sum": Decimal(10)}
+        self.assertEqual(AggregationAvg("example_avg_rate", "example_avg_rate", Decimal("2.5")),
+                         Converter.from_dict_to_aggregation(document))
+        self.assertEqual(AggregationSum("example_sum_rate", "example_sum_rate", Decimal(10)),
+                         Converter.from_dict_to_aggregation({**document, "name": "example_sum_rate",
+                                                             "configuration_name": "example_sum_rate",
+                                                             "type": "SUM"}))
+        self.assertEqual(AggregationCount("example_collection_count", "example_collection_count", Decimal(4)),
+                         Converter.from_dict_to_aggregation({"name": "example_collection_count",
+                                                             "configuration_name": "example_collection_count",
+                                                             "type": "COLLECTION_COUNT", "count": Decimal(4)}))
+
     # def test_from_aggregation_configuration_to_API(self):
     #     aggregation_configuration = AggregationConfiguration("example",AggregationType.COLLECTION_COUNT,[AggregationTrigger.INSERT,AggregationTrigger.DELETE],"field1",AnyMatch(),AggregationJoin("example_2","field2"))
     #     aggregation = AggregationCount("example_count","exampel_count",40)
@@ -247,6 +273,24 @@ class TestSystemService(unittest.TestCase):
         mock_repository.assert_called_once_with(system_table_name)
         self.assertTrue(mock_get.called_with(expected_id))
 
+    @patch.object(Repository, "create")
+    @patch.object(Repository, "get")
+    @patch.object(Repository, "__init__")
+    def test_getCollection_cached(self, mock_repository, mock_get, mock_create):
+        expected_id = 'example'
+        mock_repository.return_value = None
+        document = {"name": expected_id, "id_key": "id"}
+        mock_get.return_value = Model("collection#" + expected_id, "collection", expected_id, document)
+        mock_create.return_value = Model("collection#" + expected_id, "collection", expected_id, document)
+        hits = get_metadata_cache_stats()["collection"]["hits"]
+        CollectionService.get_collection(expected_id)
+        CollectionService.get_collection(expected_id)
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(hits + 1, get_metadata_cache_stats()["collection"]["hits"])
+        CollectionService.create_collection(Collection(expected_id, "id"))
+        CollectionService.get_collection(expected_id)
+        self.assertEqual(2, mock_get.call_count)
+
     @patch.object(QueryService, "query")
     @patch.object(Repository, "create")
     @patch.object(Repository, "__init__")
@@ -314,17 +358,21 @@ class TestSystemService(unittest.TestCase):
             call(index_metadata, Eq("collection.name", collection_name), index_by_collection_metadata, None, 20),
             mock_query.call_args_list[0])
 
-    @patch.object(QueryService, "query")
-    def test_queryIndex_by_CollectionByName_generator(self, mock_query):
-        mock_query.side_effect = [
+    @patch.object(QueryRepository, "query_range")
+    @patch.object(QueryRepository, "__init__")
+    def test_queryIndex_by_CollectionByName_generator(self, mock_query_repository, mock_query_range):
+        mock_query_repository.return_value = None
+        pages = [
             self.fake_query_result_index("example__field1", ["field1"], "example", "example__field2"),
             self.fake_query_result_index("example__field2", ["field2"], "example", "example__field3"),
             self.fake_query_result_index("example__field3", ["field3"], "example", "example__field4"),
             self.fake_query_result_index("example__field4", ["field4"], "example", "example__field5"),
             self.fake_query_result_index("example__field5", ["field5"], "example")
         ]
-        index_metadata = Collection("index", "name")
-        index_by_collection_metadata = Index(index_metadata.name, ["collection.name"], None)
+        for p in pages:
+            p.lastEvaluatedKey = Model("index#" + p.lastEvaluatedKey, "index", p.lastEvaluatedKey,
+                                       None) if p.lastEvaluatedKey else None
+        mock_query_range.side_effect = pages
         collection_name = "example"
         indexes = IndexService.get_indexes_from_collection_name_generator(collection_name, 2)
         names = list(map(lambda i: i.index_name, indexes))
@@ -332,8 +380,10 @@ class TestSystemService(unittest.TestCase):
         self.assertEqual(
             ["example__field1", "example__field2", "example__field3", "example__field4", "example__field5"], names)
         self.assertEqual(
-            call(index_metadata, Eq("collection.name", collection_name), index_by_collection_metadata, None, 2),
-            mock_query.call_args_list[0])
+            [call("index#collection.name", "example", "example", 2, None, shards=None)] +
+            [call("index#collection.name", "example", "example", 2, p.lastEvaluatedKey, shards=None)
+             for p in pages[:-1]],
+            mock_query_range.call_args_list)
 
     #
     #
@@ -347,14 +397,22 @@ class TestSystemService(unittest.TestCase):
     #     mock_get_index.assert_has_calls(calls)
     #
 
-    @patch('dynamoplus.v2.service.system.system_service.IndexService.get_index_by_name_and_collection_name')
-    def test_find_index_matching_fields_not_found(self, mock_get_index_by_name_and_collection_name):
-        mock_get_index_by_name_and_collection_name.side_effect = [None, None, None]
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    def test_find_index_matching_fields_not_found(self, mock_get_indexes_from_collection_name_generator):
+        mock_get_indexes_from_collection_name_generator.return_value = [Index("example", ["field4"]),
+                                                                          Index("example", ["field4", "field1"])]
         index = IndexService.get_index_matching_fields(["field1", "field2", "field3"], "example")
         self.assertIsNone(index)
-        calls = [call("example__field1__field2__field3", "example"), call("example__field1__field2", "example"),
-                 call("example__field1", "example")]
-        mock_get_index_by_name_and_collection_name.assert_has_calls(calls)
+        mock_get_indexes_from_collection_name_generator.assert_called_once_with("example")
+
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    def test_find_index_matching_fields(self, mock_get_indexes_from_collection_name_generator):
+        expected_index = Index("example", ["field1", "field2"])
+        mock_get_indexes_from_collection_name_generator.return_value = [Index("example", ["field1"]),
+                                                                          expected_index,
+                                                                          Index("example", ["field2", "field3"])]
+        index = IndexService.get_index_matching_fields(["field1", "field2", "field3"], "example")
+        self.assertEqual(expected_index, index)
 
     @patch.object(Repository, "create")
     @patch.object(Repository, "__init__")
@@ -483,7 +541,7 @@ class TestSystemService(unittest.TestCase):
                                                                [AggregationTrigger.INSERT], "whatever", None, None)
 
         aggregation_metadata = Collection("aggregation_configuration", "name")
-        aggregations, last_key = AggregationConfigurationService.get_all_aggregation_configurations(20, None)
+        aggregations, last_key = AggregationConfigurationService.get_all_aggregation_configurations(20, "last")
 
         names = list(map(lambda a: a.name, aggregations))
         self.assertEqual(3, len(names))
@@ -491,8 +549,8 @@ class TestSystemService(unittest.TestCase):
             call(aggregation_metadata,
                  AnyMatch(),
                  None,
-                 20,
-                 None),
+                 "last",
+                 20),
             mock_query.call_args_list[0])
         self.assertEqual(3, mock_converter.call_count)
 
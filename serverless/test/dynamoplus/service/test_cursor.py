@@ -0,0 +1,53 @@
+import os
+import unittest
+
+from dynamoplus.v2.repository.repositories import Model, ShardedKey, CompositeKey
+from dynamoplus.v2.service.cursor import encode_cursor, decode_cursor
+
+
+class TestCursor(unittest.TestCase):
+
+    def setUp(self):
+        os.environ["PAGINATION_CURSOR_SECRET"] = "secret"
+
+    def test_encode_decode(self):
+        last_key = Model("example#1", "example#name", "my_name#1", None)
+        cursor = encode_cursor(last_key)
+        self.assertNotIn("example", cursor)
+        self.assertEqual(last_key, decode_cursor(cursor))
+
+    def test_encode_decode_sharded_key(self):
+        last_key = ShardedKey("example#name", [Model("example#1", "example#name@0", "my_name#1", None), None,
+                                               Model("example#5", "example#name@2", "my_name#5", None)], [1])
+        self.assertEqual(last_key, decode_cursor(encode_cursor(last_key)))
+
+    def test_encode_decode_composite_key(self):
+        last_key = CompositeKey([Model("example#1", "example#even", "1#1", None), None,
+                                 ShardedKey("example#even", [Model("example#3", "example#even@0", "2#3", None), None],
+                                            [1])], [1])
+        self.assertEqual(last_key, decode_cursor(encode_cursor(last_key)))
+
+    def test_none(self):
+        self.assertIsNone(encode_cursor(None))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_document_id_is_not_a_cursor(self):
+        self.assertIsNone(decode_cursor("3"))
+        self.assertIsNone(decode_cursor("my.document.id"))
+
+    def test_tampered_cursor(self):
+        cursor = encode_cursor(Model("example#1", "example", "1", None))
+        payload, signature = cursor.split(".")
+        forged = encode_cursor(Model("other#1", "other", "1", None)).split(".")[0]
+        self.assertIsNone(decode_cursor("{}.{}".format(forged, signature)))
+        os.environ["PAGINATION_CURSOR_SECRET"] = "another_secret"
+        self.assertIsNone(decode_cursor(cursor))
+
+    def test_missing_secret(self):
+        del os.environ["PAGINATION_CURSOR_SECRET"]
+        jwt_secret = os.environ.pop("JWT_SECRET", None)
+        try:
+            self.assertRaises(Exception, encode_cursor, Model("example#1", "example", "1", None))
+        finally:
+            if jwt_secret is not None:
+                os.environ["JWT_SECRET"] = jwt_secret
@@ -1,8 +1,22 @@
 import unittest
 import logging
 import uuid
+from decimal import Decimal
 
 from dynamoplus.dynamo_plus_v2 import create
+from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, \
+    AggregationTrigger, AggregationSum, AggregationMax, AggregationMin
+from dynamoplus.models.query.conditions import Eq, Range, compile_predicate
+from dynamoplus.models.system.collection.collection import Collection, AttributeDefinition, AttributeType
+from dynamoplus.models.system.index.index import Index, IndexConfiguration
+from dynamoplus.v2.indexing_service_v2 import index_batch, reindex
+from dynamoplus.v2.repository.repositories import Repository, Model
+from dynamoplus.v2.service.domain.domain_service import DomainService
+from dynamoplus.v2.service.key_encoding import encode_number, encode_date
+from dynamoplus.v2.service.query_planner import QueryPlan
+from dynamoplus.v2.service.query_service import QueryService
+from dynamoplus.v2.service.system.system_service import clear_metadata_cache, AggregationService, \
+    AggregationConfigurationService, CollectionService, IndexService
 
 from moto import mock_dynamodb2
 import boto3
@@ -21,6 +35,7 @@ class TestDynamoPlusService(unittest.TestCase):
         os.environ["DYNAMODB_SYSTEM_TABLE"] = system_table_name
         self.dynamodb = boto3.resource("dynamodb", region_name='eu-west-1')
         os.environ["ENTITIES"] = "collection,index,client_authorization"
+        clear_metadata_cache()
         self.system_table = self.getMockTable(system_table_name)
         self.domain_table = self.getMockTable(domain_table_name)
         # self.fillSystemData()
@@ -134,6 +149,235 @@ class TestDynamoPlusService(unittest.TestCase):
         response = create("client_authorization", http_signature_client_authorization)
         print("{}".format(response))
 
+    def test_query_with_number_residual(self):
+        collection = CollectionService.create_collection(
+            Collection("example", "id", None, [AttributeDefinition("price", AttributeType.NUMBER)]))
+        documents = [{"id": "1", "name": "a", "price": Decimal(10)},
+                     {"id": "2", "name": "a", "price": Decimal(25)},
+                     {"id": "3", "name": "b", "price": Decimal(10)}]
+        for d in documents:
+            DomainService(collection).create_document(d)
+        for configuration in [IndexConfiguration.OPTIMIZE_READ, IndexConfiguration.OPTIMIZE_WRITE]:
+            index = Index("example", ["name"], configuration)
+            IndexService.create_index(index)
+            self.assertEqual([], index_batch("example", list(map(lambda d: (d, None), documents))))
+            ## the values of the query are strings, the prices are stored as numbers
+            for residual, expected in [(Eq("price", "10"), ["1"]), (Range("price", "5", "20"), ["1"]),
+                                       (Range("price", "11", "30"), ["2"])]:
+                result = QueryService.query(collection, Eq("name", "a"), index, None, 20, residual)
+                self.assertEqual(expected, list(map(lambda m: m.document["id"], result.data)))
+                self.assertEqual(1, QueryService.count(collection, Eq("name", "a"), index, residual))
+            IndexService.delete_index(index.index_name)
+
+    def test_query_with_residual_on_sharded_index(self):
+        collection = CollectionService.create_collection(
+            Collection("example", "id", None, [AttributeDefinition("price", AttributeType.NUMBER)]))
+        documents = [{"id": str(i), "name": "a", "price": Decimal(i % 3)} for i in range(33)]
+        for d in documents:
+            DomainService(collection).create_document(d)
+        for configuration in [IndexConfiguration.OPTIMIZE_READ, IndexConfiguration.OPTIMIZE_WRITE]:
+            index = Index("example", ["name"], configuration, shards=3)
+            IndexService.create_index(index)
+            self.assertEqual([], index_batch("example", list(map(lambda d: (d, None), documents))))
+            ids = []
+            last_key = None
+            ## 22 documents match, the pages can't be more than the rows
+            for _ in range(len(documents)):
+                result = QueryService.query(collection, Eq("name", "a"), index, last_key, 5, Range("price", "1", "2"))
+                ids.extend(map(lambda m: m.document["id"], result.data))
+                last_key = result.lastEvaluatedKey
+                if last_key is None:
+                    break
+            self.assertIsNone(last_key)
+            self.assertEqual(sorted(d["id"] for d in documents if d["price"] > 0), sorted(ids))
+            IndexService.delete_index(index.index_name)
+
+    def test_query_union_on_sharded_index(self):
+        collection = CollectionService.create_collection(
+            Collection("example", "id", None, [AttributeDefinition("n", AttributeType.NUMBER)]))
+        documents = [{"id": str(i), "s": ["a", "b", "c"][i % 3], "n": Decimal(i)} for i in range(72)]
+        for d in documents:
+            DomainService(collection).create_document(d)
+        index = Index("example", ["s"], ordering_key="n", shards=3)
+        IndexService.create_index(index)
+        self.assertEqual([], index_batch("example", list(map(lambda d: (d, None), documents))))
+        plans = [QueryPlan(index, Eq("s", "a"), None, "a"), QueryPlan(index, Eq("s", "b"), None, "b")]
+        for ascending in [True, False]:
+            ids = []
+            last_key = None
+            for _ in range(len(documents)):
+                result = QueryService.query_union(collection, plans, last_key, 3, ascending)
+                ids.extend(map(lambda m: m.document["id"], result.data))
+                last_key = result.lastEvaluatedKey
+                if last_key is None:
+                    break
+            self.assertIsNone(last_key)
+            expected = [d["id"] for d in sorted(documents, key=lambda d: d["n"], reverse=not ascending)
+                        if d["s"] in ["a", "b"]]
+            self.assertEqual(expected, ids)
+
+    def test_query_value_prefix_of_another(self):
+        documents = [{"id": "1", "status": "open", "type": "a", "n": Decimal(1)},
+                     {"id": "2", "status": "opened", "type": "a", "n": Decimal(2)},
+                     {"id": "3", "status": "open"},
+                     {"id": "4", "status": "opened"}]
+        ## the index rows of an index are identified by its fields, a collection for each index
+        for name, fields, ordering_key in [("exact", ["status"], None), ("ordered", ["status"], "n"),
+                                           ("prefix", ["status", "type"], None)]:
+            collection = CollectionService.create_collection(
+                Collection(name, "id", None, [AttributeDefinition("n", AttributeType.NUMBER)]))
+            for d in documents:
+                DomainService(collection).create_document(d)
+            index = Index(name, fields, ordering_key=ordering_key)
+            IndexService.create_index(index)
+            self.assertEqual([], index_batch(name, list(map(lambda d: (d, None), documents))))
+            result = QueryService.query(collection, Eq("status", "open"), index, None, 20)
+            ## the documents without the ordering value or the second field are in the index too
+            self.assertEqual(["1", "3"], sorted(map(lambda m: m.document["id"], result.data)))
+            self.assertEqual(2, QueryService.count(collection, Eq("status", "open"), index))
+
+    def test_reindex(self):
+        CollectionService.create_collection(Collection("example", "id", "created_at",
+                                                       [AttributeDefinition("price", AttributeType.NUMBER),
+                                                        AttributeDefinition("created_at", AttributeType.DATE)]))
+        IndexService.create_index(Index("example", ["price"]))
+        ## rows written with the encoding of the values before the typed one
+        for i in range(3):
+            document = {"id": str(i), "price": Decimal(i * 10), "created_at": "2020-01-0{}T10:00:00".format(i + 1)}
+            self.domain_table.put_item(Item={"pk": "example#" + str(i), "sk": "example",
+                                             "data": document["created_at"], "document": document})
+            self.domain_table.put_item(Item={"pk": "example#" + str(i), "sk": "example#price",
+                                             "data": str(i * 10),
+                                             "document": document})
+        last_key = reindex("example", None, 2)
+        self.assertIsNotNone(last_key)
+        self.assertIsNone(reindex("example", last_key, 2))
+        for i in range(3):
+            created_at = encode_date("2020-01-0{}T10:00:00".format(i + 1))
+            self.assertEqual(created_at, self.domain_table.get_item(
+                Key={"pk": "example#" + str(i), "sk": "example"})["Item"]["data"])
+            self.assertEqual(encode_number(i * 10), self.domain_table.get_item(
+                Key={"pk": "example#" + str(i), "sk": "example#price"})["Item"]["data"])
+
+    def test_max_and_min_aggregations(self):
+        CollectionService.create_collection(Collection("example", "id", None,
+                                                       [AttributeDefinition("amount", AttributeType.NUMBER)]))
+        maximum = AggregationConfiguration("example", AggregationType.MAX,
+                                           [AggregationTrigger.INSERT, AggregationTrigger.UPDATE,
+                                            AggregationTrigger.DELETE], "amount", None, None)
+        minimum = AggregationConfiguration("example", AggregationType.MIN,
+                                           [AggregationTrigger.INSERT, AggregationTrigger.UPDATE,
+                                            AggregationTrigger.DELETE], "amount", None, None)
+        AggregationConfigurationService.create_aggregation_configuration(maximum)
+        AggregationConfigurationService.create_aggregation_configuration(minimum)
+        self.assertTrue(IndexService.is_locked("example__amount"))
+
+        self.assertEqual([], index_batch("example", [({"id": "1", "amount": 5}, None),
+                                                     ({"id": "2", "amount": 90}, None),
+                                                     ({"id": "3", "amount": 7}, None),
+                                                     ({"id": "4"}, None)]))
+        self.assertEqual(AggregationMax(maximum.name, maximum.name, Decimal(90)),
+                         AggregationService.get_aggregation_by_name(maximum.name))
+        self.assertEqual(AggregationMin(minimum.name, minimum.name, Decimal(5)),
+                         AggregationService.get_aggregation_by_name(minimum.name))
+
+        ## the extremes are removed, the new ones are read from the index
+        self.assertEqual([], index_batch("example", [(None, {"id": "2", "amount": 90}),
+                                                     ({"id": "1", "amount": 6}, {"id": "1", "amount": 5})]))
+        self.assertEqual(AggregationMax(maximum.name, maximum.name, Decimal(7)),
+                         AggregationService.get_aggregation_by_name(maximum.name))
+        self.assertEqual(AggregationMin(minimum.name, minimum.name, Decimal(6)),
+                         AggregationService.get_aggregation_by_name(minimum.name))
+
+        self.assertEqual([], index_batch("example", [(None, {"id": "1", "amount": 6}),
+                                                     (None, {"id": "3", "amount": 7})]))
+        self.assertEqual(AggregationMax(maximum.name, maximum.name, None),
+                         AggregationService.get_aggregation_by_name(maximum.name))
+
+    def test_max_aggregation_with_matches(self):
+        CollectionService.create_collection(Collection("example", "id", None,
+                                                       [AttributeDefinition("amount", AttributeType.NUMBER)]))
+        ## the index of the target field was already there
+        IndexService.create_index(Index("example", ["amount"]))
+        maximum = AggregationConfiguration("example", AggregationType.MAX,
+                                           [AggregationTrigger.INSERT, AggregationTrigger.UPDATE,
+                                            AggregationTrigger.DELETE], "amount", Eq("status", "open"), None)
+        AggregationConfigurationService.create_aggregation_configuration(maximum)
+        self.assertTrue(IndexService.is_locked("example__amount"))
+        self.assertEqual([], index_batch("example", [({"id": "1", "amount": 5, "status": "open"}, None),
+                                                     ({"id": "2", "amount": 100, "status": "closed"}, None),
+                                                     ({"id": "3", "amount": 7, "status": "open"}, None)]))
+        self.assertEqual(AggregationMax(maximum.name, maximum.name, Decimal(7)),
+                         AggregationService.get_aggregation_by_name(maximum.name))
+        ## the maximum is recomputed from the open documents only
+        self.assertEqual([], index_batch("example", [({"id": "3", "amount": 1, "status": "open"},
+                                                      {"id": "3", "amount": 7, "status": "open"})]))
+        self.assertEqual(AggregationMax(maximum.name, maximum.name, Decimal(5)),
+                         AggregationService.get_aggregation_by_name(maximum.name))
+
+    def test_query_first_reads_at_most_max_rows(self):
+        collection = CollectionService.create_collection(
+            Collection("example", "id", None, [AttributeDefinition("amount", AttributeType.NUMBER)]))
+        index = Index("example", ["amount"])
+        IndexService.create_index(index)
+        documents = [{"id": str(i), "amount": i, "status": "open" if i == 0 else "closed"} for i in range(5)]
+        self.assertEqual([], index_batch("example", list(map(lambda d: (d, None), documents))))
+        matcher = compile_predicate(Eq("status", "open"))
+        ## the greatest amounts are read first, the only open document is the last row
+        self.assertIsNone(QueryService.query_first(collection, index, False, matcher, 2))
+        self.assertEqual("0", QueryService.query_first(collection, index, False, matcher, 5).document["id"])
+
+    def test_recomputed_extreme_does_not_replace_a_concurrent_one(self):
+        maximum = AggregationConfiguration("example", AggregationType.MAX, [AggregationTrigger.INSERT], "amount",
+                                           None, None)
+        AggregationService.update_extreme(maximum, Decimal(1), Decimal(10), [])
+        ## 10 is removed, but a concurrent update has already replaced it with 20
+        AggregationService.update_extreme(maximum, Decimal(1), Decimal(20), [])
+        repository = Repository(os.environ["DYNAMODB_SYSTEM_TABLE"])
+        model = Model("aggregation#" + maximum.name, "aggregation", None, None)
+        self.assertFalse(repository.set_in_document(model, "max", Decimal(3), replaces_one_of=[Decimal(10)]))
+        self.assertTrue(repository.set_in_document(model, "max", Decimal(3), replaces_one_of=[Decimal(20)]))
+        self.assertEqual(Decimal(3), repository.get(model.pk, model.sk).document["max"])
+
+    def test_applied_aggregations(self):
+        self.assertEqual({}, AggregationService.get_applied_aggregations("100"))
+        AggregationService.set_applied_aggregations("100", {"100": ["example_collection_count"]})
+        self.assertEqual({"100": ["example_collection_count"]}, AggregationService.get_applied_aggregations("100"))
+        AggregationService.delete_applied_aggregations("100")
+        self.assertEqual({}, AggregationService.get_applied_aggregations("100"))
+
+    def test_sharded_aggregation(self):
+        aggregation_configuration = AggregationConfiguration("example", AggregationType.SUM,
+                                                             [AggregationTrigger.INSERT], "amount", None, None, 4)
+        for i in range(20):
+            AggregationService.add_to_aggregation(aggregation_configuration, {"count": Decimal(1),
+                                                                              "sum": Decimal(i)})
+        self.assertEqual(AggregationSum("example_sum_amount", "example_sum_amount", Decimal(190)),
+                         AggregationService.get_aggregation_by_name("example_sum_amount"))
+        aggregations, last_key = AggregationService.get_all_aggregations(20, None)
+        ## the shards aren't listed as aggregations
+        self.assertEqual([AggregationSum("example_sum_amount", "example_sum_amount", Decimal(190))], aggregations)
+        aggregations, last_key = AggregationService.get_aggregations_by_configuration_name("example_sum_amount")
+        self.assertEqual([AggregationSum("example_sum_amount", "example_sum_amount", Decimal(190))], aggregations)
+
+    def test_group_by_aggregation(self):
+        CollectionService.create_collection(Collection("example", "id", None,
+                                                       [AttributeDefinition("amount", AttributeType.NUMBER)]))
+        aggregation_configuration = AggregationConfiguration("example", AggregationType.SUM,
+                                                             [AggregationTrigger.INSERT, AggregationTrigger.UPDATE,
+                                                              AggregationTrigger.DELETE], "amount", None, None,
+                                                             group_by="status")
+        AggregationConfigurationService.create_aggregation_configuration(aggregation_configuration)
+        self.assertEqual([], index_batch("example", [({"id": "1", "amount": 5, "status": "open"}, None),
+                                                     ({"id": "2", "amount": 10, "status": "closed#1"}, None),
+                                                     ({"id": "3", "amount": 7, "status": "open"}, None)]))
+        self.assertEqual([], index_batch("example", [({"id": "3", "amount": 7, "status": "closed#1"},
+                                                      {"id": "3", "amount": 7, "status": "open"})]))
+        groups, last_key = AggregationService.get_aggregation_groups(aggregation_configuration.name)
+        self.assertIsNone(last_key)
+        self.assertEqual(["closed#1", "open"], list(map(lambda g: g.group, groups)))
+        self.assertEqual([Decimal(17), Decimal(5)], list(map(lambda g: g.sum, groups)))
+
     # @mock_dynamodb2
     # def test_getIndexFromCollectionName(self):
     #     query = self.dynamoPlus.get_indexes_from_collecion_name("example")
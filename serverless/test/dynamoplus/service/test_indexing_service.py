@@ -1,16 +1,20 @@
 import os
 import unittest
+from decimal import Decimal
 
 from dynamoplus.models.system.collection.collection import Collection
 from dynamoplus.models.system.index.index import Index, IndexConfiguration
-from dynamoplus.v2.indexing_service_v2 import create_indexes,update_indexes,delete_indexes
+from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, \
+    AggregationTrigger
+from dynamoplus.v2.indexing_service_v2 import create_indexes,update_indexes,delete_indexes, index_batch
 
 from mock import call
 from unittest.mock import patch
 
 from dynamoplus.v2.repository.repositories import Repository, Model
 from dynamoplus.v2.service.system.aggregation_service import AggregationProcessingService
-from dynamoplus.v2.service.system.system_service import CollectionService, IndexService, AggregationConfigurationService
+from dynamoplus.v2.service.system.system_service import CollectionService, IndexService, AggregationConfigurationService, \
+    AggregationService
 
 domain_table_name = "domain"
 system_table_name = "system"
@@ -25,12 +29,12 @@ class TestIndexService(unittest.TestCase):
         os.environ.setdefault("STAGE", "local")
 
     @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
-    @patch.object(Repository, "create")
+    @patch.object(Repository, "batch_write")
     @patch.object(Repository,"__init__")
     @patch.object(IndexService,"get_indexes_from_collection_name_generator")
     @patch.object(CollectionService, "get_collection")
     def test_create_indexes(self,mock_get_collection,mock_get_indexes_from_collection_name_generator,
-                            mock_repository,mock_repository_create, mock_aggregations):
+                            mock_repository,mock_repository_batch_write, mock_aggregations):
         collection_name = "example"
         example_record = {
             "id": "1",
@@ -51,17 +55,18 @@ class TestIndexService(unittest.TestCase):
         create_indexes(collection_name,example_record)
         mock_get_collection.assert_called_once_with(collection_name)
         mock_get_indexes_from_collection_name_generator.assert_called_once_with(collection_name)
-        mock_repository_create.assert_has_calls([call(Model("example#1","example#attribute_1","value_1",example_record)),
-                                                 call(Model("example#1","example#attribute_2#attribute_1","value_2#value_1",example_record)),
-                                                 call(Model("example#1","example#attribute_3.attribute_31","value_31#value_1",example_record, ))])
+        mock_repository_batch_write.assert_called_once_with([Model("example#1","example#attribute_1","value_1",example_record),
+                                                             Model("example#1","example#attribute_2#attribute_1","value_2#value_1",example_record),
+                                                             Model("example#1","example#attribute_3.attribute_31","value_31#value_1",example_record)],
+                                                            [])
 
     @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
-    @patch.object(Repository, "update")
+    @patch.object(Repository, "batch_write")
     @patch.object(Repository, "__init__")
     @patch.object(IndexService, "get_indexes_from_collection_name_generator")
     @patch.object(CollectionService, "get_collection")
     def test_update_indexes(self, mock_get_collection, mock_get_indexes_from_collection_name_generator,
-                            mock_repository, mock_repository_update,mock_aggregations):
+                            mock_repository, mock_repository_batch_write,mock_aggregations):
         collection_name = "example"
         example_record = {
             "id": "1",
@@ -90,18 +95,19 @@ class TestIndexService(unittest.TestCase):
         update_indexes(collection_name, old_record, example_record)
         mock_get_collection.assert_called_once_with(collection_name)
         mock_get_indexes_from_collection_name_generator.assert_called_once_with(collection_name)
-        mock_repository_update.assert_has_calls(
-            [call(Model("example#1", "example#attribute_1", "value_1", example_record)),
-             call(Model("example#1", "example#attribute_2#attribute_1", "value_2#value_1", example_record)),
-             call(Model("example#1", "example#attribute_3.attribute_31", "value_31#value_1", example_record, ))])
+        mock_repository_batch_write.assert_called_once_with(
+            [Model("example#1", "example#attribute_1", "value_1", example_record),
+             Model("example#1", "example#attribute_2#attribute_1", "value_2#value_1", example_record),
+             Model("example#1", "example#attribute_3.attribute_31", "value_31#value_1", example_record)],
+            [])
 
     @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
-    @patch.object(Repository, "delete")
+    @patch.object(Repository, "batch_write")
     @patch.object(Repository, "__init__")
     @patch.object(IndexService, "get_indexes_from_collection_name_generator")
     @patch.object(CollectionService, "get_collection")
     def test_delete_indexes(self, mock_get_collection, mock_get_indexes_from_collection_name_generator,
-                            mock_repository, mock_repository_delete, mock_aggregations):
+                            mock_repository, mock_repository_batch_write, mock_aggregations):
         collection_name = "example"
         example_record = {
             "id": "1",
@@ -122,10 +128,94 @@ class TestIndexService(unittest.TestCase):
         delete_indexes(collection_name, example_record)
         mock_get_collection.assert_called_once_with(collection_name)
         mock_get_indexes_from_collection_name_generator.assert_called_once_with(collection_name)
-        mock_repository_delete.assert_has_calls(
-            [call("example#1", "example#attribute_1"),
-             call("example#1", "example#attribute_2#attribute_1"),
-             call("example#1", "example#attribute_3.attribute_31")])
+        removed_models = mock_repository_batch_write.call_args[0][1]
+        self.assertEqual([], mock_repository_batch_write.call_args[0][0])
+        self.assertEqual([("example#1", "example#attribute_1"),
+                          ("example#1", "example#attribute_2#attribute_1"),
+                          ("example#1", "example#attribute_3.attribute_31")],
+                         list(map(lambda m: (m.pk, m.sk), removed_models)))
 
 
 
+
+    @patch.object(AggregationService, "add_to_aggregation")
+    @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
+    @patch.object(Repository, "batch_write")
+    @patch.object(Repository, "__init__")
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    @patch.object(CollectionService, "get_collection")
+    def test_index_batch(self, mock_get_collection, mock_get_indexes_from_collection_name_generator,
+                         mock_repository, mock_repository_batch_write, mock_aggregations, mock_add_to_aggregation):
+        collection_name = "example"
+        record_1 = {"id": "1", "attribute_1": "value_1"}
+        record_1_updated = {"id": "1", "attribute_1": "value_1u"}
+        record_2 = {"id": "2", "attribute_1": "value_2"}
+        aggregation = AggregationConfiguration("example", AggregationType.COLLECTION_COUNT,
+                                               [AggregationTrigger.INSERT, AggregationTrigger.DELETE], None, None, None)
+        mock_repository.return_value = None
+        mock_get_collection.return_value = Collection("example", "id")
+        mock_get_indexes_from_collection_name_generator.return_value = [Index("example", ["attribute_1"])]
+        mock_aggregations.return_value = [aggregation]
+        failed = index_batch(collection_name, [(record_1, None),
+                                               (record_2, None),
+                                               (record_1_updated, record_1),
+                                               (None, record_2)])
+        self.assertEqual([], failed)
+        mock_get_collection.assert_called_once_with(collection_name)
+        mock_get_indexes_from_collection_name_generator.assert_called_once_with(collection_name)
+        mock_repository_batch_write.assert_called_once_with(
+            [Model("example#1", "example#attribute_1", "value_1u", record_1_updated)],
+            [Model("example#2", "example#attribute_1", "value_2", record_2)])
+        ## two inserts and a delete, a single write for the batch
+        mock_add_to_aggregation.assert_called_once_with(aggregation, {"count": Decimal(1)})
+
+    @patch.object(AggregationService, "add_to_aggregation")
+    @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
+    @patch.object(Repository, "batch_write")
+    @patch.object(Repository, "__init__")
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    @patch.object(CollectionService, "get_collection")
+    def test_index_batch_aggregation_failure(self, mock_get_collection,
+                                             mock_get_indexes_from_collection_name_generator, mock_repository,
+                                             mock_repository_batch_write, mock_aggregations, mock_add_to_aggregation):
+        count = AggregationConfiguration("example", AggregationType.COLLECTION_COUNT,
+                                         [AggregationTrigger.INSERT, AggregationTrigger.DELETE], None, None, None)
+        sum = AggregationConfiguration("example", AggregationType.SUM, [AggregationTrigger.INSERT], "value", None,
+                                       None)
+        mock_repository.return_value = None
+        mock_get_collection.return_value = Collection("example", "id")
+        mock_get_indexes_from_collection_name_generator.return_value = []
+        mock_aggregations.return_value = [count, sum]
+        mock_add_to_aggregation.side_effect = lambda a, i: exec("raise Exception('throttled')") if a is sum else None
+        changes = [({"id": "1"}, None), ({"id": "2", "value": 2}, None), ({"id": "3", "value": 3}, None)]
+        applied = [set(), set(), set()]
+        failed = index_batch("example", changes, applied)
+        ## only the changes added to the sum, the count has been applied to them anyway
+        self.assertEqual([1, 2], failed)
+        self.assertEqual([{count.name}, {count.name}, {count.name}], applied)
+        mock_add_to_aggregation.assert_has_calls([call(count, {"count": Decimal(3)}),
+                                                  call(sum, {"count": Decimal(2), "sum": Decimal(5)})],
+                                                 any_order=True)
+        ## the retry of the failed changes doesn't add them to the count again
+        mock_add_to_aggregation.reset_mock()
+        mock_add_to_aggregation.side_effect = None
+        self.assertEqual([], index_batch("example", changes[1:], applied[1:]))
+        mock_add_to_aggregation.assert_called_once_with(sum, {"count": Decimal(2), "sum": Decimal(5)})
+        self.assertEqual([{count.name, sum.name}, {count.name, sum.name}], applied[1:])
+
+    @patch.object(AggregationConfigurationService, "get_aggregation_configurations_by_collection_name_generator")
+    @patch.object(Repository, "batch_write")
+    @patch.object(Repository, "__init__")
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    @patch.object(CollectionService, "get_collection")
+    def test_index_batch_write_failure(self, mock_get_collection, mock_get_indexes_from_collection_name_generator,
+                                       mock_repository, mock_repository_batch_write, mock_aggregations):
+        mock_repository.return_value = None
+        mock_get_collection.return_value = Collection("example", "id")
+        mock_get_indexes_from_collection_name_generator.return_value = [
+            Index("example", ["attribute_2"], IndexConfiguration.OPTIMIZE_WRITE)]
+        mock_aggregations.return_value = []
+        mock_repository_batch_write.side_effect = Exception("throttled")
+        failed = index_batch("example", [({"id": "1", "attribute_1": "value_1"}, None),
+                                         ({"id": "2", "attribute_2": "value_2"}, None)])
+        self.assertEqual([1], failed)
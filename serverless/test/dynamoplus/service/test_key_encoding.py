@@ -0,0 +1,81 @@
+import unittest
+from decimal import Decimal
+
+from dynamoplus.models.system.collection.collection import Collection, AttributeDefinition, AttributeType
+from dynamoplus.models.system.index.index import Index
+from dynamoplus.v2.service.key_encoding import encode_number, encode_date, escape, encode_value, \
+    get_attribute_type, to_document_value, DATA_UPPER_BOUND_SUFFIX
+from dynamoplus.v2.service.model_service import get_index_model, get_model
+
+
+class TestKeyEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Collection("example", "id", "created_at", [
+            AttributeDefinition("price", AttributeType.NUMBER),
+            AttributeDefinition("created_at", AttributeType.DATE),
+            AttributeDefinition("address", AttributeType.OBJECT, attributes=[
+                AttributeDefinition("number", AttributeType.NUMBER)
+            ])
+        ])
+
+    def test_numbers_sort_as_numbers(self):
+        numbers = [Decimal("-1000"), -12.5, Decimal("-1.2"), -1, Decimal("-0.001"), 0, Decimal("0.001"), 1,
+                   Decimal("1.01"), Decimal("1.2"), 9, 10, 12.5, Decimal("1E+3"), 1001, "123456789"]
+        encoded = list(map(encode_number, numbers))
+        self.assertEqual(encoded, sorted(encoded))
+        self.assertEqual(len(encoded), len(set(encoded)))
+
+    def test_equal_numbers_have_the_same_encoding(self):
+        self.assertEqual(encode_number(10), encode_number(Decimal("10.00")))
+        self.assertEqual(encode_number("1.5"), encode_number(1.5))
+
+    def test_number_is_not_prefix_of_another(self):
+        self.assertFalse(encode_number(12).startswith(encode_number(1)))
+        self.assertFalse(encode_number(-12).startswith(encode_number(-1)))
+
+    def test_not_a_number(self):
+        self.assertRaises(Exception, encode_number, "abc")
+        self.assertRaises(Exception, encode_number, "NaN")
+
+    def test_dates_normalized_to_utc(self):
+        expected = "2020-01-31T10:00:00.000000Z"
+        self.assertEqual(expected, encode_date("2020-01-31T10:00:00"))
+        self.assertEqual(expected, encode_date("2020-01-31T10:00:00Z"))
+        self.assertEqual(expected, encode_date("2020-01-31T11:00:00+01:00"))
+        self.assertEqual(expected, encode_date(1580464800))
+        self.assertEqual(expected, encode_date("1580464800"))
+        self.assertRaises(Exception, encode_date, "yesterday")
+
+    def test_escape(self):
+        self.assertEqual("a%23b%2523", escape("a#b%23"))
+
+    def test_get_attribute_type(self):
+        self.assertEqual(AttributeType.NUMBER, get_attribute_type(self.collection, "price"))
+        self.assertEqual(AttributeType.NUMBER, get_attribute_type(self.collection, "address.number"))
+        self.assertIsNone(get_attribute_type(self.collection, "address.street"))
+        self.assertIsNone(get_attribute_type(Collection("example", "id"), "price"))
+
+    def test_untyped_value(self):
+        self.assertEqual("10", encode_value(self.collection, "name", Decimal(10)))
+        self.assertEqual("true", encode_value(self.collection, "name", True))
+
+    def test_index_model(self):
+        index = Index("example", ["name", "price"], ordering_key="created_at")
+        document = {"id": "1", "name": "a#b", "price": Decimal(10), "created_at": "2020-01-31T10:00:00"}
+        model = get_index_model(self.collection, index, document)
+        self.assertEqual("example#name#price", model.sk)
+        self.assertEqual("a%23b#{}#2020-01-31T10:00:00.000000Z".format(encode_number(10)), model.data)
+        self.assertEqual("2020-01-31T10:00:00.000000Z", get_model(self.collection, document).data)
+
+    def test_range_upper_bound(self):
+        index_data = encode_number(10) + "#2020-01-31T10:00:00.000000Z"
+        self.assertTrue(encode_number(9) <= index_data <= encode_number(10) + DATA_UPPER_BOUND_SUFFIX)
+        self.assertFalse(index_data <= encode_number(9) + DATA_UPPER_BOUND_SUFFIX)
+        self.assertFalse(encode_number(10.5) <= encode_number(10) + DATA_UPPER_BOUND_SUFFIX)
+
+    def test_to_document_value(self):
+        self.assertEqual(Decimal(10), to_document_value(self.collection, "price", "10"))
+        self.assertEqual(Decimal("1.5"), to_document_value(self.collection, "address.number", 1.5))
+        self.assertEqual("10", to_document_value(self.collection, "name", "10"))
+        self.assertRaises(Exception, to_document_value, self.collection, "price", "abc")
@@ -0,0 +1,96 @@
+import unittest
+
+from dynamoplus.models.query.conditions import Eq, Range, And, AnyMatch
+from dynamoplus.models.system.index.index import Index, IndexConfiguration
+from dynamoplus.v2.service.query_planner import QueryPlanner
+
+
+class TestQueryPlanner(unittest.TestCase):
+
+    def test_any_match(self):
+        plan = QueryPlanner.plan([Index("example", ["field1"])], AnyMatch())
+        self.assertIsNone(plan.index)
+        self.assertEqual(AnyMatch(), plan.predicate)
+
+    def test_no_index(self):
+        self.assertIsNone(QueryPlanner.plan([Index("example", ["field2", "field1"])], Eq("field1", "1")))
+
+    def test_longest_equality_prefix(self):
+        expected_index = Index("example", ["field2", "field1", "field4"])
+        indexes = [Index("example", ["field1"]), expected_index, Index("example", ["field3", "field5"])]
+        plan = QueryPlanner.plan(indexes, And([Eq("field1", "1"), Eq("field2", "2"), Eq("field3", "3")]))
+        self.assertIs(expected_index, plan.index)
+        ## the values are in the order of the index conditions
+        self.assertEqual(And([Eq("field2", "2"), Eq("field1", "1")]), plan.predicate)
+        self.assertEqual(Eq("field3", "3"), plan.residual)
+        self.assertIn("example__field2__field1__field4", plan.explanation)
+
+    def test_range_on_last_field(self):
+        expected_index = Index("example", ["field1", "field2"])
+        indexes = [Index("example", ["field1"]), expected_index]
+        plan = QueryPlanner.plan(indexes, And([Range("field2", "a", "b"), Eq("field1", "1")]))
+        self.assertIs(expected_index, plan.index)
+        self.assertEqual(And([Eq("field1", "1"), Range("field2", "a", "b")]), plan.predicate)
+        self.assertIsNone(plan.residual)
+
+    def test_prefer_exact_and_optimize_read(self):
+        expected_index = Index("example", ["field1"], IndexConfiguration.OPTIMIZE_READ)
+        indexes = [Index("example", ["field1", "field2"]),
+                   Index("example", ["field1"], IndexConfiguration.OPTIMIZE_WRITE),
+                   expected_index]
+        plan = QueryPlanner.plan(indexes, Eq("field1", "1"))
+        self.assertIs(expected_index, plan.index)
+
+    def test_ordering_key(self):
+        expected_index = Index("example", ["field1"], IndexConfiguration.OPTIMIZE_WRITE, "field3")
+        indexes = [Index("example", ["field1"]), expected_index]
+        plan = QueryPlanner.plan(indexes, Eq("field1", "1"), "field3")
+        self.assertIs(expected_index, plan.index)
+
+    def test_order_by_needs_an_ordered_index(self):
+        indexes = [Index("example", ["field1", "field2"]), Index("example", ["field1"])]
+        self.assertIsNone(QueryPlanner.plan(indexes, Eq("field1", "1"), "field3"))
+
+    def test_same_field_twice(self):
+        index = Index("example", ["field1"])
+        plan = QueryPlanner.plan([index], And([Eq("field1", "a"), Eq("field1", "b"), Eq("field1", "a")]))
+        self.assertIs(index, plan.index)
+        self.assertEqual(Eq("field1", "a"), plan.predicate)
+        self.assertEqual(Eq("field1", "b"), plan.residual)
+        self.assertIsNone(QueryPlanner.plan_intersection([index, Index("example", ["field2"])],
+                                                         And([Eq("field1", "a"), Eq("field1", "b"),
+                                                              Eq("field2", "c")])))
+
+    def test_find_index(self):
+        expected_index = Index("example", ["field2", "field1"])
+        indexes = [Index("example", ["field1"]), expected_index, Index("example", ["field3", "field1"])]
+        self.assertIs(expected_index, QueryPlanner.find_index(indexes, ["field1", "field2"]))
+        self.assertIsNone(QueryPlanner.find_index(indexes, ["field4"]))
+        self.assertIsNone(QueryPlanner.find_index(indexes, ["field1"], "field3"))
+
+    def test_order_by_next_field(self):
+        expected_index = Index("example", ["field1", "field3"])
+        indexes = [Index("example", ["field1", "field2"]), Index("example", ["field1"]), expected_index]
+        plan = QueryPlanner.plan(indexes, Eq("field1", "1"), "field3")
+        self.assertIs(expected_index, plan.index)
+        plan = QueryPlanner.plan(indexes, And([Eq("field1", "1"), Range("field3", "a", "b")]), "field3")
+        self.assertIs(expected_index, plan.index)
+
+    def test_intersection(self):
+        index1 = Index("example", ["field1", "field2"])
+        index3 = Index("example", ["field3"])
+        indexes = [Index("example", ["field1"]), index1, index3, Index("example", ["field4"])]
+        plans = QueryPlanner.plan_intersection(indexes, And([Eq("field1", "1"), Range("field3", "a", "b"),
+                                                             Eq("field2", "2")]))
+        self.assertEqual([index1, index3], list(map(lambda p: p.index, plans)))
+        self.assertEqual(And([Eq("field1", "1"), Eq("field2", "2")]), plans[0].predicate)
+        self.assertEqual(Range("field3", "a", "b"), plans[1].predicate)
+        self.assertIsNone(plans[1].residual)
+
+    def test_no_intersection(self):
+        indexes = [Index("example", ["field1"]), Index("example", ["field1", "field2"])]
+        ## a single index is enough
+        self.assertIsNone(QueryPlanner.plan_intersection(indexes, And([Eq("field1", "1"), Eq("field2", "2")])))
+        ## field3 is not indexed
+        self.assertIsNone(QueryPlanner.plan_intersection(indexes, And([Eq("field1", "1"), Eq("field3", "3")])))
+        self.assertIsNone(QueryPlanner.plan_intersection(indexes, Eq("field1", "1")))
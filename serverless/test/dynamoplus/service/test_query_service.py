@@ -5,6 +5,7 @@ from dynamoplus.models.query.conditions import Eq, Range, AnyMatch
 from dynamoplus.models.system.collection.collection import Collection
 from dynamoplus.models.system.index.index import Index, IndexConfiguration
 from dynamoplus.v2.repository.repositories import QueryRepository, QueryResult, Model, Repository
+from dynamoplus.v2.service.cursor import encode_cursor
 from dynamoplus.v2.service.query_service import QueryService
 
 from mock import call
@@ -19,6 +20,7 @@ class QueryServiceTest(unittest.TestCase):
     def setUp(self):
         os.environ["DYNAMODB_DOMAIN_TABLE"] = domain_table_name
         os.environ["DYNAMODB_SYSTEM_TABLE"] = system_table_name
+        os.environ["PAGINATION_CURSOR_SECRET"] = "secret"
 
 
     @patch.object(QueryRepository, "query_all")
@@ -64,9 +66,9 @@ class QueryServiceTest(unittest.TestCase):
         query_result = list(QueryService.query_generator(collection, AnyMatch(), index))
         self.assertEqual(expected_result, query_result)
         mock_query_all.assert_has_calls([
-            call("example", None, limit),
-            call("example", expected_starting_after_1, limit),
-            call("example", expected_starting_after_2, limit)
+            call("example", None, limit, shards=None),
+            call("example", expected_starting_after_1, limit, shards=None),
+            call("example", expected_starting_after_2, limit, shards=None)
         ])
 
 
@@ -109,15 +111,16 @@ class QueryServiceTest(unittest.TestCase):
         query_result = list(filtered)
         self.assertEqual(expected_result, query_result)
         mock_query_all.assert_has_calls([
-            call("example", None, limit)
+            call("example", None, limit, shards=None)
         ])
 
+    @patch.object(Repository, "batch_get")
     @patch.object(Repository, "get")
     @patch.object(Repository, "__init__")
     @patch.object(QueryRepository, "query_all")
     @patch.object(QueryRepository, "__init__")
     def test_query_all(self, mock_query_repository, mock_query_all,
-                       mock_repository, mock_repository_get):
+                       mock_repository, mock_repository_get, mock_repository_batch_get):
         mock_query_repository.return_value = None
         mock_repository.return_value = None
         partial_result = QueryResult([Model("example#1", "example", "1", None)])
@@ -125,7 +128,8 @@ class QueryServiceTest(unittest.TestCase):
         expected_model_starts_from = Model("example#0", "example", "0", None)
         expected_result = QueryResult([expected_model])
         mock_query_all.return_value = partial_result
-        mock_repository_get.side_effect = [expected_model_starts_from, expected_model]
+        mock_repository_get.return_value = expected_model_starts_from
+        mock_repository_batch_get.return_value = [expected_model]
 
         collection = Collection("example", "id")
         index = Index("example", ["name"], IndexConfiguration.OPTIMIZE_WRITE)
@@ -133,20 +137,36 @@ class QueryServiceTest(unittest.TestCase):
         limit = 10
         query_result = QueryService.query(collection, AnyMatch(), index, start_from, limit)
         self.assertEqual(expected_result, query_result)
-        mock_query_all.assert_called_once_with("example", expected_model_starts_from,limit)
-        mock_repository_get.assert_has_calls(
-            [call("example#0", "example"),
-             call("example#1", "example")]
-        )
+        mock_query_all.assert_called_once_with("example", expected_model_starts_from,limit, filter_expression=None, shards=None, ascending=False)
+        mock_repository_get.assert_called_once_with("example#0", "example")
+        mock_repository_batch_get.assert_called_once_with([("example#1", "example")])
 
 
 
+    @patch.object(Repository, "get")
+    @patch.object(QueryRepository, "query_range")
+    @patch.object(QueryRepository, "__init__")
+    def test_query_starting_from_cursor(self, mock_query_repository, mock_query_range, mock_repository_get):
+        mock_query_repository.return_value = None
+        last_key = Model("example#1", "example#name", "my_name", None)
+        expected_result = QueryResult([Model("example#2", "example#name", "my_name", {"id": "2", "name": "my_name"})])
+        mock_query_range.return_value = expected_result
+        collection = Collection("example", "id")
+        index = Index("example", ["name"], IndexConfiguration.OPTIMIZE_READ)
+        result = QueryService.query(collection, Eq("name", "my_name"), index, encode_cursor(last_key), 20)
+        self.assertEqual(expected_result, result)
+        ## the index has only the name, the rows have exactly its value
+        mock_query_range.assert_called_once_with("example#name", "my_name", "my_name", 20, last_key,
+                                                 filter_expression=None, shards=None, ascending=False)
+        mock_repository_get.assert_not_called()
+
+    @patch.object(Repository, "batch_get")
     @patch.object(Repository, "get")
     @patch.object(Repository, "__init__")
     @patch.object(QueryRepository, "query_range")
     @patch.object(QueryRepository, "__init__")
     def test_query_range(self, mock_query_repository, mock_query_range,
-                               mock_repository, mock_repository_get):
+                               mock_repository, mock_repository_get, mock_repository_batch_get):
         mock_query_repository.return_value = None
         mock_repository.return_value = None
         partial_result = QueryResult([Model("example#1", "example", "1", None)])
@@ -154,7 +174,8 @@ class QueryServiceTest(unittest.TestCase):
         expected_model_starts_from = Model("example#0", "example", "0", None)
         expected_result = QueryResult([expected_model])
         mock_query_range.return_value = partial_result
-        mock_repository_get.side_effect = [expected_model_starts_from, expected_model]
+        mock_repository_get.return_value = expected_model_starts_from
+        mock_repository_batch_get.return_value = [expected_model]
 
         collection = Collection("example", "id")
         predicate = Range("name","001","003")
@@ -163,18 +184,18 @@ class QueryServiceTest(unittest.TestCase):
         limit = 10
         query_result = QueryService.query(collection, predicate, index, start_from, limit)
         self.assertEqual(expected_result, query_result)
-        mock_query_range.assert_called_once_with("example#name", "001","003", limit,expected_model_starts_from)
-        mock_repository_get.assert_has_calls(
-            [call("example#0", "example#name"),
-             call("example#1", "example")]
-        )
+        mock_query_range.assert_called_once_with("example#name", "001", "003#\uffff", limit,expected_model_starts_from,
+                                                 filter_expression=None, shards=None, ascending=False)
+        mock_repository_get.assert_called_once_with("example#0", "example#name")
+        mock_repository_batch_get.assert_called_once_with([("example#1", "example")])
 
+    @patch.object(Repository, "batch_get")
     @patch.object(Repository, "get")
     @patch.object(Repository, "__init__")
     @patch.object(QueryRepository, "query_begins_with")
     @patch.object(QueryRepository, "__init__")
     def test_query_begins_with(self, mock_query_repository, mock_query_begins_with,
-                               mock_repository, mock_repository_get):
+                               mock_repository, mock_repository_get, mock_repository_batch_get):
         mock_query_repository.return_value = None
         mock_repository.return_value = None
         partial_result = QueryResult([Model("example#1", "example", "1", None)])
@@ -182,18 +203,51 @@ class QueryServiceTest(unittest.TestCase):
         expected_model_starts_from = Model("example#0", "example", "0", None)
         expected_result = QueryResult([expected_model])
         mock_query_begins_with.return_value = partial_result
-        mock_repository_get.side_effect = [expected_model_starts_from, expected_model]
+        mock_repository_get.return_value = expected_model_starts_from
+        mock_repository_batch_get.return_value = [expected_model]
 
         collection = Collection("example", "id")
         predicate = Eq("name", "my_name")
-        index = Index("example", ["name"], IndexConfiguration.OPTIMIZE_WRITE)
+        index = Index("example", ["name", "field_1"], IndexConfiguration.OPTIMIZE_WRITE)
         start_from = "0"
         limit = 10
         query_result = QueryService.query(collection, predicate, index, start_from, limit)
         self.assertEqual(expected_result, query_result)
-        mock_query_begins_with.assert_called_once_with("example#name", "my_name", expected_model_starts_from, limit)
-        mock_repository_get.assert_has_calls(
-            [call("example#0", "example#name"),
-             call("example#1", "example")]
-        )
+        mock_query_begins_with.assert_called_once_with("example#name#field_1", "my_name#", expected_model_starts_from,
+                                                       limit,
+                                                       filter_expression=None, shards=None, ascending=False)
+        mock_repository_get.assert_called_once_with("example#0", "example#name#field_1")
+        mock_repository_batch_get.assert_called_once_with([("example#1", "example")])
+
 
+    @patch.object(Repository, "batch_get")
+    @patch.object(Repository, "__init__")
+    @patch.object(QueryRepository, "query_range")
+    @patch.object(QueryRepository, "__init__")
+    def test_query_optimize_write_with_residual(self, mock_query_repository, mock_query_range,
+                                                mock_repository, mock_repository_batch_get):
+        mock_query_repository.return_value = None
+        mock_repository.return_value = None
+        page1 = QueryResult([Model("example#1", "example#name", "my_name", {"id": "1", "name": "my_name"}),
+                             Model("example#2", "example#name", "my_name", {"id": "2", "name": "my_name"})],
+                            Model("example#2", "example#name", "my_name", None))
+        page2 = QueryResult([Model("example#3", "example#name", "my_name", {"id": "3", "name": "my_name"})])
+        mock_query_range.side_effect = [page1, page2]
+        documents = {
+            "example#1": Model("example#1", "example", "1", {"id": "1", "name": "my_name", "field_1": "a"}),
+            "example#2": Model("example#2", "example", "2", {"id": "2", "name": "my_name", "field_1": "b"}),
+            "example#3": Model("example#3", "example", "3", {"id": "3", "name": "my_name", "field_1": "a"})
+        }
+        mock_repository_batch_get.side_effect = lambda keys: [documents[k[0]] for k in keys]
+        collection = Collection("example", "id")
+        index = Index("example", ["name"], IndexConfiguration.OPTIMIZE_WRITE)
+        result = QueryService.query(collection, Eq("name", "my_name"), index, None, 2, Eq("field_1", "a"))
+        self.assertEqual([documents["example#1"].document, documents["example#3"].document],
+                         list(map(lambda m: m.document, result.data)))
+        self.assertEqual(["example#name", "example#name"], list(map(lambda m: m.sk, result.data)))
+        self.assertIsNone(result.lastEvaluatedKey)
+        self.assertEqual([call("example#name", "my_name", "my_name", 2, None, filter_expression=None, shards=None,
+                               ascending=False),
+                          call("example#name", "my_name", "my_name", 2, page1.lastEvaluatedKey, filter_expression=None,
+                               shards=None, ascending=False)],
+                         mock_query_range.call_args_list)
@@ -5,7 +5,7 @@ from fastjsonschema import JsonSchemaException
 
 from dynamoplus.service.validation_service import is_collection_schema_valid, validate_document, validate_collection, \
     validate_index, validate_client_authorization_api_key, __validate as validate, validate_client_authorization,\
-    validate_query,validate_aggregation
+    validate_query,validate_aggregation, document_validator_cache
 
 
 class TestValidationService(unittest.TestCase):
@@ -63,6 +63,16 @@ class TestValidationService(unittest.TestCase):
                           collection_schema)
         ##no error
 
+    def test_validate_compiles_schema_once(self):
+        document_validator_cache.clear()
+        collection_schema = {"type": "object", "properties": {"name": {"type": "string"}}}
+        validate({"name": "Ambrogio"}, collection_schema)
+        hits = document_validator_cache.hits
+        validate({"name": "Fumagalli"}, {"properties": {"name": {"type": "string"}}, "type": "object"})
+        self.assertEqual(1, document_validator_cache.stats()["size"])
+        self.assertEqual(hits + 1, document_validator_cache.hits)
+        self.assertRaises(JsonSchemaException, validate, {"name": 1}, collection_schema)
+
     def test_validate_person_schema_error(self):
         collection_schema = {
             "type": "object",
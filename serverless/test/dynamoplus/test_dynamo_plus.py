@@ -4,7 +4,8 @@ from unittest.mock import patch
 
 from mock import call
 
-from dynamoplus.dynamo_plus_v2 import get, get_all,query, aggregation_configurations as get_aggregation_configurations
+from dynamoplus.dynamo_plus_v2 import get, get_all,query, aggregation_configurations as get_aggregation_configurations, \
+    HandlerException
 from dynamoplus.models.query.conditions import Eq
 from dynamoplus.models.system.aggregation.aggregation import AggregationConfiguration, AggregationType, Aggregation, \
     AggregationTrigger, AggregationCount, AggregationJoin, AggregationAvg
@@ -114,14 +115,14 @@ class TestDynamoPlusHandler(unittest.TestCase):
 
 
     @patch.object(QueryService, "query")
-    @patch.object(IndexService, "get_index_matching_fields")
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
     @patch.object(CollectionService, "get_collection")
-    def test_get_documents_by_index(self, mock_get_collection,mock_get_index_matching_fields,mock_query):
+    def test_get_documents_by_index(self, mock_get_collection,mock_get_indexes_from_collection_name_generator,mock_query):
         expected_collection = Collection("example", "id", "ordering")
         mock_get_collection.return_value = expected_collection
         expected_index = Index("example", ["attribute1"])
         expected_predicate = Eq("attribute1","1")
-        mock_get_index_matching_fields.return_value=expected_index
+        mock_get_indexes_from_collection_name_generator.return_value=[Index("example", ["attribute2"]), expected_index]
         expected_documents = [
             Model(None,None,None,{"id": "1", "attribute1": "1"}),
             Model(None,None,None,{"id": "2", "attribute1": "1"})
@@ -130,8 +131,37 @@ class TestDynamoPlusHandler(unittest.TestCase):
         documents = query("example", {"matches": {"eq":{"field_name":"attribute1", "value":"1"}}})
         self.assertEqual(len(documents), len(expected_documents))
         self.assertTrue(mock_get_collection.called_with("example"))
-        self.assertTrue(mock_get_index_matching_fields.called_with("attribute1"))
-        self.assertEqual(call(expected_collection,expected_predicate,expected_index, None, None), mock_query.call_args_list[0])
+        mock_get_indexes_from_collection_name_generator.assert_called_once_with("example")
+        self.assertEqual(call(expected_collection,expected_predicate,expected_index, None, None, None, False), mock_query.call_args_list[0])
+
+    @patch.object(QueryService, "query")
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    @patch.object(CollectionService, "get_collection")
+    def test_get_documents_by_index_ordered(self, mock_get_collection, mock_get_indexes_from_collection_name_generator,
+                                            mock_query):
+        expected_collection = Collection("example", "id", "ordering")
+        mock_get_collection.return_value = expected_collection
+        expected_index = Index("example", ["attribute1"], ordering_key="attribute2")
+        mock_get_indexes_from_collection_name_generator.return_value = [Index("example", ["attribute1"]),
+                                                                        expected_index]
+        mock_query.return_value = QueryResult([], None)
+        query("example", {"matches": {"eq": {"field_name": "attribute1", "value": "1"}}, "order_by": "attribute2",
+                          "direction": "ASC"})
+        self.assertEqual(call(expected_collection, Eq("attribute1", "1"), expected_index, None, None, None, True),
+                         mock_query.call_args_list[0])
+        ## the direction is uppercase, as in the query schema
+        self.assertRaises(HandlerException, query, "example",
+                          {"matches": {"eq": {"field_name": "attribute1", "value": "1"}}, "order_by": "attribute2",
+                           "direction": "asc"})
+
+    @patch.object(IndexService, "get_indexes_from_collection_name_generator")
+    @patch.object(CollectionService, "get_collection")
+    def test_get_documents_ordered_without_index(self, mock_get_collection,
+                                                 mock_get_indexes_from_collection_name_generator):
+        mock_get_collection.return_value = Collection("example", "id", "ordering")
+        mock_get_indexes_from_collection_name_generator.return_value = [Index("example", ["attribute1"])]
+        self.assertRaises(HandlerException, query, "example",
+                          {"matches": {"eq": {"field_name": "attribute1", "value": "1"}}, "order_by": "attribute2"})
 
     @patch.object(Converter,"from_collection_to_API")
     @patch.object(CollectionService,"get_all_collections")
@@ -147,7 +177,7 @@ class TestDynamoPlusHandler(unittest.TestCase):
         result,last_key=get_all("collection","example_0",20)
 
         self.assertCountEqual(result,expected_data)
-        mock_get_all_collections.assert_has_calls([call(20,"example_0")])
+        mock_get_all_collections.assert_has_calls([call("example_0", 20)])
         mock_converter_to_API.assert_has_calls(
             [call(expected_collections[0]),
             call(expected_collections[1])]
@@ -168,7 +198,7 @@ class TestDynamoPlusHandler(unittest.TestCase):
         result,last_key=get_all("collection","example_0",20)
 
         self.assertCountEqual(result,expected_data)
-        mock_get_all_collections.assert_has_calls([call(20,"example_0")])
+        mock_get_all_collections.assert_has_calls([call("example_0", 20)])
         mock_converter_to_API.assert_has_calls(
             [call(expected_collections[0]),
             call(expected_collections[1])]
@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import patch
+
+from dynamoplus.utils.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_or_load(self):
+        cache = TTLCache(10, 60)
+        loaded = []
+
+        def loader():
+            loaded.append("value")
+            return "value"
+
+        self.assertEqual("value", cache.get_or_load("key", loader))
+        self.assertEqual("value", cache.get_or_load("key", loader))
+        self.assertEqual(1, len(loaded))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 1}, cache.stats())
+
+    def test_none_is_not_cached(self):
+        cache = TTLCache(10, 60)
+        self.assertIsNone(cache.get_or_load("key", lambda: None))
+        self.assertEqual(0, cache.stats()["size"])
+
+    def test_expiration(self):
+        cache = TTLCache(10, 60)
+        with patch("dynamoplus.utils.cache.time.monotonic") as mock_monotonic:
+            mock_monotonic.return_value = 100
+            cache.put("key", "value")
+            mock_monotonic.return_value = 159
+            self.assertEqual("value", cache.get("key"))
+            mock_monotonic.return_value = 161
+            self.assertIsNone(cache.get("key"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(2, 60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_invalidate(self):
+        cache = TTLCache(10, 60)
+        cache.put("a", 1)
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
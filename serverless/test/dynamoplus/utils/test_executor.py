@@ -0,0 +1,120 @@
+import gc
+import threading
+import time
+import unittest
+
+from dynamoplus.utils.executor import run_in_parallel, PrefetchingIterator
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_results_in_order(self):
+        tasks = [lambda i=i: time.sleep(0.01 * (5 - i)) or i for i in range(5)]
+        self.assertEqual([0, 1, 2, 3, 4], run_in_parallel(tasks))
+
+    def test_empty(self):
+        self.assertEqual([], run_in_parallel([]))
+
+    def test_tasks_overlap(self):
+        barrier = threading.Barrier(3, timeout=5)
+        result = run_in_parallel([lambda: barrier.wait() is not None for _ in range(3)])
+        self.assertEqual([True, True, True], result)
+
+    def test_error_raised_after_all_tasks(self):
+        done = []
+
+        def fail():
+            raise Exception("failed")
+
+        def slow():
+            time.sleep(0.05)
+            done.append(True)
+
+        self.assertRaises(Exception, run_in_parallel, [fail, slow])
+        self.assertEqual([True], done)
+
+    def test_nested_tasks_run_inline(self):
+        result = run_in_parallel([lambda: 0] + [lambda i=i: sum(run_in_parallel([lambda: i, lambda: i])) for i in
+                                                range(1, 20)])
+        self.assertEqual([i * 2 for i in range(20)], result)
+
+
+class TestPrefetchingIterator(unittest.TestCase):
+
+    def test_iterates_all_pages(self):
+        pages = {None: ([1, 2], "a"), "a": ([3], "b"), "b": ([4, 5], None)}
+        self.assertEqual([1, 2, 3, 4, 5], list(PrefetchingIterator(lambda cursor: pages[cursor], 2)))
+
+    def test_next_page_fetched_while_consuming(self):
+        fetched = []
+        second_page_fetched = threading.Event()
+
+        def fetch_page(cursor):
+            fetched.append(cursor)
+            if cursor is None:
+                return [1], "a"
+            second_page_fetched.set()
+            return [2], None
+
+        iterator = PrefetchingIterator(fetch_page)
+        self.assertEqual(1, next(iterator))
+        self.assertTrue(second_page_fetched.wait(5))
+        self.assertEqual([2], list(iterator))
+        self.assertEqual([None, "a"], fetched)
+
+    def test_error_raised_to_consumer(self):
+        def fetch_page(cursor):
+            if cursor is None:
+                return [1], "a"
+            raise Exception("throttled")
+
+        iterator = PrefetchingIterator(fetch_page)
+        self.assertEqual(1, next(iterator))
+        self.assertRaises(Exception, next, iterator)
+
+    def test_close_stops_fetching(self):
+        fetched = []
+
+        def fetch_page(cursor):
+            fetched.append(cursor)
+            return [len(fetched)], len(fetched)
+
+        iterator = PrefetchingIterator(fetch_page, 1)
+        self.assertEqual(1, next(iterator))
+        iterator.close()
+        time.sleep(0.3)
+        count = len(fetched)
+        time.sleep(0.3)
+        self.assertEqual(count, len(fetched))
+        self.assertRaises(StopIteration, next, iterator)
+
+    def test_pages_fetched_in_the_pool(self):
+        threads = []
+
+        def fetch_page(cursor):
+            threads.append(threading.current_thread().name)
+            return [cursor or 0], (cursor or 0) + 1 if (cursor or 0) < 3 else None
+
+        self.assertEqual([0, 1, 2, 3], list(PrefetchingIterator(fetch_page, 2)))
+        ## the threads of the shared pool, with their DynamoDB resources
+        self.assertTrue(all(t.startswith("dynamoplus_") for t in threads))
+        ## a consumer running in the pool fetches its pages in its own thread
+        self.assertEqual([None, [0, 1, 2, 3]],
+                         run_in_parallel([lambda: None, lambda: list(PrefetchingIterator(fetch_page, 2))]))
+
+    def test_collected_iterator_stops_fetching(self):
+        fetched = []
+
+        def fetch_page(cursor):
+            fetched.append(cursor)
+            return [len(fetched)], len(fetched)
+
+        iterator = PrefetchingIterator(fetch_page, 2)
+        self.assertEqual(1, next(iterator))
+        del iterator
+        gc.collect()
+        time.sleep(0.1)
+        count = len(fetched)
+        time.sleep(0.1)
+        self.assertEqual(count, len(fetched))
+        self.assertLessEqual(count, 3)